@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import random
+import binascii
+import shutil
+import logging
+import platform
+import tempfile
+import argparse
+import subprocess
+import threading
+import multiprocessing
+import logger
+
+from commons import CommonConsts, CommonUtils
+from manifestutils import ManifestGenerator, ManifestFile
+from swdepot import SoftwareDepot
+from depinstall import INSTALL_ENGINES, INSTALL_ENGINE_POOL, get_installer_class
+from verifier import InstallVerifier, VERIFY_MODE_QUICK, VERIFY_MODE_DEEP
+from transport import DepotHTTPServer
+from metrics import Metrics, METRICS_TOTAL
+
+'''
+Offline benchmark of voltron20 on synthetic staging trees and depots. Nothing is downloaded: the
+content of the staged files is derived from a seed, so every run of a shape with the same parameters
+stages exactly the same files. Results are written as JSON; compare them with --compare to spot
+regressions.
+'''
+RESULTS_FORMAT_VERSION = 1
+
+BENCH_VERSION = "1.0"
+BENCH_PLATFORM = "bench"
+
+STEP_GENFILE = "genfile"
+STEP_GENFILE_CACHED = "genfile_cached"
+STEP_DEPOT_ADD = "depot_add"
+STEP_INSTALL = "install"
+STEP_VERIFY_QUICK = "verify_quick"
+STEP_VERIFY_DEEP = "verify_deep"
+STEP_DEPOT_UPDATE = "depot_update"
+STEP_INSTALL_UPDATE = "install_update"
+STEPS = (STEP_GENFILE, STEP_GENFILE_CACHED, STEP_DEPOT_ADD, STEP_INSTALL, STEP_VERIFY_QUICK, STEP_VERIFY_DEEP,
+         STEP_DEPOT_UPDATE, STEP_INSTALL_UPDATE)
+
+STARTUP_HELP = "help"
+STARTUP_GENSHA1 = "gensha1"
+STARTUP_DEPOT_LIST = "depot_list"
+STARTUP_COMMANDS = (STARTUP_HELP, STARTUP_GENSHA1, STARTUP_DEPOT_LIST)
+STARTUP_BUDGET = 0.075 # seconds a short command may take on top of starting the interpreter
+
+_BLOCK_SIZE = 1024 * 1024
+_WORDS = ("couchbase", "erlang", "otp", "beam", "v8", "snappy", "icu", "libevent", "module", "static", "const",
+          "return", "include", "define", "struct", "void", "int", "char", "if", "else", "for", "while")
+
+
+class Shape:
+    """Parameters of a synthetic workload: packages of files_per_package files with sizes drawn between
+    min_file_size and max_file_size, of which compressible_ratio are text-like and the rest random bytes.
+    With more than one package, a root package depends on all others, which all depend on the first.
+    update_ratio of the files of each package are changed, added or removed before the update steps.
+    """
+
+    def __init__(self, name, packages, files_per_package, min_file_size, max_file_size, files_per_dir=64,
+                 compressible_ratio=0.5, duplicate_ratio=0.05, update_ratio=0.1):
+        self.name = name
+        self.packages = packages
+        self.files_per_package = files_per_package
+        self.min_file_size = min_file_size
+        self.max_file_size = max_file_size
+        self.files_per_dir = files_per_dir
+        self.compressible_ratio = compressible_ratio
+        self.duplicate_ratio = duplicate_ratio
+        self.update_ratio = update_ratio
+
+    def scaled(self, scale):
+        return Shape(self.name, max(1, int(round(self.packages * scale))) if self.packages > 1 else 1,
+                     max(1, int(round(self.files_per_package * scale))), self.min_file_size, self.max_file_size,
+                     self.files_per_dir, self.compressible_ratio, self.duplicate_ratio, self.update_ratio)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+'''
+Workloads modelled on the packages that install slowly: many tiny files (otp), a few huge files (v8)
+and a package with a wide fan-out of small dependencies (couchbase-deps).
+'''
+SHAPES = {
+    "small-files": Shape("small-files", 1, 5000, 64, 4096),
+    "large-files": Shape("large-files", 1, 4, 16 * 1024 * 1024, 48 * 1024 * 1024, compressible_ratio=0.25),
+    "fanout": Shape("fanout", 40, 25, 256, 16 * 1024),
+}
+
+
+class SyntheticTree:
+    """Stages the packages of a shape under stage_dir, with file content derived from seed."""
+
+    def __init__(self, shape, stage_dir, seed):
+        self._shape = shape
+        self._stage_dir = stage_dir
+        self._seed = seed
+        rng = random.Random(seed)
+        self._random_block = binascii.unhexlify("{0:0{1}x}".format(rng.getrandbits(_BLOCK_SIZE * 8), _BLOCK_SIZE * 2))
+        self._text_block = " ".join(rng.choice(_WORDS) for _ in xrange(_BLOCK_SIZE / 4))[:_BLOCK_SIZE]
+
+    def package_names(self):
+        return ["bench{0:03d}".format(i) for i in xrange(self._shape.packages)]
+
+    def root_package(self):
+        return "bench-root" if self._shape.packages > 1 else self.package_names()[0]
+
+    def package_dir(self, package):
+        return os.path.join(self._stage_dir, package)
+
+    def stage(self):
+        """Writes every package. Returns (file count, byte count)."""
+        totals = [0, 0]
+        for package in self.package_names():
+            rng = random.Random("{0}-{1}".format(self._seed, package))
+            for i in xrange(self._shape.files_per_package):
+                self._add(totals, rng, package, i, i)
+        return tuple(totals)
+
+    def mutate(self):
+        """Changes, adds and removes update_ratio of the files of every package. Returns (file count, byte count) written."""
+        totals = [0, 0]
+        for package in self.package_names():
+            rng = random.Random("{0}-{1}-update".format(self._seed, package))
+            count = self._shape.files_per_package
+            for i in rng.sample(xrange(count), max(1, int(count * self._shape.update_ratio))):
+                action = rng.random()
+                if action < 0.2:
+                    os.remove(self._file_path(package, i))
+                elif action < 0.4:
+                    self._add(totals, rng, package, count + i, count + i)
+                else:
+                    self._add(totals, rng, package, i, count + i)
+        return tuple(totals)
+
+    def _add(self, totals, rng, package, index, content_index):
+        size = rng.randint(self._shape.min_file_size, self._shape.max_file_size)
+        if rng.random() < self._shape.duplicate_ratio:
+            content_index = 0
+            size = self._shape.min_file_size
+        block = self._text_block if rng.random() < self._shape.compressible_ratio else self._random_block
+        path = self._file_path(package, index)
+        CommonUtils.make_dirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            self._write_content(f, block, "{0}:{1}:{2}\n".format(package, content_index, size) if content_index else "", size)
+        os.chmod(path, 0755 if index % 7 == 0 else 0644)
+        totals[0] += 1
+        totals[1] += size
+
+    def _write_content(self, f, block, header, size):
+        f.write(header[:size])
+        written = min(len(header), size)
+        offset = hash(header) % _BLOCK_SIZE
+        while written < size:
+            chunk = block[offset:offset + min(size - written, CommonConsts.IO_CHUNK_SIZE)]
+            f.write(chunk)
+            written += len(chunk)
+            offset = (offset + len(chunk) + 1) % _BLOCK_SIZE
+
+    def _file_path(self, package, index):
+        d = index // self._shape.files_per_dir
+        return os.path.join(self.package_dir(package), "lib", package, "d{0:03d}".format(d // 64), "d{0:03d}".format(d % 64),
+                            "f{0:06d}.dat".format(index))
+
+
+class Benchmark:
+    """Runs the steps of a shape repeat times, each run on a freshly staged tree under work_dir.
+
+    The wall time of every step is recorded; install, update and depot steps also record the time
+    of each of their phases. pack, compress, chunk and http choose how the depot is published and read,
+    and engine the install engine.
+    """
+
+    def __init__(self, shape, work_dir, repeat=3, jobs=None, dep_jobs=CommonConsts.DEFAULT_DEPENDENCY_JOBS, seed=0,
+                 pack=False, compress=False, http=False, engine=INSTALL_ENGINE_POOL, chunk=False):
+        self._shape = shape
+        self._work_dir = work_dir
+        self._repeat = repeat
+        self._jobs = jobs or multiprocessing.cpu_count()
+        self._dep_jobs = dep_jobs
+        self._seed = seed
+        self._pack = pack
+        self._compress = compress
+        self._http = http
+        self._engine = engine
+        self._chunk = chunk
+
+    def run(self):
+        runs = dict((step, []) for step in STEPS)
+        phases = dict((step, []) for step in STEPS)
+        sizes = {}
+        for i in xrange(self._repeat):
+            run_dir = os.path.join(self._work_dir, "run{0}".format(i))
+            if os.path.exists(run_dir):
+                shutil.rmtree(run_dir)
+            try:
+                for step, seconds, step_phases in self._run_once(run_dir, sizes):
+                    runs[step].append(seconds)
+                    if step_phases:
+                        phases[step].append(step_phases)
+            finally:
+                shutil.rmtree(run_dir, ignore_errors=True)
+        results = {}
+        for step in STEPS:
+            results[step] = {"runs": runs[step], "min": min(runs[step]), "median": _median(runs[step]),
+                             "phases": _median_phases(phases[step])}
+        return {"format": RESULTS_FORMAT_VERSION, "shape": self._shape.to_dict(), "created": time.time(),
+                "options": {"repeat": self._repeat, "jobs": self._jobs, "dep_jobs": self._dep_jobs, "seed": self._seed,
+                            "pack": self._pack, "compress": self._compress, "http": self._http,
+                            "engine": self._engine, "chunk": self._chunk},
+                "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                                "cpus": multiprocessing.cpu_count()},
+                "staged": sizes, "results": results}
+
+    def _run_once(self, run_dir, sizes):
+        tree = SyntheticTree(self._shape, os.path.join(run_dir, "staging"), self._seed)
+        manifest_dir = os.path.join(run_dir, "manifests")
+        depot_dir = os.path.join(run_dir, "depot")
+        install_dir = os.path.join(run_dir, "install")
+        CommonUtils.make_dirs(manifest_dir)
+        sizes["files"], sizes["bytes"] = tree.stage()
+
+        yield STEP_GENFILE, self._time(self._generate_manifests, tree, manifest_dir), None
+        yield STEP_GENFILE_CACHED, self._time(self._generate_manifests, tree, manifest_dir), None
+        yield self._depot_step(STEP_DEPOT_ADD, tree, manifest_dir, depot_dir, SoftwareDepot.add)
+        yield self._install_step(STEP_INSTALL, tree, depot_dir, install_dir, [tree.root_package()])
+        yield STEP_VERIFY_QUICK, self._time(self._verify, install_dir, VERIFY_MODE_QUICK), None
+        yield STEP_VERIFY_DEEP, self._time(self._verify, install_dir, VERIFY_MODE_DEEP), None
+        sizes["update_files"], sizes["update_bytes"] = tree.mutate()
+        self._generate_manifests(tree, manifest_dir)
+        yield self._depot_step(STEP_DEPOT_UPDATE, tree, manifest_dir, depot_dir, SoftwareDepot.update)
+        # updating an installed package does not revisit its dependencies, so every package is updated
+        yield self._install_step(STEP_INSTALL_UPDATE, tree, depot_dir, install_dir, tree.package_names())
+
+    def _generate_manifests(self, tree, manifest_dir):
+        for package in tree.package_names():
+            ManifestGenerator(package, BENCH_VERSION, BENCH_PLATFORM, tree.package_dir(package), manifest_dir,
+                              jobs=self._jobs).generate_manifest()
+        if tree.root_package() not in tree.package_names():
+            self._write_root_manifest(tree, manifest_dir)
+
+    def _write_root_manifest(self, tree, manifest_dir):
+        packages = tree.package_names()
+        depends = [_depends_entry(p) for p in packages]
+        manifest = {CommonConsts.MF_KEY_BUILD: [], CommonConsts.MF_KEY_DIRS: [], CommonConsts.MF_KEY_FILES: [],
+                    CommonConsts.MF_KEY_DEPENDS: depends}
+        ManifestFile.write_file(manifest, os.path.join(manifest_dir, _manifest_filename(tree.root_package())))
+        for package in packages[1:]:
+            path = os.path.join(manifest_dir, _manifest_filename(package))
+            manifest = ManifestFile.load_file(path)
+            manifest[CommonConsts.MF_KEY_DEPENDS] = [_depends_entry(packages[0])]
+            ManifestFile.write_file(manifest, path)
+
+    def _depot_step(self, step, tree, manifest_dir, depot_dir, func):
+        metrics = Metrics()
+        depot = SoftwareDepot(depot_dir, self._jobs, metrics=metrics)
+        packages = tree.package_names()
+        if tree.root_package() not in packages:
+            packages = packages + [tree.root_package()]
+        empty_dir = os.path.join(self._work_dir, "empty")
+        CommonUtils.make_dirs(empty_dir)
+
+        def publish():
+            for package in packages:
+                staged = tree.package_dir(package) if package in tree.package_names() else empty_dir
+                func(depot, package, BENCH_VERSION, BENCH_PLATFORM, staged, manifest_dir, self._pack, self._compress, self._chunk)
+
+        return step, self._time(publish), _phase_seconds(metrics)
+
+    def _install_step(self, step, tree, depot_dir, install_dir, packages):
+        metrics = Metrics()
+        server = None
+        location = depot_dir
+        if self._http:
+            server = DepotHTTPServer(depot_dir, "127.0.0.1", 0)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            location = server.get_url()
+
+        installer_class = get_installer_class(self._engine)
+
+        def install():
+            for package in packages:
+                installer_class(package, BENCH_VERSION, BENCH_PLATFORM, install_dir, location, jobs=self._jobs,
+                                 dep_jobs=self._dep_jobs, metrics=metrics).install()
+
+        try:
+            seconds = self._time(install)
+        finally:
+            if server:
+                server.shutdown()
+                server.server_close()
+        return step, seconds, _phase_seconds(metrics)
+
+    def _verify(self, install_dir, mode):
+        if not InstallVerifier(install_dir, self._jobs, mode).verify()["ok"]:
+            raise AssertionError("Benchmark install does not verify: {0}".format(install_dir))
+
+    def _time(self, func, *args):
+        start = time.time()
+        func(*args)
+        return time.time() - start
+
+
+class StartupBenchmark:
+    """Times cold starts of short voltron20 commands, each run repeat times in a new interpreter as scripts run them.
+
+    The overhead of a command is its median wall time less that of an interpreter running nothing, which keeps
+    budget, in seconds, comparable across machines; the commands whose overhead exceeds it are listed in over_budget.
+    """
+
+    def __init__(self, work_dir, repeat=10, budget=STARTUP_BUDGET):
+        self._work_dir = work_dir
+        self._repeat = repeat
+        self._budget = budget
+        self._script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "voltron20.py")
+
+    def run(self):
+        CommonUtils.make_dirs(self._work_dir)
+        sample = os.path.join(self._work_dir, "sample.dat")
+        with open(sample, "wb") as f:
+            f.write(os.urandom(64 * 1024))
+        commands = {STARTUP_HELP: ["--help"],
+                    STARTUP_GENSHA1: ["manifest", "gensha1", sample],
+                    STARTUP_DEPOT_LIST: ["depot", "-l", os.path.join(self._work_dir, "depot"), "list"]}
+        # the first run creates the depot index and compiles the modules
+        self._time_runs([sys.executable, self._script] + commands[STARTUP_DEPOT_LIST], 1)
+        interpreter = self._time_runs([sys.executable, "-c", "pass"], self._repeat)
+        base = _median(interpreter)
+        results = {}
+        for name in STARTUP_COMMANDS:
+            runs = self._time_runs([sys.executable, self._script] + commands[name], self._repeat)
+            results[name] = {"runs": runs, "min": min(runs), "median": _median(runs), "overhead": max(0.0, _median(runs) - base)}
+        return {"format": RESULTS_FORMAT_VERSION, "created": time.time(),
+                "options": {"repeat": self._repeat, "budget": self._budget},
+                "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                                "cpus": multiprocessing.cpu_count()},
+                "interpreter": {"runs": interpreter, "min": min(interpreter), "median": base},
+                "results": results,
+                "over_budget": [name for name in STARTUP_COMMANDS if results[name]["overhead"] > self._budget]}
+
+    def _time_runs(self, argv, repeat):
+        runs = []
+        with open(os.devnull, "w") as devnull:
+            for i in xrange(repeat):
+                start = time.time()
+                if subprocess.call(argv, stdout=devnull, stderr=devnull):
+                    raise AssertionError("Benchmark command failed: {0}".format(" ".join(argv)))
+                runs.append(time.time() - start)
+        return runs
+
+
+def _manifest_filename(package):
+    return CommonUtils.generate_manifest_filename(package, BENCH_VERSION, BENCH_PLATFORM, CommonConsts.MF_EXT_JSON)
+
+def _depends_entry(package):
+    return {CommonConsts.MF_KEY_DEPENDS_ATTR_PACKAGE: package, CommonConsts.MF_KEY_DEPENDS_ATTR_VERSION: BENCH_VERSION,
+            CommonConsts.MF_KEY_DEPENDS_ATTR_PLATFORM: BENCH_PLATFORM,
+            CommonConsts.MF_KEY_DEPENDS_ATTR_MANIFEST: _manifest_filename(package)}
+
+def _phase_seconds(metrics):
+    total = metrics.to_dict()["packages"].get(METRICS_TOTAL, {"phases": {}})
+    return dict((phase, p["seconds"]) for phase, p in total["phases"].items())
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def _median_phases(runs):
+    phases = set(p for run in runs for p in run)
+    return dict((p, _median([run.get(p, 0.0) for run in runs])) for p in phases)
+
+
+def compare(results, baseline, threshold):
+    """Compares the median step times of results with those of baseline. Returns (step, baseline, current, ratio) rows
+    and the steps that got slower than baseline by more than threshold, a fraction."""
+    rows = []
+    regressions = []
+    for step in STEPS + STARTUP_COMMANDS:
+        if step not in results["results"] or step not in baseline["results"]:
+            continue
+        old = baseline["results"][step]["median"]
+        new = results["results"][step]["median"]
+        ratio = new / old if old else 1.0
+        rows.append((step, old, new, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(step)
+    return rows, regressions
+
+def format_results(results, rows=None):
+    lines = ["Shape {0}: {1} files, {2} bytes; {3} runs with {4} jobs.".format(results["shape"]["name"], results["staged"]["files"],
+             results["staged"]["bytes"], results["options"]["repeat"], results["options"]["jobs"])]
+    baseline = dict((row[0], row) for row in rows or [])
+    for step in STEPS:
+        r = results["results"][step]
+        line = "    {0:<16}{1:>10.3f}s median{2:>10.3f}s min".format(step, r["median"], r["min"])
+        if step in baseline:
+            line += "{0:>+9.1f}% vs baseline".format((baseline[step][3] - 1) * 100)
+        lines.append(line)
+    return "\n".join(lines)
+
+def format_startup_results(results, rows=None):
+    lines = ["Startup of voltron20 commands over {0} runs; the interpreter alone takes {1:.1f}ms, the budget is {2:.1f}ms.".format(
+             results["options"]["repeat"], results["interpreter"]["median"] * 1000, results["options"]["budget"] * 1000)]
+    baseline = dict((row[0], row) for row in rows or [])
+    for name in STARTUP_COMMANDS:
+        r = results["results"][name]
+        line = "    {0:<16}{1:>8.1f}ms median{2:>8.1f}ms min{3:>8.1f}ms overhead".format(
+            name, r["median"] * 1000, r["min"] * 1000, r["overhead"] * 1000)
+        if name in results["over_budget"]:
+            line += " over budget"
+        if name in baseline:
+            line += "{0:>+9.1f}% vs baseline".format((baseline[name][3] - 1) * 100)
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def _define_arguments():
+    parser = argparse.ArgumentParser(prog="benchmark", description="Benchmark voltron20 on synthetic packages.")
+    parser.add_argument("--shape", "-s", dest="shape", choices=sorted(SHAPES), default="small-files", help="Workload shape.")
+    parser.add_argument("--scale", dest="scale", type=float, default=1.0, help="Multiplies the number of files and packages of the shape.")
+    parser.add_argument("--repeat", "-r", dest="repeat", type=int, default=3, help="Number of runs of every step.")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int, help="Number of parallel jobs. Defaults to the number of CPUs.")
+    parser.add_argument("--dep_jobs", "-dj", dest="dep_jobs", type=int, default=CommonConsts.DEFAULT_DEPENDENCY_JOBS, help="Number of dependency packages installed in parallel.")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed of the staged content.")
+    parser.add_argument("--pack", dest="pack", action="store_true", help="Publish packfiles.")
+    parser.add_argument("--compress", dest="compress", action="store_true", help="Publish compressed blobs.")
+    parser.add_argument("--chunk", dest="chunk", action="store_true", help="Publish large files as content-defined chunks.")
+    parser.add_argument("--http", dest="http", action="store_true", help="Install from the depot served over HTTP.")
+    parser.add_argument("--engine", dest="engine", choices=INSTALL_ENGINES, default=INSTALL_ENGINE_POOL, help="Install engine.")
+    parser.add_argument("--work_dir", "-w", dest="work_dir", help="Directory to stage, publish and install in. Defaults to a temporary directory.")
+    parser.add_argument("--output", "-o", dest="output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", dest="baseline", help="Compare with the results in this JSON file.")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=0.1, help="Slowdown, as a fraction, reported as a regression.")
+    parser.add_argument("--startup", dest="startup", action="store_true", help="Time the cold start of short commands instead of a shape.")
+    parser.add_argument("--budget", dest="budget", type=float, default=STARTUP_BUDGET,
+                        help="Seconds a short command may take on top of starting the interpreter, with --startup.")
+    return parser.parse_args()
+
+def main():
+    args = _define_arguments()
+    logger.Logger.get_logger().setLevel(logging.WARNING)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="v20bench-")
+    try:
+        if args.startup:
+            results = StartupBenchmark(work_dir, args.repeat, args.budget).run()
+        else:
+            results = Benchmark(SHAPES[args.shape].scaled(args.scale), work_dir, args.repeat, args.jobs, args.dep_jobs, args.seed,
+                                args.pack, args.compress, args.http, args.engine, args.chunk).run()
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    rows, regressions = None, []
+    if args.baseline:
+        with open(args.baseline) as f:
+            rows, regressions = compare(results, json.load(f), args.threshold)
+    if args.startup:
+        print format_startup_results(results, rows)
+    else:
+        print format_results(results, rows)
+    if args.output:
+        CommonUtils.write_json_atomic(args.output, results)
+    if regressions:
+        print "Regressions: {0}".format(", ".join(regressions))
+        return 1
+    if args.startup and results["over_budget"]:
+        print "Over budget: {0}".format(", ".join(results["over_budget"]))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
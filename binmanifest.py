@@ -0,0 +1,174 @@
+import os
+import mmap
+import json
+import struct
+import binascii
+
+from commons import CommonConsts
+
+'''
+Binary manifest layout (little endian):
+
+    header      magic, format version, file count, prefix count and the offsets/lengths of the sections below
+    metadata    JSON of every manifest key except "files" (dirs, depends, build)
+    prefixes    interned directory names of the file paths: <u16 length><utf-8 bytes>
+    records     one record per file, sorted by path: <u32 prefix index><u16 mode><20 byte sha1><u16 length><utf-8 file name>
+    index       <u32 offset> of every record relative to the start of the records section
+'''
+MAGIC = "V20M"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHIIQQQQQ")
+_PREFIX = struct.Struct("<H")
+_RECORD = struct.Struct("<IH20sH")
+_INDEX = struct.Struct("<I")
+
+
+def is_binary_manifest(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+class BinaryManifestWriter:
+
+    @staticmethod
+    def to_bytes(manifest):
+        files = sorted(manifest.get(CommonConsts.MF_KEY_FILES, []), key=lambda f: f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        metadata = dict((k, v) for k, v in manifest.items() if k != CommonConsts.MF_KEY_FILES)
+        meta_bytes = json.dumps(metadata)
+
+        prefixes = []
+        prefix_ids = {}
+        records = []
+        index = []
+        offset = 0
+        for f in files:
+            dirname, basename = os.path.split(f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+            if dirname not in prefix_ids:
+                prefix_ids[dirname] = len(prefixes)
+                prefixes.append(dirname)
+            name = basename.encode("utf-8")
+            record = _RECORD.pack(prefix_ids[dirname], int(f[CommonConsts.MF_KEY_FILES_ATTR_MODE], 8),
+                                  binascii.unhexlify(f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]), len(name)) + name
+            index.append(_INDEX.pack(offset))
+            records.append(record)
+            offset += len(record)
+        prefix_bytes = "".join(_PREFIX.pack(len(p)) + p for p in (d.encode("utf-8") for d in prefixes))
+
+        meta_offset = _HEADER.size
+        prefix_offset = meta_offset + len(meta_bytes)
+        records_offset = prefix_offset + len(prefix_bytes)
+        index_offset = records_offset + offset
+        header = _HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(files), len(prefixes), meta_offset, len(meta_bytes),
+                              prefix_offset, records_offset, index_offset)
+        return "".join([header, meta_bytes, prefix_bytes] + records + index)
+
+    @staticmethod
+    def write(manifest, path):
+        with open(path, "wb") as f:
+            f.write(BinaryManifestWriter.to_bytes(manifest))
+
+
+class BinaryManifest:
+    """Read-only view of a binary manifest that behaves like the dictionary of a JSON manifest.
+
+    The file records are decoded only when accessed, so opening a manifest costs one header and
+    metadata read however many files it lists. data is a string or an mmap of the whole manifest.
+    """
+
+    def __init__(self, data):
+        if not is_binary_manifest(data):
+            raise ValueError("Not a binary manifest.")
+        (magic, version, flags, self._file_count, prefix_count, meta_offset, meta_length,
+         prefix_offset, self._records_offset, self._index_offset) = _HEADER.unpack_from(data, 0)
+        if version != FORMAT_VERSION:
+            raise ValueError("Not supported binary manifest version: {0}".format(version))
+        self._data = data
+        self._metadata = json.loads(data[meta_offset:meta_offset + meta_length])
+        self._prefixes = []
+        pos = prefix_offset
+        for _ in xrange(prefix_count):
+            (length,) = _PREFIX.unpack_from(data, pos)
+            pos += _PREFIX.size
+            self._prefixes.append(data[pos:pos + length].decode("utf-8"))
+            pos += length
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self._metadata) + 1
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return key == CommonConsts.MF_KEY_FILES or key in self._metadata
+
+    def __getitem__(self, key):
+        if key == CommonConsts.MF_KEY_FILES:
+            return BinaryManifestFiles(self)
+        return self._metadata[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return [CommonConsts.MF_KEY_FILES] + self._metadata.keys()
+
+    def file_count(self):
+        return self._file_count
+
+    def get_file(self, i):
+        (offset,) = _INDEX.unpack_from(self._data, self._index_offset + i * _INDEX.size)
+        pos = self._records_offset + offset
+        prefix_id, mode, sha1, length = _RECORD.unpack_from(self._data, pos)
+        pos += _RECORD.size
+        name = self._data[pos:pos + length].decode("utf-8")
+        prefix = self._prefixes[prefix_id]
+        return {CommonConsts.MF_KEY_FILES_ATTR_PATH: os.path.join(prefix, name) if prefix else name,
+                CommonConsts.MF_KEY_FILES_ATTR_SHA1: binascii.hexlify(sha1),
+                CommonConsts.MF_KEY_FILES_ATTR_MODE: oct(mode)}
+
+    def find_file(self, path):
+        """Returns the file entry of path, found by binary search over the sorted records, or None."""
+        lo, hi = 0, self._file_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            f = self.get_file(mid)
+            if f[CommonConsts.MF_KEY_FILES_ATTR_PATH] < path:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._file_count:
+            f = self.get_file(lo)
+            if f[CommonConsts.MF_KEY_FILES_ATTR_PATH] == path:
+                return f
+        return None
+
+    def to_bytes(self):
+        return self._data[:]
+
+
+class BinaryManifestFiles:
+    """Lazy sequence of the file entries of a BinaryManifest."""
+
+    def __init__(self, manifest):
+        self._manifest = manifest
+
+    def __len__(self):
+        return self._manifest.file_count()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._manifest.get_file(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._manifest.get_file(i)
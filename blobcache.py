@@ -0,0 +1,125 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+import logger
+
+from commons import CommonUtils, CommonConsts
+
+
+class BlobCache:
+    """Local content-addressed cache of depot blobs, shared by every install root on a machine.
+
+    Blobs are kept under <cache_dir>/<sha1[:2]>/<sha1> and re-hashed as they are copied out, so a
+    corrupted entry is dropped and fetched again. Cache hits are reflinked into the install tree
+    where possible and copied otherwise, never hardlinked, as installed files are chmodded and may
+    be edited in place. Sizes and access times live in a SQLite index;
+    accesses are recorded in memory and written by flush(), which also evicts the least recently
+    used blobs once the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=CommonConsts.DEFAULT_BLOB_CACHE_SIZE_MB * 1024 * 1024):
+        self._log = logger.Logger.get_logger()
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._index_file = os.path.join(cache_dir, CommonConsts.BLOB_CACHE_INDEX_FILE)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        CommonUtils.make_dirs(cache_dir)
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS blobs (sha1 TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def blob_path(self, sha1):
+        return os.path.join(self._cache_dir, CommonUtils.generate_blob_path(sha1))
+
+    def materialize(self, sha1, destfile):
+        """Places the cached blob sha1 at destfile. Returns its size, or None if the blob is not cached or corrupted."""
+        path = self.blob_path(sha1)
+        if not os.path.exists(path):
+            self._record_miss()
+            return None
+        try:
+            digest = hashlib.sha1()
+            CommonUtils.clone_or_copy(path, destfile, digest)
+            if digest.hexdigest() != sha1:
+                self._log.warning("Removing corrupted blob from cache: {0}".format(path))
+                os.remove(path)
+                os.remove(destfile)
+                self._record_miss()
+                return None
+        except (IOError, OSError) as e:
+            self._log.warning("Could not use cached blob: {0}. Error is {1}".format(path, e))
+            self._record_miss()
+            return None
+        size = os.path.getsize(destfile)
+        with self._lock:
+            self.hits += 1
+        self._record(sha1, size)
+        return size
+
+    def add(self, sha1, srcfile):
+        """Adds srcfile, whose content has been verified to hash to sha1, to the cache."""
+        path = self.blob_path(sha1)
+        if os.path.exists(path):
+            return
+        try:
+            CommonUtils.make_dirs(os.path.dirname(path))
+            temp = path + CommonConsts.TEMP_FILE_SUFFIX + str(threading.current_thread().ident)
+            CommonUtils.clone_or_copy(srcfile, temp)
+            os.rename(temp, path)
+        except (IOError, OSError) as e:
+            self._log.warning("Could not add blob to cache: {0}. Error is {1}".format(path, e))
+            return
+        self._record(sha1, os.path.getsize(path))
+
+    def flush(self):
+        """Writes the recorded accesses to the index and evicts least recently used blobs beyond max_size."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            conn = self._connect()
+            try:
+                conn.executemany("INSERT OR REPLACE INTO blobs (sha1, size, last_access) VALUES (?, ?, ?)",
+                                 [(sha1, size, atime) for sha1, (size, atime) in pending.iteritems()])
+                conn.commit()
+                self._evict(conn)
+            finally:
+                conn.close()
+        if self.hits or self.misses:
+            self._log.info("Blob cache: {0} hits, {1} misses.".format(self.hits, self.misses))
+
+    def _evict(self, conn):
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        if total <= self._max_size:
+            return
+        target = self._max_size * CommonConsts.BLOB_CACHE_EVICT_RATIO
+        evicted = []
+        for sha1, size in conn.execute("SELECT sha1, size FROM blobs ORDER BY last_access").fetchall():
+            if total <= target:
+                break
+            try:
+                os.remove(self.blob_path(sha1))
+            except OSError:
+                pass
+            evicted.append((sha1,))
+            total -= size
+        conn.executemany("DELETE FROM blobs WHERE sha1 = ?", evicted)
+        conn.commit()
+        self._log.info("Evicted {0} blobs from blob cache: {1}.".format(len(evicted), self._cache_dir))
+
+    def _record(self, sha1, size):
+        with self._lock:
+            self._pending[sha1] = (size, time.time())
+
+    def _record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def _connect(self):
+        return sqlite3.connect(self._index_file, timeout=60)
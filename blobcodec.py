@@ -0,0 +1,211 @@
+import os
+import bz2
+import zlib
+import struct
+import hashlib
+
+from commons import CommonUtils, CommonConsts, ChecksumError
+
+'''
+A depot blob is stored either as the plain file content or compressed, behind a header holding its codec:
+
+    <4 byte magic "V20Z"><u8 codec><u64 uncompressed size><compressed stream>
+
+Content that happens to start with the magic is stored behind a CODEC_NONE header, so a blob without
+a header never starts with the magic. Blobs are identified by the sha1 of their uncompressed content.
+'''
+MAGIC = "V20Z"
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_BZ2 = 2
+CODEC_NAMES = {CODEC_NONE: "none", CODEC_ZLIB: "zlib", CODEC_BZ2: "bz2"}
+
+_HEADER = struct.Struct("<4sBQ")
+
+
+def _new_compressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(CommonConsts.BLOB_ZLIB_LEVEL)
+    return bz2.BZ2Compressor(CommonConsts.BLOB_BZ2_LEVEL)
+
+def _new_decompressor(codec):
+    if codec == CODEC_NONE:
+        return None
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_BZ2:
+        return bz2.BZ2Decompressor()
+    raise ValueError("Not supported blob codec: {0}".format(codec))
+
+def _decompress(decompressor, data):
+    try:
+        return decompressor.decompress(data)
+    except (zlib.error, IOError, EOFError) as e:
+        raise ChecksumError("FATAL: Corrupted compressed blob. Error is {0}".format(e))
+
+def _flush(decompressor):
+    # BZ2Decompressor has nothing to flush
+    if hasattr(decompressor, "flush"):
+        return decompressor.flush()
+    return ""
+
+
+def choose_codec(path):
+    """Picks the codec for the file at path from its size and from how well a sample of it compresses:
+    none for small or incompressible files, bz2 for large files it shrinks clearly better, zlib otherwise."""
+    size = os.path.getsize(path)
+    if size < CommonConsts.BLOB_COMPRESS_MIN_SIZE:
+        return CODEC_NONE
+    with open(path, "rb") as f:
+        sample = f.read(CommonConsts.BLOB_COMPRESS_SAMPLE_SIZE)
+    zlib_size = len(zlib.compress(sample, CommonConsts.BLOB_ZLIB_LEVEL))
+    if zlib_size > len(sample) * CommonConsts.BLOB_COMPRESS_RATIO:
+        return CODEC_NONE
+    if size >= CommonConsts.BLOB_BZ2_MIN_SIZE and len(bz2.compress(sample, CommonConsts.BLOB_BZ2_LEVEL)) < zlib_size * CommonConsts.BLOB_BZ2_GAIN:
+        return CODEC_BZ2
+    return CODEC_ZLIB
+
+
+def encode_blob(src_path, dest_path, codec=CODEC_NONE, hardlink=False):
+    """Stores the file src_path as a blob at dest_path, compressed with codec unless that does not save enough,
+    hashing the content in the same pass. An uncompressed blob is reflinked where the filesystem supports it,
+    or hardlinked if hardlink is set, and copied otherwise. Returns (codec used, sha1 of the content)."""
+    size = os.path.getsize(src_path)
+    with open(src_path, "rb") as src:
+        if codec != CODEC_NONE:
+            digest = hashlib.new("sha1")
+            with open(dest_path, "wb") as dest:
+                dest.write(_HEADER.pack(MAGIC, codec, size))
+                compressor = _new_compressor(codec)
+                while True:
+                    chunk = src.read(CommonConsts.IO_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    dest.write(compressor.compress(chunk))
+                dest.write(compressor.flush())
+                if dest.tell() - _HEADER.size <= size * CommonConsts.BLOB_COMPRESS_RATIO:
+                    return codec, digest.hexdigest()
+            src.seek(0)
+        digest = hashlib.new("sha1")
+        framed = src.read(len(MAGIC)) == MAGIC
+        src.seek(0)
+        if not framed and (hardlink and _link(src_path, dest_path) or CommonUtils.reflink(src_path, dest_path)):
+            CommonUtils.copy_stream(src, None, digest)
+            return CODEC_NONE, digest.hexdigest()
+        with open(dest_path, "wb") as dest:
+            if framed:
+                dest.write(_HEADER.pack(MAGIC, CODEC_NONE, size))
+            CommonUtils.copy_stream(src, dest, digest)
+    return CODEC_NONE, digest.hexdigest()
+
+def _link(src_path, dest_path):
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+        return True
+    except OSError:
+        return False
+
+
+class BlobReader:
+    """Readable file object over the uncompressed content of the stored blob at path.
+    stored_bytes counts the bytes read from the blob file so far, as stored."""
+
+    def __init__(self, path):
+        self._f = open(path, "rb")
+        header = self._f.read(_HEADER.size)
+        if len(header) == _HEADER.size and header[:len(MAGIC)] == MAGIC:
+            magic, self.codec, self.size = _HEADER.unpack(header)
+            self._decompressor = _new_decompressor(self.codec)
+            self.stored_bytes = len(header)
+        else:
+            self._f.seek(0)
+            self.stored_bytes = 0
+            self.codec = CODEC_NONE
+            self.size = os.path.getsize(path)
+            self._decompressor = None
+        self._buffer = ""
+        self._eof = False
+
+    def read(self, n=-1):
+        if self._decompressor is None:
+            data = self._f.read(n)
+            self.stored_bytes += len(data)
+            return data
+        while (n < 0 or len(self._buffer) < n) and not self._eof:
+            chunk = self._f.read(CommonConsts.IO_CHUNK_SIZE)
+            self.stored_bytes += len(chunk)
+            if chunk:
+                self._buffer += _decompress(self._decompressor, chunk)
+            else:
+                self._buffer += _flush(self._decompressor)
+                self._eof = True
+        if n < 0:
+            n = len(self._buffer)
+        data, self._buffer = self._buffer[:n], self._buffer[n:]
+        return data
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class BlobDecoder:
+    """File-like sink that decodes a stored blob, written to it in chunks, into the file object dest.
+
+    size and hexdigest() describe the uncompressed content written to dest.
+    """
+
+    def __init__(self, dest):
+        self._dest = dest
+        self.seek(0)
+
+    def seek(self, pos):
+        self._dest.seek(pos)
+        self._head = ""
+        self._framed = None
+        self._decompressor = None
+        self._digest = hashlib.new("sha1")
+        self.size = 0
+
+    def truncate(self):
+        self._dest.truncate()
+
+    def write(self, chunk):
+        if self._framed is None:
+            self._head += chunk
+            if self._head[:len(MAGIC)] != MAGIC[:len(self._head)]:
+                self._framed = False
+            elif len(self._head) >= _HEADER.size:
+                self._framed = True
+                magic, codec, size = _HEADER.unpack_from(self._head)
+                self._decompressor = _new_decompressor(codec)
+            else:
+                return
+            chunk = self._head[_HEADER.size:] if self._framed else self._head
+            self._head = ""
+        if self._decompressor is not None:
+            chunk = _decompress(self._decompressor, chunk)
+        self._write(chunk)
+
+    def close(self):
+        if self._framed is None:
+            self._write(self._head)
+        elif self._decompressor is not None:
+            self._write(_flush(self._decompressor))
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def _write(self, data):
+        self._dest.write(data)
+        self._digest.update(data)
+        self.size += len(data)
@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+import threading
+
+from commons import CommonUtils, CommonConsts, ChecksumError, fcntl
+from blobcodec import BlobReader, encode_blob, choose_codec, CODEC_NONE
+from chunking import iter_chunks
+
+_refs_lock = threading.Lock()
+
+
+class _RefsLock:
+    """Serializes the updates of the package references of a depot: between the threads of this process, and by
+    an exclusive flock of the depot lock file, between processes."""
+
+    def __init__(self, lock_file):
+        self._lock_file = lock_file
+        self._f = None
+
+    def __enter__(self):
+        _refs_lock.acquire()
+        try:
+            if fcntl is not None:
+                CommonUtils.make_dirs(os.path.dirname(self._lock_file))
+                self._f = open(self._lock_file, "a")
+                fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        except Exception:
+            self._close()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._close()
+
+    def _close(self):
+        if self._f is not None:
+            self._f.close() # releases the flock
+            self._f = None
+        _refs_lock.release()
+
+
+class BlobStore:
+    """Content-addressed store for the data files of a software depot.
+
+    Every blob is stored once under datafiles/<sha1[:2]>/<sha1>, whichever package it came from.
+    The sha1s referenced by a package are recorded under refs/<package>.json and the number of
+    packages referencing each blob is kept in refcounts.json; a blob is removed when its count drops to zero.
+    Blobs may be stored compressed (see blobcodec); open_blob reads the uncompressed content.
+    Large files may instead be stored as their content-defined chunks (see chunking), each chunk a blob.
+    """
+
+    def __init__(self, depot_location):
+        self._df_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_DATAFILES_DIR)
+        self._refs_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_REFS_DIR)
+        self._refcounts_file = os.path.join(depot_location, CommonConsts.SW_DEPOT_REFCOUNTS_FILE)
+        self._lock_file = os.path.join(depot_location, CommonConsts.SW_DEPOT_LOCK_FILE)
+        self._refcounts = None
+
+    def blob_path(self, sha1):
+        return os.path.join(self._df_path, CommonUtils.generate_blob_path(sha1))
+
+    def has_blob(self, sha1):
+        return os.path.exists(self.blob_path(sha1))
+
+    def open_blob(self, sha1):
+        return BlobReader(self.blob_path(sha1))
+
+    def put_blob(self, src_path, sha1, compress=False, hardlink=False):
+        """Stores src_path as blob sha1, compressed with the codec choose_codec picks for it if compress is set.
+        The content is read once, and raises ChecksumError unless it hashes to sha1. Returns False if the blob was already stored."""
+        dest = self.blob_path(sha1)
+        if os.path.exists(dest):
+            return False
+        CommonUtils.make_dirs(os.path.dirname(dest))
+        temp = self._get_temp_file(dest)
+        codec, content_sha1 = encode_blob(src_path, temp, choose_codec(src_path) if compress else CODEC_NONE, hardlink)
+        if content_sha1 != sha1:
+            os.remove(temp)
+            raise ChecksumError("FATAL: File modified in staging area before installation: {0}".format(src_path))
+        os.rename(temp, dest)
+        return True
+
+    def put_chunks(self, src_path, sha1, compress=False):
+        """Stores the content-defined chunks of src_path as blobs and returns its recipe, [[chunk sha1, size], ...].
+        Raises ChecksumError unless the whole content hashes to sha1."""
+        digest = hashlib.new("sha1")
+        recipe = []
+        CommonUtils.make_dirs(self._df_path)
+        temp = self._get_temp_file(os.path.join(self._df_path, "chunk"))
+        try:
+            with open(src_path, "rb") as src:
+                for chunk in iter_chunks(src):
+                    digest.update(chunk)
+                    chunk_sha1 = hashlib.sha1(chunk).hexdigest()
+                    recipe.append([chunk_sha1, len(chunk)])
+                    if not self.has_blob(chunk_sha1):
+                        with open(temp, "wb") as f:
+                            f.write(chunk)
+                        self.put_blob(temp, chunk_sha1, compress)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        if digest.hexdigest() != sha1:
+            raise ChecksumError("FATAL: File modified in staging area before installation: {0}".format(src_path))
+        return recipe
+
+    def remove_blob(self, sha1):
+        """Removes blob sha1 unless a package references it."""
+        with self.lock_refs():
+            self._refcounts = None
+            self._remove_blob(sha1)
+
+    def _remove_blob(self, sha1):
+        if self.get_refcount(sha1) == 0 and self.has_blob(sha1):
+            os.remove(self.blob_path(sha1))
+
+    def get_refcount(self, sha1):
+        return self._get_refcounts().get(sha1, 0)
+
+    def get_refs(self, package):
+        path = self._get_refs_file(package)
+        if not os.path.exists(path):
+            return set()
+        with open(path, "rb") as f:
+            return set(json.load(f))
+
+    def lock_refs(self):
+        """Returns a context manager holding the lock of the references and refcounts of the depot."""
+        return _RefsLock(self._lock_file)
+
+    def set_refs(self, package, sha1s):
+        """Replaces the blobs referenced by package with sha1s and removes blobs nothing references any more."""
+        with self.lock_refs():
+            return self._set_refs(package, sha1s)
+
+    def _set_refs(self, package, sha1s):
+        old_refs = self.get_refs(package)
+        new_refs = set(sha1s)
+        self._refcounts = None
+        refcounts = self._get_refcounts()
+        for sha1 in new_refs - old_refs:
+            refcounts[sha1] = refcounts.get(sha1, 0) + 1
+        released = []
+        for sha1 in old_refs - new_refs:
+            refcounts[sha1] = refcounts.get(sha1, 1) - 1
+            if refcounts[sha1] <= 0:
+                del refcounts[sha1]
+                released.append(sha1)
+        if new_refs:
+            CommonUtils.make_dirs(self._refs_path)
+            CommonUtils.write_json_atomic(self._get_refs_file(package), sorted(new_refs))
+        elif os.path.exists(self._get_refs_file(package)):
+            os.remove(self._get_refs_file(package))
+        CommonUtils.write_json_atomic(self._refcounts_file, refcounts)
+        for sha1 in released:
+            self._remove_blob(sha1)
+        return released
+
+    def remove_refs(self, package):
+        return self.set_refs(package, ())
+
+    """Temporary name for path unique to the calling process and thread, as workers may store the same chunk at once."""
+    def _get_temp_file(self, path):
+        return "{0}.{1}.{2}{3}".format(path, os.getpid(), threading.current_thread().ident, CommonConsts.TEMP_FILE_SUFFIX)
+
+    def _get_refs_file(self, package):
+        return os.path.join(self._refs_path, package + ".json")
+
+    def _get_refcounts(self):
+        if self._refcounts is None:
+            self._refcounts = {}
+            if os.path.exists(self._refcounts_file):
+                with open(self._refcounts_file, "rb") as f:
+                    self._refcounts = json.load(f)
+        return self._refcounts
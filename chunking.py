@@ -0,0 +1,65 @@
+import os
+import json
+import hashlib
+
+from commons import CommonConsts, DepotFileNotFoundError
+
+'''
+Content-defined chunking of large files. A chunk ends where a gear hash of the bytes since it started,
+which only depends on the last 32 of them, has all the bits of a mask clear; chunks are at least
+CHUNK_MIN_SIZE and at most CHUNK_MAX_SIZE bytes. An insert or delete early in a file then only
+changes the chunks around the edit, and the chunks after it line up again with the previous version.
+
+The recipes of the chunked files of a package are kept in the depot in recipes/<package>.json, mapping the
+sha1 of each file to the list of its chunks: [[chunk sha1, size], ...]. The chunks are stored as blobs.
+'''
+_GEAR = [int(hashlib.sha1(str(i)).hexdigest()[:8], 16) for i in xrange(256)]
+_MASK = ((1 << CommonConsts.CHUNK_AVG_BITS) - 1) << (32 - CommonConsts.CHUNK_AVG_BITS)
+
+
+def _find_cut(data):
+    """Returns the length of the chunk starting data, which holds at least CHUNK_MAX_SIZE bytes unless it is the end of the file."""
+    size = min(len(data), CommonConsts.CHUNK_MAX_SIZE)
+    if size <= CommonConsts.CHUNK_MIN_SIZE:
+        return size
+    gear = _GEAR
+    mask = _MASK
+    h = 0
+    i = CommonConsts.CHUNK_MIN_SIZE
+    for b in bytearray(buffer(data, CommonConsts.CHUNK_MIN_SIZE, size - CommonConsts.CHUNK_MIN_SIZE)):
+        h = ((h << 1) + gear[b]) & 0xffffffff
+        i += 1
+        if not h & mask:
+            return i
+    return size
+
+def iter_chunks(f):
+    """Yields the content-defined chunks of the file object f."""
+    data = ""
+    eof = False
+    while True:
+        while not eof and len(data) < CommonConsts.CHUNK_MAX_SIZE:
+            block = f.read(CommonConsts.CHUNK_MAX_SIZE)
+            if not block:
+                eof = True
+            data += block
+        if not data:
+            return
+        cut = _find_cut(data)
+        yield data[:cut]
+        data = data[cut:]
+
+
+def get_recipes_path(manifest_filename):
+    return os.path.join(CommonConsts.SW_DEPOT_RECIPES_DIR, os.path.splitext(manifest_filename)[0] + ".json")
+
+def load_depot_recipes(transport, manifest_filename):
+    """Returns the recipes of the chunked files of a package, keyed by file sha1; empty if it has none."""
+    try:
+        data = transport.read(get_recipes_path(manifest_filename))
+    except DepotFileNotFoundError:
+        return {}
+    return json.loads(data)
+
+def get_recipe_size(recipe):
+    return sum(size for chunk, size in recipe)
@@ -1,5 +1,11 @@
 import os.path
 import stat
+import json
+import hashlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class CommonUtils:
 
@@ -7,16 +13,118 @@ class CommonUtils:
     def generate_manifest_filename(package_name, version, platform, file_ext):
         return CommonUtils.generate_package_name(package_name, version, platform) + "." + file_ext
 
+    @staticmethod
+    def get_manifest_filename_variants(manifest_filename):
+        """Names a manifest may have in either format, in the order they are looked up: binary first, then JSON."""
+        base = os.path.splitext(manifest_filename)[0]
+        return [base + "." + ext for ext in CommonConsts.MF_EXTS]
+
+    @staticmethod
+    def generate_snapshot_filename(manifest_filename):
+        return os.path.splitext(manifest_filename)[0] + "." + CommonConsts.INSTALL_SNAPSHOT_EXT
+
+    @staticmethod
+    def generate_packfile_name(manifest_filename):
+        return os.path.splitext(manifest_filename)[0] + "." + CommonConsts.PACKFILE_EXT
+
+    @staticmethod
+    def generate_journal_filename(manifest_filename):
+        return os.path.splitext(manifest_filename)[0] + "." + CommonConsts.INSTALL_JOURNAL_EXT
+
     @staticmethod
     def generate_package_name(package_name, version , platform):
         return package_name + "-" + version + "-" + platform
 
+    @staticmethod
+    def generate_blob_path(sha1):
+        """Path of a blob relative to the depot datafiles directory, sharded by the first two hex digits."""
+        return os.path.join(sha1[:2], sha1)
+
     # Based on # https://stomp.colorado.edu/blog/blog/2010/10/22/on-python-stat-octal-and-file-system-permissions/ (2012-06-25)
     @staticmethod
     def get_filepermission(path):
         """Returns the permission of a file."""
         return oct(stat.S_IMODE(os.stat(path).st_mode))
 
+    @staticmethod
+    def make_dirs(path, mode=0777):
+        """Creates path and its missing parents; a directory created concurrently by someone else is not an error."""
+        try:
+            os.makedirs(path, mode)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+    @staticmethod
+    def write_json_atomic(path, obj):
+        """Writes obj as JSON to a temporary file next to path and renames it over path."""
+        temp = path + CommonConsts.TEMP_FILE_SUFFIX
+        with open(temp, "wb") as f:
+            json.dump(obj, f)
+        os.rename(temp, path)
+
+    @staticmethod
+    def clone_or_copy(src, dest, digest=None):
+        """Places a copy of src at dest, sharing its data blocks by reflink where the filesystem supports it.
+        dest always gets an inode of its own, so changing its content or mode never changes src. digest, if given,
+        is updated with the content, read once whichever way it is copied."""
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if CommonUtils.reflink(src, dest):
+            if digest is not None:
+                with open(dest, "rb") as d:
+                    CommonUtils.copy_stream(d, None, digest)
+            return
+        with open(src, "rb") as s:
+            with open(dest, "wb") as d:
+                CommonUtils.copy_stream(s, d, digest)
+
+    @staticmethod
+    def reflink(src, dest):
+        """Clones src to dest sharing its data blocks, where the filesystem supports it. Returns False, leaving no dest, otherwise."""
+        if fcntl is None:
+            return False
+        with open(src, "rb") as s:
+            with open(dest, "wb") as d:
+                try:
+                    fcntl.ioctl(d.fileno(), CommonConsts.FICLONE, s.fileno())
+                    return True
+                except IOError:
+                    pass
+        os.remove(dest)
+        return False
+
+    @staticmethod
+    def copy_stream(src, dest, digest=None, chunk_size=None, length=None):
+        """Copies file object src to dest in fixed-size chunks, updating digest with every chunk.
+        Copies at most length bytes if given. Returns the number of bytes copied."""
+        chunk_size = chunk_size or CommonConsts.IO_CHUNK_SIZE
+        size = 0
+        while length is None or size < length:
+            chunk = src.read(chunk_size if length is None else min(chunk_size, length - size))
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            if dest is not None:
+                dest.write(chunk)
+            size += len(chunk)
+        return size
+
+    @staticmethod
+    def get_filehash(path, algo="sha1"):
+        """Returns the hex digest of a file, reading it in chunks."""
+        digest = hashlib.new(algo)
+        with open(path, "rb") as f:
+            CommonUtils.copy_stream(f, None, digest)
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_stat_snapshot(st):
+        """(size, mtime in nanoseconds) of an os.stat result, as a list so it compares equal after a JSON round trip.
+        st_mtime is a float, so the mtime is rounded to the microseconds it can represent exactly."""
+        return [st.st_size, int(round(st.st_mtime * 1000000)) * 1000]
+
     @staticmethod
     def get_filecount_for_dir_tree(dir_path):
         count = 0
@@ -28,6 +136,69 @@ class CommonConsts:
 
     SW_DEPOT_MANIFEST_FILE_DIR = "manifestfiles"
     SW_DEPOT_DATAFILES_DIR = "datafiles"
+    SW_DEPOT_REFS_DIR = "refs"
+    SW_DEPOT_REFCOUNTS_FILE = "refcounts.json"
+    SW_DEPOT_LOCK_FILE = "depot.lock"
+    SW_DEPOT_PACKS_DIR = "packs"
+    SW_DEPOT_RECIPES_DIR = "recipes"
+    SW_DEPOT_PACKAGES_DIR = "packages"
+    SW_DEPOT_INDEX_FILE = "index.sqlite"
+    TEMP_FILE_SUFFIX = ".v20tmp"
+    BACKUP_FILE_SUFFIX = ".v20bak"
+    INSTALL_ETC_PACKAGES_DIR = os.path.join("etc", "packages")
+    INSTALL_SNAPSHOT_EXT = "v20stat"
+    INSTALL_JOURNAL_EXT = "v20journal"
+    INSTALL_DB_FILE = "installed.sqlite"
+    JOURNAL_SYNC_INTERVAL = 64
+    HASH_CACHE_FILE_SUFFIX = ".v20hashcache"
+
+    DEFAULT_INSTALL_JOBS = 8
+    DEFAULT_DEPENDENCY_JOBS = 4
+    INSTALL_PIPELINE_QUEUE_SIZE = 64
+    IO_CHUNK_SIZE = 64 * 1024
+    FICLONE = 0x40049409 # Linux ioctl to reflink a file
+
+    DEFAULT_BLOB_CACHE_SIZE_MB = 10 * 1024
+    BLOB_CACHE_INDEX_FILE = "index.sqlite"
+    BLOB_CACHE_EVICT_RATIO = 0.9
+
+    DEFAULT_HTTP_CONNECTIONS = 8
+    DEFAULT_HTTP_TIMEOUT = 60
+    DEFAULT_HTTP_RETRIES = 3
+    DEFAULT_HTTP_BACKOFF = 0.5
+    DEFAULT_DEPOT_HTTP_PORT = 8020
+
+    DAEMON_SOCKET = os.path.join(os.path.expanduser("~"), ".voltron20", "daemon.sock")
+    DAEMON_SOCKET_ENV = "VOLTRON20_SOCKET"
+    DAEMON_HTTP_CACHE_TTL = 30 # seconds manifests and listings read from an HTTP depot are cached by the daemon
+
+    DEPOT_GC_MIN_AGE = 3600 # seconds a new unreferenced blob is kept, as its package may still be being added
+    DEPOT_SCRUB_BATCH = 256 # blobs scrubbed between checkpoints
+    DEPOT_SCRUB_CHECKPOINT_FILE = "scrub.checkpoint.json"
+
+    BLOB_COMPRESS_MIN_SIZE = 512
+    BLOB_COMPRESS_SAMPLE_SIZE = 256 * 1024
+    BLOB_COMPRESS_RATIO = 0.9 # keep a compressed blob only if it is at most this fraction of its size
+    BLOB_BZ2_MIN_SIZE = 1024 * 1024
+    BLOB_BZ2_GAIN = 0.85 # use bz2 if it compresses the sample to at most this fraction of the zlib output
+    BLOB_ZLIB_LEVEL = 6
+    BLOB_BZ2_LEVEL = 9
+
+    PACKFILE_EXT = "v20pack"
+    PACKFILE_ZLIB_LEVEL = 6
+    PACKFILE_COMPRESS_RATIO = 0.9 # keep a compressed blob only if it is at most this fraction of its size
+    PACKFILE_MIN_BLOBS = 8 # fewer missing blobs are fetched one by one
+    PACKFILE_SEQUENTIAL_RATIO = 0.5 # read the whole pack when at least this fraction of its data is needed
+    PACKFILE_MAX_GAP = 64 * 1024 # entries closer than this are fetched with one ranged read
+
+    CHUNK_MIN_FILE_SIZE = 1024 * 1024 # smaller files are stored and fetched whole
+    CHUNK_MIN_SIZE = 16 * 1024
+    CHUNK_AVG_BITS = 16 # chunks average about 2 ** CHUNK_AVG_BITS bytes past CHUNK_MIN_SIZE
+    CHUNK_MAX_SIZE = 256 * 1024
+
+    MF_EXT_JSON = "json"
+    MF_EXT_BINARY = "v20m"
+    MF_EXTS = (MF_EXT_BINARY, MF_EXT_JSON)
 
     '''
     Manifest file dictionary keys and attributes of keys
@@ -62,3 +233,9 @@ class CyclicDependencyError(Exception):
 
 class ResourceNotFoundError(Exception):
     pass
+
+class PackageInUseError(Exception):
+    pass
+
+class DepotFileNotFoundError(IOError):
+    pass
@@ -1,70 +1,126 @@
 import os.path
-import json
 import shutil
-import urllib2
-import urlparse
 import hashlib
+import cStringIO
+import time
+import threading
+import logging
 import logger
 
-from commons import CommonUtils, CommonConsts, ChecksumError, PermissionError, CyclicDependencyError
-
-DEP_STATUS_KEY_INSTALLED = "installed"
-DEP_STATUS_KEY_INQUEUE = "in-queue"
+from parallel import WorkerPool, Pipeline
+from manifestutils import ManifestFile, ManifestDiff
+from depresolver import PackageNode, DependencyResolver, DependencyScheduler
+from transport import get_transport
+from packfile import PackfileIndex, PackfileExtractor, get_pack_reads
+from blobcodec import BlobDecoder
+from journal import InstallJournal, JOURNAL_OP_WRITE, JOURNAL_OP_REMOVE, JOURNAL_OP_CHMOD, JOURNAL_OP_BACKUP
+from metrics import NULL_METRICS
+from installdb import open_install_database, get_file_record
+from chunking import load_depot_recipes
+
+from commons import CommonUtils, CommonConsts, ChecksumError, PermissionError, CyclicDependencyError, DepotFileNotFoundError, \
+    ResourceNotFoundError, PackageInUseError
+
+INSTALL_ENGINE_POOL = "pool"
+INSTALL_ENGINE_PIPELINE = "pipeline"
+INSTALL_ENGINES = (INSTALL_ENGINE_POOL, INSTALL_ENGINE_PIPELINE)
+
+
+def load_depot_manifest(transport, manifest_filename):
+    """Loads a manifest through a depot transport, preferring the binary variant of manifest_filename over the JSON one."""
+    error = None
+    for mfn in CommonUtils.get_manifest_filename_variants(manifest_filename):
+        try:
+            data = transport.read(os.path.join(CommonConsts.SW_DEPOT_MANIFEST_FILE_DIR, mfn))
+        except IOError as e:
+            error = e
+            continue
+        try:
+            return ManifestFile.loads(data)
+        except Exception as e:
+            error = e
+            break
+    raise ValueError("Error while retrieving manifest file: {0} from Software Depot.Error is {1}".format(manifest_filename, error))
 
 
 class PackageInstaller:
-    def __init__(self, name, version, platform, install_dir, depot_location, dep_status={DEP_STATUS_KEY_INSTALLED: [],
-                                                                                         DEP_STATUS_KEY_INQUEUE:[]}):
+    """Installs a package and its dependencies from the software depot, file by file, through an install journal."""
+    _pipelined_resolve = False
+
+    def __init__(self, name, version, platform, install_dir, depot_location, jobs=1, dep_jobs=1, manifest=None,
+                 resolve_dependencies=True, verify=False, blob_cache=None, transport=None, use_packs=True,
+                 metrics=None, depot_cache=None):
         self._log = logger.Logger.get_logger()
         self._name = name
         self._version = version
         self._platform = platform
         self._depot_location = depot_location
         self._install_dir = install_dir
-        self._dep_status = dep_status
+        self._jobs = jobs # files installed at a time
+        self._dep_jobs = dep_jobs # dependency packages installed at a time
+        self._manifest = manifest # passed in by the installer of a dependent package, with resolve_dependencies=False
+        self._resolve_dependencies = resolve_dependencies
+        self._verify = verify # re-hash files unchanged since the installed version too
+        self._blob_cache = blob_cache # a BlobCache blobs are taken from and fetched blobs are added to
+        # shared with the installers of the dependencies, so an HTTP depot is read over one pool of connections
+        self._transport = transport or get_transport(depot_location, max(jobs, 1) * max(dep_jobs, 1))
+        self._use_packs = use_packs # extract missing blobs from the packfile of the package where the depot has one
+        self._metrics = metrics or NULL_METRICS # a Metrics timing each phase per package, shared with the dependencies
+        self._depot_cache = depot_cache # a DepotCache of parsed manifests and graphs, kept by a long-running process
+        self._prefetched = {}
+        self._recipes = None
+        self._recipes_lock = threading.Lock()
         self._installation_success = False
         self._setup()
 
 
+    """Files are written to a temporary name and renamed into place, each change recorded in the journal in etc/packages.
+    An interrupted install resumes with the files the journal shows in place; one failing on an error a retry would hit
+    again (a bad checksum, permission or manifest, a missing depot file) is rolled back."""
     def install(self):
         try:
             self._log.info("Started installing package : {0}-{1} for OS : {2} ...".format(self._name, self._version, self._platform))
-            self._update_dep_status()
+            if self._committed:
+                self._log.info("Resuming install of package : {0}-{1} with {2} files already in place.".format(self._name, self._version, len(self._committed)))
+            self._check_conflicts()
             if self._is_already_installed:
                 self._install_update()
             else:
                 self._install_fresh()
             self._store_manifestfile()
+            self._store_snapshot()
+            self._complete_journal()
             self._installation_success = True
-            self._update_dep_status()
             self._log.info("Completed installing package : {0}-{1} for OS : {2} .".format(self._name, self._version, self._platform))
+        except (ChecksumError, PermissionError, CyclicDependencyError, DepotFileNotFoundError, ValueError):
+            self._rollback()
+            raise
         finally:
+            if self._blob_cache:
+                self._blob_cache.flush()
             self._cleanup()
 
-    def _update_dep_status(self):
-        if not  self._installation_success:
-            self._dep_status[DEP_STATUS_KEY_INQUEUE].append(self._manifest_filename)
-        else:
-            self._dep_status[DEP_STATUS_KEY_INQUEUE].remove(self._manifest_filename)
-            self._dep_status[DEP_STATUS_KEY_INSTALLED].append(self._manifest_filename)
-
     def _setup(self):
         try:
             self._manifest_filename = CommonUtils.generate_manifest_filename(self._name, self._version, self._platform, "json")
+            self._package = os.path.splitext(self._manifest_filename)[0]
 
-            self._depot_manifestfile_location = os.path.join(self._depot_location, CommonConsts.SW_DEPOT_MANIFEST_FILE_DIR)
-            self._depot_datafile_location = os.path.join(self._depot_location, CommonConsts.SW_DEPOT_DATAFILES_DIR,
-                                                         CommonUtils.generate_package_name(self._name, self._version, self._platform))
+            self._depot_manifestfile_location = CommonConsts.SW_DEPOT_MANIFEST_FILE_DIR
+            self._depot_datafile_location = CommonConsts.SW_DEPOT_DATAFILES_DIR
 
-
-            self._etc_dir = os.path.join(self._install_dir, "etc", "packages")
+            self._etc_dir = os.path.join(self._install_dir, CommonConsts.INSTALL_ETC_PACKAGES_DIR)
             if not os.path.exists(self._etc_dir):
                 os.makedirs(self._etc_dir)
             self._pkg_install_dir = self._install_dir
             self._is_already_installed = self._is_already_installed()
             self._temp_dir = os.path.join(self._pkg_install_dir, os.path.splitext(self._manifest_filename)[0] + "-INSTALL-TEMP")
-            os.mkdir(self._temp_dir)
-            self._manifest = self._get_manifest_object()
+            CommonUtils.make_dirs(self._temp_dir)
+            self._install_db = open_install_database(self._install_dir)
+            self._journal = InstallJournal(os.path.join(self._etc_dir, CommonUtils.generate_journal_filename(self._manifest_filename)))
+            self._committed = dict((r["path"], r) for r in self._journal.load() if r["op"] == JOURNAL_OP_WRITE)
+            if self._manifest is None:
+                with self._metrics.timer("manifest", self._package):
+                    self._manifest = self._get_manifest_object()
         except Exception as e:
             self._cleanup()
             self._log.error(e)
@@ -72,127 +128,446 @@ class PackageInstaller:
 
     def _cleanup(self):
         try:
+            if hasattr(self, "_journal"):
+                self._journal.close()
             if os.path.exists(self._temp_dir):
                 shutil.rmtree(self._temp_dir)
-            ''' TODO: clean up by tracking the installed files
-            if not self._is_already_installe    d and not self._installation_success:
-                if os.path.exists(self._pkg_install_dir):
-                    shutil.rmtree(self._pkg_install_dir)
-            '''
         except Exception as e:
             print "Error during cleanup - ", e
 
+    """Undoes the changes recorded in the journal, newest first, and removes the journal."""
+    def _rollback(self):
+        self._journal.close()
+        records = self._journal.load()
+        self._log.info("Rolling back {0} changes of package : {1}-{2} ...".format(len(records), self._name, self._version))
+        for r in reversed(records):
+            path = os.path.join(self._pkg_install_dir, r["path"])
+            if r["op"] == JOURNAL_OP_CHMOD:
+                if os.path.exists(path):
+                    os.chmod(path, r["old_mode"])
+            elif r["backup"] and os.path.lexists(path + CommonConsts.BACKUP_FILE_SUFFIX):
+                os.rename(path + CommonConsts.BACKUP_FILE_SUFFIX, path)
+            elif r["op"] == JOURNAL_OP_WRITE and os.path.lexists(path):
+                os.remove(path)
+        self._journal.remove()
+
+    """Removes the backups of the files the install replaced or removed, and the journal."""
+    def _complete_journal(self):
+        self._journal.close()
+        for r in self._journal.load():
+            backup = os.path.join(self._pkg_install_dir, r["path"]) + CommonConsts.BACKUP_FILE_SUFFIX
+            if r.get("backup") and os.path.lexists(backup):
+                os.remove(backup)
+        self._journal.remove()
+
     def  _is_already_installed(self):
-        if os.path.exists(os.path.join(self._etc_dir, self._manifest_filename)):
-            return True
+        for mfn in CommonUtils.get_manifest_filename_variants(self._manifest_filename):
+            if os.path.exists(os.path.join(self._etc_dir, mfn)):
+                return True
         return False
 
+    """Stores the manifest in etc/packages in the format it was published in, replacing one in the other format."""
     def _store_manifestfile(self):
-        mf_temp_file = self._get_local_temp_manifest_filepath()
-        shutil.copy(mf_temp_file, self._etc_dir)
+        self._stored_manifest_filename = os.path.splitext(self._manifest_filename)[0] + "." + ManifestFile.get_format(self._manifest)
+        ManifestFile.write_file(self._manifest, os.path.join(self._etc_dir, self._stored_manifest_filename))
+        for mfn in CommonUtils.get_manifest_filename_variants(self._manifest_filename):
+            if mfn != self._stored_manifest_filename and os.path.exists(os.path.join(self._etc_dir, mfn)):
+                os.remove(os.path.join(self._etc_dir, mfn))
+
+    """Records (size, mtime) of the installed files, which lets a quick verify skip hashing unchanged files,
+    and records them in the install database as owned by this package."""
+    def _store_snapshot(self):
+        snapshot = {}
+        records = []
+        for f in self._manifest.get(CommonConsts.MF_KEY_FILES, []):
+            path = f[CommonConsts.MF_KEY_FILES_ATTR_PATH]
+            snapshot[path] = CommonUtils.get_stat_snapshot(os.stat(os.path.join(self._pkg_install_dir, path)))
+            records.append(get_file_record(path, self._package, f, snapshot[path]))
+        CommonUtils.write_json_atomic(os.path.join(self._etc_dir, CommonUtils.generate_snapshot_filename(self._manifest_filename)), snapshot)
+        recipes = dict((r["sha1"], self._recipes[r["sha1"]]) for r in records if self._recipes and r["sha1"] in self._recipes)
+        self._install_db.put_package(self._package, self._stored_manifest_filename, list(self._manifest.get(CommonConsts.MF_KEY_DEPENDS, [])),
+                                     records, time.time(), recipes)
+
+    """Files owned by another installed package, as the install database records, are taken over with a warning."""
+    def _check_conflicts(self):
+        paths = [f[CommonConsts.MF_KEY_FILES_ATTR_PATH] for f in self._manifest.get(CommonConsts.MF_KEY_FILES, [])]
+        for r in self._install_db.conflicts(self._package, paths):
+            self._log.warning("File {0} of package : {1} is owned by installed package : {2} and will be taken over.".format(
+                r["path"], self._package, r["package"]))
 
     def _get_manifest_object(self):
-        try:
-            mf_path = self._get_local_manifest_file()
-            with open(mf_path, "rb") as f:
-                return json.load(f)
-        except Exception as e:
-            raise ValueError("Error while retrieving manifest file: {0} from Software Depot: {1}.Error is {2}".format(self._manifest_filename, self._depot_location, e))
+        if self._depot_cache:
+            return self._depot_cache.load_depot_manifest(self._transport, self._depot_location, self._manifest_filename)
+        error = None
+        for mfn in CommonUtils.get_manifest_filename_variants(self._manifest_filename):
+            try:
+                mf_path = self._get_local_manifest_file(mfn)
+            except IOError as e:
+                error = e
+                continue
+            try:
+                return ManifestFile.load_file(mf_path)
+            except Exception as e:
+                error = e
+                break
+        raise ValueError("Error while retrieving manifest file: {0} from Software Depot: {1}.Error is {2}".format(self._manifest_filename, self._depot_location, error))
 
     #TODO: Security (Authenticaton, etc) 
-    def _get_local_manifest_file(self):
-        manifest_depo_path = os.path.join(self._depot_manifestfile_location, self._manifest_filename)
-        manifest_temp_path = self._get_local_temp_manifest_filepath()
-        #urllib.urlretrieve(manifest_depo_path, manifest_temp_path)
+    def _get_local_manifest_file(self, manifest_filename):
+        manifest_depo_path = os.path.join(self._depot_manifestfile_location, manifest_filename)
+        manifest_temp_path = os.path.join(self._temp_dir, manifest_filename)
         self._retrieve_file(manifest_depo_path, manifest_temp_path)
         return manifest_temp_path
 
-
-    def _get_local_temp_manifest_filepath(self):
-        return os.path.join(self._temp_dir, self._manifest_filename)
-
     def _install_fresh(self):
         if CommonConsts.MF_KEY_DEPENDS in self._manifest:
             self._process_dependencies(self._manifest[CommonConsts.MF_KEY_DEPENDS])
         if CommonConsts.MF_KEY_DIRS in self._manifest:
             self._process_directories(self._manifest[CommonConsts.MF_KEY_DIRS])
         if CommonConsts.MF_KEY_FILES in self._manifest:
+            self._prefetch_blobs(self._manifest[CommonConsts.MF_KEY_FILES])
             self._process_files(self._manifest[CommonConsts.MF_KEY_FILES])
 
+    """Only touches the files that differ from the manifest stored in etc/packages, unless verify is set."""
     def _install_update(self):
-        print "Updating.."
-        if CommonConsts.MF_KEY_FILES in self._manifest:
-            self._process_files(self._manifest[CommonConsts.MF_KEY_FILES])
-
+        self._log.info("Updating installed package : {0}-{1} ...".format(self._name, self._version))
+        if CommonConsts.MF_KEY_DIRS in self._manifest:
+            self._process_directories(self._manifest[CommonConsts.MF_KEY_DIRS])
+        installed_manifest = self._get_installed_manifest()
+        if installed_manifest is None:
+            self._process_files(self._manifest.get(CommonConsts.MF_KEY_FILES, []))
+            return
+        diff = ManifestDiff(installed_manifest, self._manifest)
+        self._log.info("Package : {0}-{1} has {2} added, {3} changed, {4} mode changed, {5} removed and {6} unchanged files.".format(
+            self._name, self._version, len(diff.added), len(diff.changed), len(diff.mode_changed), len(diff.removed), len(diff.unchanged)))
+        self._remove_files(diff.removed)
+        self._prefetch_blobs(diff.added + diff.changed)
+        self._process_files(diff.added + diff.changed, self._install_file)
+        self._process_files(diff.mode_changed, self._update_mode)
+        if self._verify:
+            self._process_files(diff.unchanged)
+        else:
+            self._process_files([f for f in diff.unchanged if not os.path.exists(self._get_destination_file(f))], self._install_file)
+
+    def _get_installed_manifest(self):
+        for mfn in CommonUtils.get_manifest_filename_variants(self._manifest_filename):
+            path = os.path.join(self._etc_dir, mfn)
+            if os.path.exists(path):
+                try:
+                    if self._depot_cache:
+                        return self._depot_cache.load_manifest_file(path)
+                    return ManifestFile.load_file(path)
+                except Exception as e:
+                    self._log.warning("Ignoring unreadable installed manifest: {0}. Error is {1}".format(path, e))
+        return None
+
+    """Moves the files to their backup names, which are removed once the install completes."""
+    def _remove_files(self, files):
+        for f in files:
+            destfile = self._get_destination_file(f)
+            if os.path.lexists(destfile):
+                if self._log.isEnabledFor(logging.DEBUG):
+                    self._log.debug("Removing file: {0}".format(destfile))
+                backup = self._backup_file(destfile, f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+                if not backup:
+                    os.remove(destfile)
+                self._journal.record({"op": JOURNAL_OP_REMOVE, "path": f[CommonConsts.MF_KEY_FILES_ATTR_PATH], "backup": backup})
+
+    """Resolves the dependencies into a graph and installs dep_jobs of them at a time, each after its own dependencies."""
     def _process_dependencies(self, deps):
-        for dep in deps:
-            self._install_dependency(dep)
+        if not self._resolve_dependencies or not deps:
+            return
+        root = PackageNode(self._name, self._version, self._platform, self._manifest_filename, self._manifest)
+        resolver = DependencyResolver(self._load_manifest, self._dep_jobs, self._pipelined_resolve)
+        with self._metrics.timer("resolve", self._package):
+            if self._depot_cache:
+                graph = self._depot_cache.get_graph(self._transport, self._depot_location, self._manifest_filename,
+                                                    lambda: resolver.resolve(root))
+            else:
+                graph = resolver.resolve(root)
+        self._log.info("Resolved {0} dependencies of package : {1}-{2}.".format(len(graph) - 1, self._name, self._version))
+        DependencyScheduler(self._dep_jobs).run(graph, self._install_dependency, exclude=[self._manifest_filename])
+
+    def _load_manifest(self, manifest_filename):
+        with self._metrics.timer("manifest", os.path.splitext(manifest_filename)[0]):
+            if self._depot_cache:
+                return self._depot_cache.load_depot_manifest(self._transport, self._depot_location, manifest_filename)
+            return load_depot_manifest(self._transport, manifest_filename)
 
 
     def _process_directories(self, dirs):
         for d in dirs:
             p = os.path.join(self._pkg_install_dir, d[CommonConsts.MF_KEY_FILES_ATTR_PATH])
-            if not os.path.exists(p):
-                os.makedirs(p, 0755)
+            CommonUtils.make_dirs(p, 0755)
 
-    def _process_files(self, files):
-        for f in files:
-            destfile = os.path.join(self._pkg_install_dir, f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
-            if os.path.exists(destfile):
-                self._update_file(f)
-            else:
-                self._install_file(f)
-
-    def _install_dependency(self, dep):
-        mfn = dep[CommonConsts.MF_KEY_DEPENDS_ATTR_MANIFEST]
-        if not mfn:
-            mfn = CommonUtils.generate_manifest_filename(dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PACKAGE],
-                                                         dep[CommonConsts.MF_KEY_DEPENDS_ATTR_VERSION],
-                                                         dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PLATFORM],
-                                                         "json")
-        if mfn in self._dep_status[DEP_STATUS_KEY_INSTALLED]:
+    def _process_files(self, files, func=None):
+        if not files:
             return
-        elif mfn in self._dep_status[DEP_STATUS_KEY_INQUEUE]:
-            raise CyclicDependencyError("FATAL: Cyclic dependency found in manifest : {0} for {1} while installing package: {2}".format(self._manifest_filename,
-                                                                                                                                        mfn, self._name))
-        pi = PackageInstaller(dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PACKAGE],
-                                                         dep[CommonConsts.MF_KEY_DEPENDS_ATTR_VERSION],
-                                                         dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PLATFORM],
-                                                         self._install_dir, self._depot_location, self._dep_status)
+        start = time.time()
+        written = WorkerPool(self._jobs).map(func or self._process_file, files)
+        self._report_throughput(len(written), sum(written), time.time() - start)
+
+    def _process_file(self, f):
+        destfile = os.path.join(self._pkg_install_dir, f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        if self._is_committed(f, destfile):
+            self._metrics.count("files_resumed", package=self._package)
+            return 0
+        if os.path.exists(destfile):
+            return self._update_file(f)
+        return self._install_file(f)
+
+    def _report_throughput(self, file_count, byte_count, elapsed):
+        elapsed = max(elapsed, 0.000001)
+        self._log.info("Processed {0} files ({1} bytes) of package : {2}-{3} in {4:.2f}s ({5:.1f} files/s, {6:.2f} MB/s) using {7} jobs.".format(
+            file_count, byte_count, self._name, self._version, elapsed, file_count / elapsed, byte_count / elapsed / (1024 * 1024), self._jobs))
+
+    def _install_dependency(self, node):
+        pi = self.__class__(node.name, node.version, node.platform, self._install_dir, self._depot_location,
+                            jobs=self._jobs, manifest=node.manifest, resolve_dependencies=False, verify=self._verify,
+                            blob_cache=self._blob_cache, transport=self._transport, use_packs=self._use_packs,
+                            metrics=self._metrics, depot_cache=self._depot_cache)
         pi.install()
 
     def _update_file(self, f):
         try:
             self._verify_file(f)
-        except ChecksumError, PermissionError:
-            self._install_file(f)
+            return 0
+        except (ChecksumError, PermissionError):
+            return self._install_file(f)
 
+    def _update_mode(self, f):
+        destfile = self._get_destination_file(f)
+        if not os.path.exists(destfile):
+            return self._install_file(f)
+        with self._metrics.timer("chmod", self._package):
+            self._journal.record({"op": JOURNAL_OP_CHMOD, "path": f[CommonConsts.MF_KEY_FILES_ATTR_PATH], "old_mode": os.stat(destfile).st_mode & 07777})
+            os.chmod(destfile, int(f[CommonConsts.MF_KEY_FILES_ATTR_MODE], 8))
+        return 0
+
+    """Writes the file under a temporary name and renames it into place, backing up the file it replaces."""
     def _install_file(self, f):
-        srcfile = self._get_source_file(f)
+        staged = self._stage_file(f)
+        if staged is None:
+            return 0
+        return self._commit_file(staged)
+
+    """Writes the content of the file to its temporary name. Returns (f, temporary name, size), or None if it is committed."""
+    def _stage_file(self, f):
+        destfile = self._get_destination_file(f)
+        if self._is_committed(f, destfile):
+            self._metrics.count("files_resumed", package=self._package)
+            return None
+        tempfile = destfile + CommonConsts.TEMP_FILE_SUFFIX
+        try:
+            size = None
+            if self._blob_cache:
+                with self._metrics.timer("cache", self._package) as t:
+                    size = self._blob_cache.materialize(f[CommonConsts.MF_KEY_FILES_ATTR_SHA1], tempfile)
+                    t.bytes = size or 0
+                if size is not None:
+                    self._metrics.count("cache_hits", package=self._package)
+            if size is None:
+                size = self._fetch_file(f, tempfile)
+            with self._metrics.timer("chmod", self._package):
+                os.chmod(tempfile, int(f[CommonConsts.MF_KEY_FILES_ATTR_MODE], 8))
+        except Exception:
+            if os.path.lexists(tempfile):
+                os.remove(tempfile)
+            raise
+        return f, tempfile, size
+
+    """Renames a staged file into place, backing up the file it replaces, and records it in the journal."""
+    def _commit_file(self, staged):
+        f, tempfile, size = staged
         destfile = self._get_destination_file(f)
-        self._log.debug("Installing file... \n src: {0} \n dest: {1} ".format(srcfile, destfile))
-        #urllib.urlretrieve(srcfile, destfile) 
-        self._retrieve_file(srcfile, destfile) # TODO: need to optimize here (use pycurl)
-        self._log.debug("File retrieved from depot: {0}".format(srcfile))
-        os.chmod(destfile, int(f[CommonConsts.MF_KEY_FILES_ATTR_MODE], 8))
-        if not self._verify_file(f):
-            os._exit(os.EX_DATAERR)
+        with self._metrics.timer("commit", self._package):
+            backup = os.path.lexists(destfile) and self._backup_file(destfile, f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+            os.rename(tempfile, destfile)
+            self._journal.record({"op": JOURNAL_OP_WRITE, "path": f[CommonConsts.MF_KEY_FILES_ATTR_PATH], "backup": backup,
+                                  "sha1": f[CommonConsts.MF_KEY_FILES_ATTR_SHA1], "stat": CommonUtils.get_stat_snapshot(os.stat(destfile))})
+        self._metrics.count("files_installed", package=self._package)
+        return size
+
+    """Renames path to its backup name unless an earlier, interrupted install already did. Returns whether it did.
+    The backup is journaled and synced before the rename, so a crash can not leave a backup the journal does not show."""
+    def _backup_file(self, path, rel_path):
+        backup = path + CommonConsts.BACKUP_FILE_SUFFIX
+        if os.path.lexists(backup):
+            return False
+        self._journal.record({"op": JOURNAL_OP_BACKUP, "path": rel_path, "backup": True}, sync=True)
+        os.rename(path, backup)
+        return True
 
+    """A file is committed if the journal of an interrupted install shows it written with this content and unchanged since."""
+    def _is_committed(self, f, destfile):
+        r = self._committed.get(f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        if r is None or r["sha1"] != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
+            return False
+        try:
+            return CommonUtils.get_stat_snapshot(os.stat(destfile)) == r["stat"]
+        except OSError:
+            return False
+
+    def _fetch_file(self, f, destfile):
+        sha1 = f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+        size = self._take_prefetched_blob(sha1, destfile)
+        recipe = self._get_recipes().get(sha1) if size is None else None
+        if recipe:
+            size, sha1 = self._assemble_file(recipe, destfile)
+            if sha1 != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
+                raise ChecksumError("FATAL: SHA1 doesn't match for installed file: {0}".format(destfile))
+        elif size is None:
+            srcfile = self._get_source_file(f)
+            if self._log.isEnabledFor(logging.DEBUG):
+                self._log.debug("Installing file... \n src: {0} \n dest: {1} ".format(srcfile, destfile))
+            with self._metrics.timer("fetch", self._package) as t:
+                size, sha1 = self._retrieve_file(srcfile, destfile)
+                t.bytes = size
+            if sha1 != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
+                raise ChecksumError("FATAL: SHA1 doesn't match for installed file: {0}".format(destfile))
+        if self._blob_cache:
+            with self._metrics.timer("cache", self._package):
+                self._blob_cache.add(sha1, destfile)
+        return size
+
+    """Returns the recipes of the files of the package the depot stores as chunks, loading them on first use."""
+    def _get_recipes(self):
+        with self._recipes_lock:
+            if self._recipes is None:
+                with self._metrics.timer("manifest", self._package):
+                    self._recipes = load_depot_recipes(self._transport, self._manifest_filename)
+        return self._recipes
+
+    """Writes the file of the chunk list recipe to destfile, copying the chunks installed files hold and fetching the others.
+    Each chunk is checked against its sha1. Returns (size, sha1) of the content."""
+    def _assemble_file(self, recipe, destfile):
+        located = self._install_db.locate_chunks(set(chunk for chunk, size in recipe))
+        digest = hashlib.new("sha1")
+        total = 0
+        with open(destfile, "wb") as out:
+            for chunk, size in recipe:
+                with self._metrics.timer("reuse", self._package) as t:
+                    data = self._read_local_chunk(located.get(chunk), chunk, size)
+                    t.bytes = len(data) if data is not None else 0
+                if data is None:
+                    with self._metrics.timer("fetch", self._package) as t:
+                        data, t.bytes = self._fetch_chunk(chunk)
+                    self._metrics.count("chunks_fetched", package=self._package)
+                else:
+                    self._metrics.count("chunks_reused", package=self._package)
+                out.write(data)
+                digest.update(data)
+                total += len(data)
+        return total, digest.hexdigest()
+
+    """Reads a chunk from the installed file and offset location, or returns None if that file no longer holds it."""
+    def _read_local_chunk(self, location, chunk, size):
+        if location is None:
+            return None
+        try:
+            with open(os.path.join(self._install_dir, location[0]), "rb") as f:
+                f.seek(location[1])
+                data = f.read(size)
+        except (IOError, OSError):
+            return None
+        if len(data) != size or hashlib.sha1(data).hexdigest() != chunk:
+            return None
+        return data
+
+    """Fetches a chunk blob from the depot. Returns its content and the number of bytes transferred."""
+    def _fetch_chunk(self, chunk):
+        buf = cStringIO.StringIO()
+        decoder = BlobDecoder(buf)
+        transferred = self._transport.fetch(os.path.join(self._depot_datafile_location, CommonUtils.generate_blob_path(chunk)), decoder)[0]
+        decoder.close()
+        if decoder.hexdigest() != chunk:
+            raise ChecksumError("FATAL: SHA1 doesn't match for depot chunk: {0}".format(chunk))
+        return buf.getvalue(), transferred
+
+    """Extracts the blobs of files that are not in the blob cache from the packfile of the package into the temp dir.
+    Failing to read the packfile is not an error: the blobs it did not provide are fetched one by one."""
+    def _prefetch_blobs(self, files):
+        if not self._use_packs:
+            return
+        recipes = self._get_recipes() if files else {}
+        refs = {}
+        for f in files:
+            sha1 = f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+            if sha1 in recipes or self._blob_cache and os.path.exists(self._blob_cache.blob_path(sha1)):
+                continue
+            refs[sha1] = refs.get(sha1, 0) + 1
+        if len(refs) < CommonConsts.PACKFILE_MIN_BLOBS:
+            return
+        pack = os.path.join(CommonConsts.SW_DEPOT_PACKS_DIR, CommonUtils.generate_packfile_name(self._manifest_filename))
+        try:
+            index = PackfileIndex.read(self._transport, pack)
+        except DepotFileNotFoundError:
+            return
+        except (IOError, ValueError) as e:
+            self._log.warning("Ignoring unreadable packfile: {0}. Error is {1}".format(pack, e))
+            return
+        entries = sorted((index.get(sha1) for sha1 in refs if sha1 in index), key=lambda e: e.offset)
+        if not entries:
+            return
+        blob_dir = os.path.join(self._temp_dir, "blobs")
+        CommonUtils.make_dirs(blob_dir)
+        dest_func = lambda sha1: os.path.join(blob_dir, sha1)
+        ranges = get_pack_reads(index, entries)
+        start = time.time()
+
+        def fetch_range(r):
+            extractor = PackfileExtractor(r[0], r[1], dest_func)
+            with self._metrics.timer("pack", self._package) as t:
+                try:
+                    t.bytes = self._transport.fetch(pack, extractor, r[1], r[2])[0]
+                    extractor.close()
+                except (IOError, ValueError, ChecksumError) as e:
+                    self._log.warning("Could not extract blobs from packfile: {0}. Error is {1}".format(pack, e))
+            return extractor.extracted
+
+        extracted = [sha1 for sha1s in WorkerPool(self._jobs).map(fetch_range, ranges) for sha1 in sha1s]
+        self._metrics.count("pack_blobs", len(extracted), self._package)
+        for sha1 in extracted:
+            self._prefetched[sha1] = {"path": dest_func(sha1), "refs": refs[sha1], "lock": threading.Lock()}
+        self._log.info("Extracted {0} of {1} blobs from packfile : {2} with {3} reads in {4:.2f}s.".format(
+            len(extracted), len(refs), pack, len(ranges), time.time() - start))
+
+    """Moves the prefetched blob sha1 to destfile, or copies it if more files still need it. Returns the size, or None."""
+    def _take_prefetched_blob(self, sha1, destfile):
+        blob = self._prefetched.get(sha1)
+        if blob is None:
+            return None
+        with blob["lock"]:
+            if blob["refs"] <= 0:
+                return None
+            blob["refs"] -= 1
+            if os.path.lexists(destfile):
+                os.remove(destfile)
+            if blob["refs"]:
+                shutil.copyfile(blob["path"], destfile)
+            else:
+                os.rename(blob["path"], destfile)
+        return os.path.getsize(destfile)
+
+    """Streams the depot file srcfile to destfile through the transport, decompressing a compressed blob and hashing
+    the content as it is written. Returns (size, sha1) of the content."""
     def _retrieve_file(self, srcfile, destfile):
-        if not urlparse.urlparse(srcfile).scheme:
-            srcfile = "file:" + srcfile
-        response = urllib2.urlopen(srcfile)
-        content = response.read()
-        with open(destfile, "w") as f:
-            f.write(content)
+        if os.path.lexists(destfile):
+            os.remove(destfile)
+        with open(destfile, "wb") as f:
+            decoder = BlobDecoder(f)
+            self._transport.fetch(srcfile, decoder)
+            decoder.close()
+        return decoder.size, decoder.hexdigest()
 
 
     """Check the sha1 of and installed file and verifies its permission"""
     def _verify_file(self, f):
         fullpath = self._get_destination_file(f)
-        digest = hashlib.new("sha1")
-        digest.update(open(fullpath, "rb").read())
-        if digest.hexdigest() != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
+        with self._metrics.timer("verify", self._package) as t:
+            sha1 = CommonUtils.get_filehash(fullpath)
+            t.bytes = os.path.getsize(fullpath)
+        if sha1 != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
             raise ChecksumError("FATAL: SHA1 doesn't match for installed file: {0}".format(fullpath))
         mode = CommonUtils.get_filepermission(fullpath)
         if mode != f[CommonConsts.MF_KEY_FILES_ATTR_MODE]:
@@ -201,13 +576,117 @@ class PackageInstaller:
 
 
     def _get_source_file(self, f):
-        return os.path.join(self._depot_datafile_location, f[CommonConsts.MF_KEY_FILES_ATTR_SHA1])
+        return os.path.join(self._depot_datafile_location, CommonUtils.generate_blob_path(f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]))
 
     def _get_destination_file(self, f):
         return os.path.join(self._pkg_install_dir, f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
 
 
+class PipelinedPackageInstaller(PackageInstaller):
+    """Installs a package like PackageInstaller, but moves its files through a pipeline of stages instead of giving
+    each of jobs workers a file from start to end: jobs workers verify installed files, jobs workers fetch content
+    to temporary files, and one worker renames them into place and journals them. The queues between the stages
+    are bounded, so fetched files never pile up ahead of the commit, and the first error stops every stage.
+    The manifests of the dependencies are loaded as soon as a loaded manifest names them, and the dependencies
+    are installed with this engine as well.
+    """
+    _pipelined_resolve = True
+
+    def _process_files(self, files, func=None):
+        if func not in (None, self._install_file):
+            return PackageInstaller._process_files(self, files, func)
+        if not files:
+            return
+        stages = [(self._stage_file, self._jobs), (self._commit_file, 1)]
+        if func is None:
+            stages.insert(0, (self._check_file, self._jobs))
+        start = time.time()
+        try:
+            written = Pipeline(stages, CommonConsts.INSTALL_PIPELINE_QUEUE_SIZE).run(files)
+        except Exception:
+            self._remove_staged_files(files)
+            raise
+        self._report_throughput(len(files), sum(written), time.time() - start)
+
+    """Passes on the files that are neither committed nor installed with the right content and mode."""
+    def _check_file(self, f):
+        destfile = self._get_destination_file(f)
+        if self._is_committed(f, destfile):
+            self._metrics.count("files_resumed", package=self._package)
+            return None
+        if os.path.exists(destfile):
+            try:
+                self._verify_file(f)
+                return None
+            except (ChecksumError, PermissionError):
+                pass
+        return f
+
+    """Removes the temporary files of files staged by a cancelled pipeline and never committed."""
+    def _remove_staged_files(self, files):
+        for f in files:
+            tempfile = self._get_destination_file(f) + CommonConsts.TEMP_FILE_SUFFIX
+            if os.path.lexists(tempfile):
+                os.remove(tempfile)
 
 
+class PackageUninstaller:
+    """Removes an installed package: the files the install database records it as owning, the directories
+    left empty by them, and its manifest, snapshot and journal in etc/packages. Files another package took
+    over are left in place. A package other installed packages depend on is only removed with force=True.
+    """
 
-
+    def __init__(self, name, version, platform, install_dir, force=False):
+        self._log = logger.Logger.get_logger()
+        self._name = name
+        self._version = version
+        self._platform = platform
+        self._install_dir = install_dir
+        self._force = force
+        self._manifest_filename = CommonUtils.generate_manifest_filename(name, version, platform, "json")
+        self._package = os.path.splitext(self._manifest_filename)[0]
+        self._etc_dir = os.path.join(install_dir, CommonConsts.INSTALL_ETC_PACKAGES_DIR)
+
+    def uninstall(self):
+        install_db = open_install_database(self._install_dir)
+        if install_db.get_package(self._package) is None:
+            raise ResourceNotFoundError("Package is not installed. Package : {0}, install directory : {1}".format(self._package, self._install_dir))
+        dependents = install_db.dependents(self._package)
+        if dependents and not self._force:
+            raise PackageInUseError("Package : {0} is a dependency of installed packages : {1}".format(self._package, ", ".join(dependents)))
+        self._log.info("Started uninstalling package : {0}-{1} for OS : {2} ...".format(self._name, self._version, self._platform))
+        files = install_db.files(self._package)
+        for r in files:
+            path = os.path.join(self._install_dir, r["path"])
+            if os.path.lexists(path):
+                os.remove(path)
+        self._remove_empty_dirs(files)
+        for filename in CommonUtils.get_manifest_filename_variants(self._manifest_filename) + \
+                [CommonUtils.generate_snapshot_filename(self._manifest_filename), CommonUtils.generate_journal_filename(self._manifest_filename)]:
+            if os.path.exists(os.path.join(self._etc_dir, filename)):
+                os.remove(os.path.join(self._etc_dir, filename))
+        install_db.remove_package(self._package)
+        self._log.info("Completed uninstalling package : {0}-{1} for OS : {2} with {3} files removed.".format(
+            self._name, self._version, self._platform, len(files)))
+        return len(files)
+
+    """Removes the directories of the removed files that are left empty, deepest first, up to the install root."""
+    def _remove_empty_dirs(self, files):
+        dirs = set()
+        for r in files:
+            d = os.path.dirname(r["path"])
+            while d:
+                dirs.add(d)
+                d = os.path.dirname(d)
+        for d in sorted(dirs, key=lambda d: -d.count(os.sep)):
+            path = os.path.join(self._install_dir, d)
+            if os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+
+
+def get_installer_class(engine):
+    if engine == INSTALL_ENGINE_POOL:
+        return PackageInstaller
+    if engine == INSTALL_ENGINE_PIPELINE:
+        return PipelinedPackageInstaller
+    raise ValueError("Not supported install engine: {0}".format(engine))
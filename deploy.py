@@ -9,22 +9,23 @@
 
 import sys
 import os
-import hashlib
 import shutil
 
-def gen_depot(stage_dir, depot_dir):
+from hashutils import ParallelHasher
+
+def gen_depot(stage_dir, depot_dir, jobs=None):
     """Put files from staging directory into the depot"""
 
+    fullpaths = []
     for root, dirs, files in os.walk(stage_dir):
         for file_ in files:
-            fullpath = os.path.join(root, file_)
-            contents = open(fullpath, 'rb').read()
-            sha1 = hashlib.sha1(contents).hexdigest()
-            dest_file = os.path.join(depot_dir, sha1)
-            # NOTE vmx 2012-06-25: Currently we just overwrite the file if it
-            #     already exists
-            shutil.copy(fullpath, dest_file)
-            print "Copied ", fullpath, "to", dest_file
+            fullpaths.append(os.path.join(root, file_))
+    for fullpath, sha1 in zip(fullpaths, ParallelHasher(jobs).hash_files(fullpaths)):
+        dest_file = os.path.join(depot_dir, sha1)
+        # NOTE vmx 2012-06-25: Currently we just overwrite the file if it
+        #     already exists
+        shutil.copy(fullpath, dest_file)
+        print "Copied ", fullpath, "to", dest_file
 
 def main(argv=None):
     if argv is None:
@@ -0,0 +1,110 @@
+import os
+import time
+import threading
+
+from commons import CommonUtils, CommonConsts
+from manifestutils import ManifestFile
+
+CACHE_KIND_MANIFEST = "manifest"
+CACHE_KIND_GRAPH = "graph"
+CACHE_KIND_LISTING = "listing"
+CACHE_KINDS = (CACHE_KIND_MANIFEST, CACHE_KIND_GRAPH, CACHE_KIND_LISTING)
+
+
+class DepotCache:
+    """In-memory cache of parsed manifests, resolved dependency graphs and depot listings, for a long-running process.
+
+    Every entry is checked before it is used. Entries read from local files are valid while the stat of those
+    files (size and mtime) is unchanged, so a package published by another process is seen at once; entries read
+    from an HTTP depot are trusted for ttl seconds. A dependency graph is valid while the manifests of all its
+    packages are. Cached manifests and graphs are shared between callers and must not be modified.
+    """
+
+    def __init__(self, ttl=CommonConsts.DAEMON_HTTP_CACHE_TTL):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._hits = dict((kind, 0) for kind in CACHE_KINDS)
+        self._misses = dict((kind, 0) for kind in CACHE_KINDS)
+
+    def load_depot_manifest(self, transport, depot_location, manifest_filename):
+        """Returns the depot manifest manifest_filename in either format, as load_depot_manifest would."""
+        from depinstall import load_depot_manifest
+        key = (CACHE_KIND_MANIFEST, depot_location, manifest_filename)
+        stamp = self._get_depot_stamp(transport, manifest_filename)
+        return self._get(key, stamp, lambda: load_depot_manifest(transport, manifest_filename))
+
+    def load_manifest_file(self, path):
+        """Returns the manifest at path, as ManifestFile.load_file would but never mapped, as the file may be rewritten."""
+        key = (CACHE_KIND_MANIFEST, None, path)
+        return self._get(key, self._get_file_stamp(path), lambda: ManifestFile.loads(self._read(path)))
+
+    def get_graph(self, transport, depot_location, manifest_filename, resolve):
+        """Returns the dependency graph of the depot package manifest_filename, calling resolve() to build it if needed."""
+        key = (CACHE_KIND_GRAPH, depot_location, manifest_filename)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry["stamp"] == self._get_graph_stamp(transport, entry["value"]) and self._is_fresh(entry):
+            self._count(CACHE_KIND_GRAPH, True)
+            return entry["value"]
+        self._count(CACHE_KIND_GRAPH, False)
+        graph = resolve()
+        self._put(key, self._get_graph_stamp(transport, graph), graph)
+        return graph
+
+    def get_listing(self, index_file, query, load):
+        """Returns the result of load(), a list of depot index records, cached for query while index_file is unchanged."""
+        key = (CACHE_KIND_LISTING, index_file, query)
+        records = self._get(key, self._get_file_stamp(index_file), load)
+        return [dict(r) for r in records]
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": dict(self._hits), "misses": dict(self._misses)}
+
+    def _get(self, key, stamp, load):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry["stamp"] == stamp and self._is_fresh(entry):
+            self._count(key[0], True)
+            return entry["value"]
+        self._count(key[0], False)
+        value = load()
+        self._put(key, stamp, value)
+        return value
+
+    def _put(self, key, stamp, value):
+        with self._lock:
+            self._entries[key] = {"stamp": stamp, "value": value, "loaded": time.time()}
+
+    def _count(self, kind, hit):
+        with self._lock:
+            counts = self._hits if hit else self._misses
+            counts[kind] += 1
+
+    def _is_fresh(self, entry):
+        return entry["stamp"] is not None or time.time() - entry["loaded"] < self._ttl
+
+    """Stamp of a depot manifest: the stat of each of its variants in a local depot, None in a remote one."""
+    def _get_depot_stamp(self, transport, manifest_filename):
+        local_path = getattr(transport, "local_path", None)
+        if local_path is None:
+            return None
+        return tuple(self._get_file_stamp(local_path(os.path.join(CommonConsts.SW_DEPOT_MANIFEST_FILE_DIR, mfn)))
+                     for mfn in CommonUtils.get_manifest_filename_variants(manifest_filename))
+
+    def _get_graph_stamp(self, transport, graph):
+        stamps = tuple((mfn, self._get_depot_stamp(transport, mfn)) for mfn in sorted(graph.packages()))
+        if any(stamp is None for mfn, stamp in stamps):
+            return None
+        return stamps
+
+    def _get_file_stamp(self, path):
+        try:
+            return CommonUtils.get_stat_snapshot(os.stat(path))
+        except OSError:
+            return ()
+
+    def _read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
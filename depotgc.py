@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import logger
+
+from commons import CommonUtils, CommonConsts
+from parallel import WorkerPool
+from manifestutils import ManifestFile
+from blobstore import BlobStore
+from blobcodec import BlobReader
+from chunking import get_recipes_path
+
+BLOB_STATUS_OK = "ok"
+BLOB_STATUS_CORRUPT = "corrupt"
+BLOB_STATUS_UNREADABLE = "unreadable"
+
+
+def get_depot_blobs(depot_location):
+    """Returns (sha1, path) of every blob stored in the depot, ordered by sha1, skipping temporary files."""
+    df_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_DATAFILES_DIR)
+    blobs = []
+    if not os.path.isdir(df_path):
+        return blobs
+    for shard in sorted(os.listdir(df_path)):
+        shard_path = os.path.join(df_path, shard)
+        if not os.path.isdir(shard_path):
+            continue
+        for name in sorted(os.listdir(shard_path)):
+            if not name.endswith(CommonConsts.TEMP_FILE_SUFFIX):
+                blobs.append((name, os.path.join(shard_path, name)))
+    return blobs
+
+
+class DepotCollector:
+    """Removes what the manifests of a software depot no longer reach.
+
+    The reachable blobs are the sha1s of the files of every published manifest, or the chunks of those
+    stored as chunks; collect refuses to run if a manifest cannot be read, since its blobs would look
+    unreferenced. Blobs, temporary files, packfiles, recipes and package records nothing reaches are removed, along
+    with shard directories left empty, and the package references and refcounts of the blob store are
+    rewritten from the manifests, which repairs the drift left by overwritten manifests and failed adds. Blobs, temporary
+    files, packfiles, recipes and package records modified less than min_age seconds ago are kept, as they may belong to a package being
+    added right now.
+    """
+
+    def __init__(self, depot_location, min_age=CommonConsts.DEPOT_GC_MIN_AGE):
+        self._log = logger.Logger.get_logger()
+        self._location = depot_location
+        self._min_age = min_age
+        self._df_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_DATAFILES_DIR)
+        self._mf_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_MANIFEST_FILE_DIR)
+        self._packs_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_PACKS_DIR)
+        self._refs_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_REFS_DIR)
+        self._recipes_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_RECIPES_DIR)
+        self._packages_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_PACKAGES_DIR)
+
+    def collect(self, dry_run=False):
+        """Returns the report as a dictionary; with dry_run=True it only reports what would be removed.
+        The references of the depot are locked meanwhile, so no publish updates them under the collector."""
+        with BlobStore(self._location).lock_refs():
+            return self._collect(dry_run)
+
+    def _collect(self, dry_run):
+        refs = self._get_reachable_refs()
+        reachable = set()
+        for sha1s in refs.values():
+            reachable.update(sha1s)
+        cutoff = time.time() - self._min_age
+        report = {"depot": self._location, "dry_run": dry_run, "packages": len(refs), "reachable_blobs": len(reachable),
+                  "removed_blobs": [], "removed_temp_files": [], "removed_packs": [], "removed_recipes": [], "removed_package_records": [],
+                  "missing_blobs": [], "bytes_freed": 0}
+        stored = set()
+        for sha1, path in get_depot_blobs(self._location):
+            stored.add(sha1)
+            if sha1 not in reachable and os.path.getmtime(path) < cutoff:
+                report["removed_blobs"].append(sha1)
+                report["bytes_freed"] += self._remove(path, dry_run)
+        for path in self._get_temp_files():
+            if os.path.getmtime(path) < cutoff:
+                report["removed_temp_files"].append(os.path.relpath(path, self._location))
+                report["bytes_freed"] += self._remove(path, dry_run)
+        # refs are keyed by manifest names without extension, whose versions may hold dots themselves
+        packs = set(package + "." + CommonConsts.PACKFILE_EXT for package in refs)
+        for name, path in self._list_files(self._packs_path, cutoff):
+            if name not in packs:
+                report["removed_packs"].append(name)
+                report["bytes_freed"] += self._remove(path, dry_run)
+        for name, path in self._list_files(self._recipes_path, cutoff):
+            if name.endswith(".json") and os.path.splitext(name)[0] not in refs:
+                report["removed_recipes"].append(name)
+                report["bytes_freed"] += self._remove(path, dry_run)
+        for name, path in self._list_files(self._packages_path, cutoff):
+            if name.endswith(".json") and os.path.splitext(name)[0] not in refs:
+                report["removed_package_records"].append(name)
+                report["bytes_freed"] += self._remove(path, dry_run)
+        report["missing_blobs"] = sorted(reachable - stored)
+        if not dry_run:
+            self._remove_empty_shards()
+            self._rewrite_refs(refs)
+        self._log.info("Collected depot {0}: {1} unreferenced blobs, {2} temporary files and {3} packfiles, {4} bytes{5}.".format(
+            self._location, len(report["removed_blobs"]), len(report["removed_temp_files"]), len(report["removed_packs"]),
+            report["bytes_freed"], " (dry run)" if dry_run else ""))
+        if report["missing_blobs"]:
+            self._log.warning("Depot {0} is missing {1} blobs referenced by its manifests.".format(self._location, len(report["missing_blobs"])))
+        return report
+
+    """Returns the blobs referenced by each published package, keyed by package name, from both manifest formats:
+    the sha1s of its files and the chunks of its chunked files."""
+    def _get_reachable_refs(self):
+        refs = {}
+        if not os.path.isdir(self._mf_path):
+            return refs
+        for mfn in sorted(os.listdir(self._mf_path)):
+            base, ext = os.path.splitext(mfn)
+            if ext[1:] not in CommonConsts.MF_EXTS:
+                continue
+            try:
+                manifest = ManifestFile.load_file(os.path.join(self._mf_path, mfn))
+            except Exception as e:
+                raise ValueError("Cannot collect depot {0}, manifest file: {1} is unreadable. Error is {2}".format(self._location, mfn, e))
+            recipes = self._load_recipes(mfn)
+            sha1s = refs.setdefault(base, set())
+            for f in manifest.get(CommonConsts.MF_KEY_FILES, []):
+                sha1 = f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+                if sha1 in recipes:
+                    sha1s.update(chunk for chunk, size in recipes[sha1])
+                else:
+                    sha1s.add(sha1)
+        return refs
+
+    def _load_recipes(self, manifest_filename):
+        path = os.path.join(self._location, get_recipes_path(manifest_filename))
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "rb") as f:
+                return json.load(f)
+        except ValueError as e:
+            raise ValueError("Cannot collect depot {0}, recipes file: {1} is unreadable. Error is {2}".format(self._location, path, e))
+
+    def _get_temp_files(self):
+        temp_files = []
+        for top in (self._df_path, self._packs_path, self._refs_path, self._recipes_path, self._packages_path, self._mf_path):
+            for dirpath, dirnames, filenames in os.walk(top):
+                temp_files.extend(os.path.join(dirpath, name) for name in sorted(filenames) if name.endswith(CommonConsts.TEMP_FILE_SUFFIX))
+        return temp_files
+
+    """Returns (name, path) of the files in directory modified before cutoff, skipping temporary files."""
+    def _list_files(self, directory, cutoff):
+        if not os.path.isdir(directory):
+            return []
+        files = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not name.endswith(CommonConsts.TEMP_FILE_SUFFIX) and os.path.getmtime(path) < cutoff:
+                files.append((name, path))
+        return files
+
+    def _remove(self, path, dry_run):
+        size = os.path.getsize(path)
+        if not dry_run:
+            os.remove(path)
+        return size
+
+    def _remove_empty_shards(self):
+        if not os.path.isdir(self._df_path):
+            return
+        for shard in os.listdir(self._df_path):
+            path = os.path.join(self._df_path, shard)
+            if os.path.isdir(path) and not os.listdir(path):
+                os.rmdir(path)
+
+    def _rewrite_refs(self, refs):
+        if os.path.isdir(self._refs_path):
+            for name in os.listdir(self._refs_path):
+                if name.endswith(".json") and os.path.splitext(name)[0] not in refs:
+                    os.remove(os.path.join(self._refs_path, name))
+        refcounts = {}
+        for package, sha1s in refs.items():
+            for sha1 in sha1s:
+                refcounts[sha1] = refcounts.get(sha1, 0) + 1
+            if sha1s:
+                CommonUtils.make_dirs(self._refs_path)
+                CommonUtils.write_json_atomic(os.path.join(self._refs_path, package + ".json"), sorted(sha1s))
+            elif os.path.exists(os.path.join(self._refs_path, package + ".json")):
+                os.remove(os.path.join(self._refs_path, package + ".json"))
+        CommonUtils.write_json_atomic(os.path.join(self._location, CommonConsts.SW_DEPOT_REFCOUNTS_FILE), refcounts)
+
+    @staticmethod
+    def format_report(report):
+        lines = ["{0}: {1} packages, {2} reachable blobs{3}".format(report["depot"], report["packages"], report["reachable_blobs"],
+                                                                  " (dry run)" if report["dry_run"] else "")]
+        for key, label in (("removed_blobs", "blob"), ("removed_temp_files", "temporary file"), ("removed_packs", "packfile"),
+                           ("removed_recipes", "recipes"), ("removed_package_records", "package record")):
+            for name in report[key]:
+                lines.append("    removed {0}: {1}".format(label, name))
+        for sha1 in report["missing_blobs"]:
+            lines.append("    missing blob: {0}".format(sha1))
+        lines.append("{0} bytes freed.".format(report["bytes_freed"]))
+        return "\n".join(lines)
+
+
+class DepotScrubber:
+    """Re-hashes the blobs of a software depot and reports those whose content no longer matches their sha1.
+
+    Blobs are read by jobs workers in sha1 order, decompressed, and together read at most io_budget bytes
+    a second from disk if it is given. Progress is written to a checkpoint file after every batch of blobs, so an
+    interrupted scrub of a large depot resumes after the last completed batch; the checkpoint is removed
+    when the scrub completes. Corrupt blobs are only reported: a depot update with the staged files
+    puts them back once they are removed.
+    """
+
+    def __init__(self, depot_location, jobs=1, io_budget=None, checkpoint_file=None):
+        self._log = logger.Logger.get_logger()
+        self._location = depot_location
+        self._jobs = jobs
+        self._throttle = _Throttle(io_budget) if io_budget else None
+        self._checkpoint_file = checkpoint_file or os.path.join(depot_location, CommonConsts.DEPOT_SCRUB_CHECKPOINT_FILE)
+        self._blob_store = BlobStore(depot_location)
+
+    def scrub(self, resume=True, limit=None):
+        """Returns the report as a dictionary. limit stops after that many blobs, leaving the checkpoint to resume from."""
+        state = self._load_checkpoint() if resume else None
+        if state:
+            self._log.info("Resuming scrub of depot {0} after blob {1} with {2} blobs checked.".format(self._location, state["position"], state["checked"]))
+        else:
+            state = {"position": "", "checked": 0, "bytes": 0, BLOB_STATUS_CORRUPT: [], BLOB_STATUS_UNREADABLE: []}
+        blobs = [b for b in get_depot_blobs(self._location) if b[0] > state["position"]]
+        complete = limit is None or len(blobs) <= limit
+        blobs = blobs[:limit]
+        pool = WorkerPool(self._jobs)
+        for i in xrange(0, len(blobs), CommonConsts.DEPOT_SCRUB_BATCH):
+            batch = blobs[i:i + CommonConsts.DEPOT_SCRUB_BATCH]
+            for (sha1, path), (status, size) in zip(batch, pool.map(self._scrub_blob, batch)):
+                state["checked"] += 1
+                state["bytes"] += size
+                if status != BLOB_STATUS_OK:
+                    state[status].append(sha1)
+                    self._log.warning("Depot blob {0} is {1}.".format(sha1, status))
+            state["position"] = batch[-1][0]
+            CommonUtils.write_json_atomic(self._checkpoint_file, state)
+        if complete and os.path.exists(self._checkpoint_file):
+            os.remove(self._checkpoint_file)
+        report = {"depot": self._location, "complete": complete, "checked": state["checked"], "bytes": state["bytes"],
+                  BLOB_STATUS_CORRUPT: sorted(state[BLOB_STATUS_CORRUPT]), BLOB_STATUS_UNREADABLE: sorted(state[BLOB_STATUS_UNREADABLE])}
+        report["ok"] = not (report[BLOB_STATUS_CORRUPT] or report[BLOB_STATUS_UNREADABLE])
+        return report
+
+    def _scrub_blob(self, blob):
+        sha1, path = blob
+        digest = hashlib.sha1()
+        size = 0
+        try:
+            with BlobReader(path) as reader:
+                charged = 0
+                while True:
+                    chunk = reader.read(CommonConsts.IO_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if self._throttle:
+                        # the budget caps disk reads, so compressed blobs are charged what they take on disk
+                        self._throttle.consume(reader.stored_bytes - charged)
+                        charged = reader.stored_bytes
+                    digest.update(chunk)
+                    size += len(chunk)
+        except Exception as e:
+            self._log.debug("Cannot read depot blob {0}. Error is {1}".format(sha1, e))
+            return BLOB_STATUS_UNREADABLE, size
+        return (BLOB_STATUS_OK if digest.hexdigest() == sha1 else BLOB_STATUS_CORRUPT), size
+
+    def _load_checkpoint(self):
+        if not os.path.exists(self._checkpoint_file):
+            return None
+        try:
+            with open(self._checkpoint_file, "rb") as f:
+                return json.load(f)
+        except ValueError as e:
+            self._log.warning("Ignoring unreadable scrub checkpoint: {0}. Error is {1}".format(self._checkpoint_file, e))
+            return None
+
+    @staticmethod
+    def format_report(report):
+        lines = ["{0}: {1} blobs, {2} bytes checked, {3}{4}".format(report["depot"], report["checked"], report["bytes"],
+                                                                  "OK" if report["ok"] else "FAILED", "" if report["complete"] else " (incomplete)")]
+        for status in (BLOB_STATUS_CORRUPT, BLOB_STATUS_UNREADABLE):
+            for sha1 in report[status]:
+                lines.append("    {0}: {1}".format(status, sha1))
+        return "\n".join(lines)
+
+
+class _Throttle:
+    """Token bucket shared by the scrub workers, holding at most one second of budget."""
+
+    def __init__(self, rate):
+        self._rate = float(rate)
+        self._lock = threading.Lock()
+        self._tokens = self._rate
+        self._last = time.time()
+
+    def consume(self, n):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
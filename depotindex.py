@@ -0,0 +1,85 @@
+import json
+import sqlite3
+
+'''
+Record fields of a package in the depot index.
+'''
+INDEX_KEY_PACKAGE = "package"
+INDEX_KEY_VERSION = "version"
+INDEX_KEY_PLATFORM = "platform"
+INDEX_KEY_MANIFEST = "manifest"
+INDEX_KEY_MANIFEST_SHA1 = "manifest_sha1"
+INDEX_KEY_TOTAL_SIZE = "total_size"
+INDEX_KEY_FILE_COUNT = "file_count"
+INDEX_KEY_DEPENDS = "depends"
+INDEX_KEY_PUBLISHED = "published"
+
+_COLUMNS = (INDEX_KEY_PACKAGE, INDEX_KEY_VERSION, INDEX_KEY_PLATFORM, INDEX_KEY_MANIFEST, INDEX_KEY_MANIFEST_SHA1,
+            INDEX_KEY_TOTAL_SIZE, INDEX_KEY_FILE_COUNT, INDEX_KEY_DEPENDS, INDEX_KEY_PUBLISHED)
+
+
+class DepotIndex:
+    """SQLite catalog of the packages in a software depot, one record per package version and platform.
+
+    Records hold the manifest name and sha1, the total size and number of files and the direct
+    dependencies of a package, so listing and querying the depot never opens a manifest.
+    """
+
+    def __init__(self, index_file):
+        self._index_file = index_file
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS packages (package TEXT, version TEXT, platform TEXT, manifest TEXT, "
+                         "manifest_sha1 TEXT, total_size INTEGER, file_count INTEGER, depends TEXT, published REAL, "
+                         "PRIMARY KEY (package, version, platform))")
+            conn.execute("CREATE INDEX IF NOT EXISTS packages_platform ON packages (platform)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def put(self, record):
+        """Adds or replaces the record of a package. depends is a list of dependency dictionaries of the manifest."""
+        values = [record[k] for k in _COLUMNS]
+        values[_COLUMNS.index(INDEX_KEY_DEPENDS)] = json.dumps(record[INDEX_KEY_DEPENDS])
+        self._execute("INSERT OR REPLACE INTO packages ({0}) VALUES ({1})".format(", ".join(_COLUMNS), ", ".join("?" * len(_COLUMNS))), values)
+
+    def remove(self, package, version, platform):
+        self._execute("DELETE FROM packages WHERE package = ? AND version = ? AND platform = ?", (package, version, platform))
+
+    def clear(self):
+        self._execute("DELETE FROM packages")
+
+    def query(self, package=None, version=None, platform=None):
+        """Returns the records matching the given fields, ordered by package, version and platform."""
+        conditions = []
+        values = []
+        for column, value in ((INDEX_KEY_PACKAGE, package), (INDEX_KEY_VERSION, version), (INDEX_KEY_PLATFORM, platform)):
+            if value is not None:
+                conditions.append(column + " = ?")
+                values.append(value)
+        sql = "SELECT {0} FROM packages".format(", ".join(_COLUMNS))
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY package, version, platform"
+        conn = self._connect()
+        try:
+            rows = conn.execute(sql, values).fetchall()
+        finally:
+            conn.close()
+        records = []
+        for row in rows:
+            record = dict(zip(_COLUMNS, row))
+            record[INDEX_KEY_DEPENDS] = json.loads(record[INDEX_KEY_DEPENDS])
+            records.append(record)
+        return records
+
+    def _execute(self, sql, values=()):
+        conn = self._connect()
+        try:
+            conn.execute(sql, values)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self._index_file, timeout=60)
@@ -0,0 +1,239 @@
+import sys
+import threading
+
+from commons import CommonUtils, CommonConsts, CyclicDependencyError
+from parallel import WorkerPool
+
+
+class PackageNode:
+    def __init__(self, name, version, platform, manifest_filename, manifest=None):
+        self.name = name
+        self.version = version
+        self.platform = platform
+        self.manifest_filename = manifest_filename
+        self.manifest = manifest
+
+    @classmethod
+    def instance_from_dependency(cls, dep):
+        mfn = dep.get(CommonConsts.MF_KEY_DEPENDS_ATTR_MANIFEST)
+        if not mfn:
+            mfn = CommonUtils.generate_manifest_filename(dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PACKAGE],
+                                                         dep[CommonConsts.MF_KEY_DEPENDS_ATTR_VERSION],
+                                                         dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PLATFORM],
+                                                         "json")
+        return cls(dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PACKAGE], dep[CommonConsts.MF_KEY_DEPENDS_ATTR_VERSION],
+                   dep[CommonConsts.MF_KEY_DEPENDS_ATTR_PLATFORM], mfn)
+
+
+class DependencyGraph:
+    """Packages keyed by manifest file name, with an edge from each package to its direct dependencies."""
+
+    def __init__(self):
+        self._nodes = {}
+        self._edges = {}
+
+    def add_package(self, node):
+        self._nodes[node.manifest_filename] = node
+        self._edges.setdefault(node.manifest_filename, [])
+
+    def add_dependency(self, manifest_filename, dep_manifest_filename):
+        deps = self._edges.setdefault(manifest_filename, [])
+        if dep_manifest_filename not in deps:
+            deps.append(dep_manifest_filename)
+
+    def get_package(self, manifest_filename):
+        return self._nodes[manifest_filename]
+
+    def packages(self):
+        return list(self._nodes)
+
+    def dependencies(self, manifest_filename):
+        return list(self._edges.get(manifest_filename, []))
+
+    def __contains__(self, manifest_filename):
+        return manifest_filename in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def topological_order(self):
+        """Returns the manifest file names with every package after all of its dependencies.
+        Raises CyclicDependencyError for the first cycle found; the graph is walked once."""
+        visiting, visited = set(), set()
+        order = []
+        for root in sorted(self._nodes):
+            if root in visited:
+                continue
+            path = [root]
+            stack = [(root, iter(self._edges.get(root, [])))]
+            visiting.add(root)
+            while stack:
+                node, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    stack.pop()
+                    path.pop()
+                    visiting.discard(node)
+                    visited.add(node)
+                    order.append(node)
+                elif child in visiting:
+                    cycle = path[path.index(child):] + [child]
+                    raise CyclicDependencyError("FATAL: Cyclic dependency found between manifests: {0}".format(" -> ".join(cycle)))
+                elif child not in visited:
+                    visiting.add(child)
+                    path.append(child)
+                    stack.append((child, iter(self._edges.get(child, []))))
+        return order
+
+
+class DependencyResolver:
+    """Loads the manifests of a package and all of its transitive dependencies into a DependencyGraph.
+
+    load_manifest is called with a manifest file name and returns the parsed manifest. Manifests of
+    one level of the graph are loaded in parallel by up to jobs workers. With pipelined=True there are
+    no levels: the manifest of a dependency is loaded as soon as a loaded manifest names it.
+    """
+
+    def __init__(self, load_manifest, jobs=1, pipelined=False):
+        self._load_manifest = load_manifest
+        self._jobs = jobs
+        self._pipelined = pipelined
+
+    def resolve(self, root):
+        if self._pipelined:
+            return self._resolve_pipelined(root)
+        graph = DependencyGraph()
+        graph.add_package(root)
+        if root.manifest is None:
+            root.manifest = self._load_manifest(root.manifest_filename)
+        frontier = [root]
+        while frontier:
+            discovered = []
+            for node in frontier:
+                for dep in node.manifest.get(CommonConsts.MF_KEY_DEPENDS, []):
+                    dep_node = PackageNode.instance_from_dependency(dep)
+                    graph.add_dependency(node.manifest_filename, dep_node.manifest_filename)
+                    if dep_node.manifest_filename not in graph:
+                        graph.add_package(dep_node)
+                        discovered.append(dep_node)
+            manifests = WorkerPool(self._jobs).map(self._load_manifest, [n.manifest_filename for n in discovered])
+            for node, manifest in zip(discovered, manifests):
+                node.manifest = manifest
+            frontier = discovered
+        graph.topological_order()
+        return graph
+
+    def _resolve_pipelined(self, root):
+        graph = DependencyGraph()
+        graph.add_package(root)
+        if root.manifest is None:
+            root.manifest = self._load_manifest(root.manifest_filename)
+        pending = []
+        loading = [0]
+        errors = []
+        cond = threading.Condition()
+
+        def discover(node):
+            for dep in node.manifest.get(CommonConsts.MF_KEY_DEPENDS, []):
+                dep_node = PackageNode.instance_from_dependency(dep)
+                graph.add_dependency(node.manifest_filename, dep_node.manifest_filename)
+                if dep_node.manifest_filename not in graph:
+                    graph.add_package(dep_node)
+                    pending.append(dep_node)
+            cond.notify_all()
+
+        def worker():
+            while True:
+                with cond:
+                    while not pending and loading[0] and not errors:
+                        cond.wait()
+                    if errors or not pending:
+                        return
+                    node = pending.pop(0)
+                    loading[0] += 1
+                try:
+                    manifest = self._load_manifest(node.manifest_filename)
+                except Exception:
+                    with cond:
+                        errors.append(sys.exc_info())
+                        loading[0] -= 1
+                        cond.notify_all()
+                    return
+                with cond:
+                    node.manifest = manifest
+                    loading[0] -= 1
+                    discover(node)
+
+        with cond:
+            discover(root)
+        threads = [threading.Thread(target=worker) for _ in range(max(1, int(self._jobs)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        graph.topological_order()
+        return graph
+
+
+class DependencyScheduler:
+    """Runs a function for every package of a DependencyGraph once all of its dependencies are done.
+
+    Independent packages run concurrently, at most jobs at a time. After the first failure no new
+    package is started; the packages already running are waited for and the error is re-raised.
+    """
+
+    def __init__(self, jobs=1):
+        self._jobs = max(1, int(jobs))
+
+    def run(self, graph, func, exclude=()):
+        order = [mfn for mfn in graph.topological_order() if mfn not in exclude]
+        waiting = {}
+        dependents = {}
+        for mfn in order:
+            deps = [d for d in graph.dependencies(mfn) if d not in exclude]
+            waiting[mfn] = len(deps)
+            for d in deps:
+                dependents.setdefault(d, []).append(mfn)
+
+        position = dict((mfn, i) for i, mfn in enumerate(order))
+        ready = [mfn for mfn in order if waiting[mfn] == 0]
+        running = set()
+        errors = []
+        cond = threading.Condition()
+
+        def worker(mfn):
+            try:
+                func(graph.get_package(mfn))
+            except Exception:
+                with cond:
+                    errors.append(sys.exc_info())
+            else:
+                with cond:
+                    for d in dependents.get(mfn, []):
+                        waiting[d] -= 1
+                        if waiting[d] == 0:
+                            ready.append(d)
+                    ready.sort(key=position.get)
+            finally:
+                with cond:
+                    running.discard(mfn)
+                    cond.notify_all()
+
+        with cond:
+            while True:
+                while not errors and ready and len(running) < self._jobs:
+                    mfn = ready.pop(0)
+                    running.add(mfn)
+                    t = threading.Thread(target=worker, args=(mfn,))
+                    t.daemon = True
+                    t.start()
+                if not running:
+                    break
+                cond.wait()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
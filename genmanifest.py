@@ -4,29 +4,30 @@
 
 import sys
 import os
-import hashlib
 import json
 import stat
 
+from hashutils import ParallelHasher
+
 
 # Based on # https://stomp.colorado.edu/blog/blog/2010/10/22/on-python-stat-octal-and-file-system-permissions/ (2012-06-25)
 def get_permission(path):
     """Returns the permission of a file."""
     return oct(stat.S_IMODE(os.stat(path).st_mode))
 
-def gen_manifest(stage_dir):
+def gen_manifest(stage_dir, jobs=None):
     """Generate a manifest from a directory"""
     manifest = {'files': []}
 
+    fullpaths = []
     for root, dirs, files in os.walk(stage_dir):
         for file_ in files:
-            fullpath = os.path.join(root, file_)
-            contents = open(fullpath, 'rb').read()
-            sha1 = hashlib.sha1(contents).hexdigest()
-            filename = os.path.relpath(fullpath, stage_dir)
-            mode = get_permission(fullpath)
-            manifest['files'].append({'path': filename, 'sha1': sha1,
-                                      'mode': mode})
+            fullpaths.append(os.path.join(root, file_))
+    for fullpath, sha1 in zip(fullpaths, ParallelHasher(jobs).hash_files(fullpaths)):
+        filename = os.path.relpath(fullpath, stage_dir)
+        mode = get_permission(fullpath)
+        manifest['files'].append({'path': filename, 'sha1': sha1,
+                                  'mode': mode})
     return manifest
 
 def main(argv=None):
@@ -0,0 +1,25 @@
+from commons import CommonUtils
+from parallel import WorkerPool, POOL_TYPE_THREAD
+
+
+def hash_file(path):
+    return CommonUtils.get_filehash(path)
+
+
+class ParallelHasher:
+    """Hashes files in chunks, spreading them over a pool of jobs threads or processes.
+
+    Threads suit most hosts since hashlib releases the GIL while hashing large buffers;
+    a process pool avoids the GIL entirely for trees of many small files.
+    """
+
+    def __init__(self, jobs=None, pool_type=POOL_TYPE_THREAD):
+        if not jobs:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        self._jobs = jobs
+        self._pool_type = pool_type
+
+    def hash_files(self, paths):
+        """Returns the sha1 of every path, in the order of paths."""
+        return WorkerPool(self._jobs, self._pool_type).map(hash_file, paths)
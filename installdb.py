@@ -0,0 +1,183 @@
+import os
+import json
+import sqlite3
+import logger
+
+from commons import CommonUtils, CommonConsts
+from manifestutils import ManifestFile
+from depresolver import PackageNode
+
+'''
+Record fields of an installed file in the install database.
+'''
+FILE_KEY_PATH = "path"
+FILE_KEY_PACKAGE = "package"
+FILE_KEY_SHA1 = "sha1"
+FILE_KEY_MODE = "mode"
+FILE_KEY_SIZE = "size"
+FILE_KEY_MTIME = "mtime"
+
+_FILE_COLUMNS = (FILE_KEY_PATH, FILE_KEY_PACKAGE, FILE_KEY_SHA1, FILE_KEY_MODE, FILE_KEY_SIZE, FILE_KEY_MTIME)
+_QUERY_CHUNK = 500 # stays below the limit of SQLite on host parameters
+
+
+class InstallDatabase:
+    """SQLite database of the files installed in an install root, kept in etc/packages next to the manifests.
+
+    Every installed file has one owner, the package that installed it last, recorded with its sha1,
+    mode, size and mtime (in nanoseconds). Packages are recorded with their manifest and direct
+    dependencies, so finding the owner of a file, the files of a package or the packages depending on
+    one are indexed lookups instead of reading every stored manifest. The chunks of files installed
+    from chunks are recorded with their offsets, so later installs can copy them from the installed files.
+    """
+
+    def __init__(self, db_file):
+        self._db_file = db_file
+        conn = self._connect()
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, package TEXT, sha1 TEXT, mode TEXT, "
+                         "size INTEGER, mtime INTEGER)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_package ON files (package)")
+            conn.execute("CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1)")
+            conn.execute("CREATE TABLE IF NOT EXISTS chunks (sha1 TEXT, offset INTEGER, chunk TEXT, size INTEGER, PRIMARY KEY (sha1, offset))")
+            conn.execute("CREATE INDEX IF NOT EXISTS chunks_chunk ON chunks (chunk)")
+            conn.execute("CREATE TABLE IF NOT EXISTS packages (package TEXT PRIMARY KEY, manifest TEXT, depends TEXT, installed REAL)")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def put_package(self, package, manifest_filename, depends, files, installed, recipes=None):
+        """Records package as the owner of files, a list of file records, replacing the files it owned before.
+        recipes holds the chunk lists of the files installed from chunks, keyed by sha1."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM files WHERE package = ?", (package,))
+            conn.executemany("INSERT OR REPLACE INTO files ({0}) VALUES ({1})".format(", ".join(_FILE_COLUMNS), ", ".join("?" * len(_FILE_COLUMNS))),
+                             [[f[k] for k in _FILE_COLUMNS] for f in files])
+            conn.execute("INSERT OR REPLACE INTO packages (package, manifest, depends, installed) VALUES (?, ?, ?, ?)",
+                         (package, manifest_filename, json.dumps(depends), installed))
+            for sha1, recipe in (recipes or {}).items():
+                offsets = []
+                offset = 0
+                for chunk, size in recipe:
+                    offsets.append((sha1, offset, chunk, size))
+                    offset += size
+                conn.executemany("INSERT OR IGNORE INTO chunks (sha1, offset, chunk, size) VALUES (?, ?, ?, ?)", offsets)
+            self._remove_unused_chunks(conn)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remove_package(self, package):
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM files WHERE package = ?", (package,))
+            conn.execute("DELETE FROM packages WHERE package = ?", (package,))
+            self._remove_unused_chunks(conn)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get_package(self, package):
+        """Returns the manifest file name and the direct dependencies of an installed package, or None."""
+        rows = self._query("SELECT manifest, depends FROM packages WHERE package = ?", (package,))
+        if not rows:
+            return None
+        return {"manifest": rows[0][0], "depends": json.loads(rows[0][1])}
+
+    def packages(self):
+        return [row[0] for row in self._query("SELECT package FROM packages ORDER BY package")]
+
+    def files(self, package):
+        """Returns the records of the files owned by package, ordered by path."""
+        return [dict(zip(_FILE_COLUMNS, row)) for row in
+                self._query("SELECT {0} FROM files WHERE package = ? ORDER BY path".format(", ".join(_FILE_COLUMNS)), (package,))]
+
+    def owners(self, paths):
+        """Returns the records of those of paths that are installed, keyed by path."""
+        paths = list(paths)
+        owners = {}
+        for i in xrange(0, len(paths), _QUERY_CHUNK):
+            chunk = paths[i:i + _QUERY_CHUNK]
+            sql = "SELECT {0} FROM files WHERE path IN ({1})".format(", ".join(_FILE_COLUMNS), ", ".join("?" * len(chunk)))
+            for row in self._query(sql, chunk):
+                owners[row[0]] = dict(zip(_FILE_COLUMNS, row))
+        return owners
+
+    def conflicts(self, package, paths):
+        """Returns the records of those of paths that are owned by a package other than package, ordered by path."""
+        return sorted((r for r in self.owners(paths).values() if r[FILE_KEY_PACKAGE] != package), key=lambda r: r[FILE_KEY_PATH])
+
+    def locate_chunks(self, chunks):
+        """Returns, for those of chunks held by an installed file, the path of one such file and the offset of the chunk in it."""
+        chunks = list(chunks)
+        located = {}
+        for i in xrange(0, len(chunks), _QUERY_CHUNK):
+            part = chunks[i:i + _QUERY_CHUNK]
+            sql = ("SELECT c.chunk, f.path, c.offset FROM chunks c JOIN files f ON f.sha1 = c.sha1 WHERE c.chunk IN ({0})"
+                   .format(", ".join("?" * len(part))))
+            for chunk, path, offset in self._query(sql, part):
+                located[chunk] = (path, offset)
+        return located
+
+    def dependents(self, package):
+        """Returns the other installed packages that directly depend on package."""
+        dependents = []
+        for other, depends in self._query("SELECT package, depends FROM packages WHERE package != ? ORDER BY package", (package,)):
+            for dep in json.loads(depends):
+                if os.path.splitext(PackageNode.instance_from_dependency(dep).manifest_filename)[0] == package:
+                    dependents.append(other)
+                    break
+        return dependents
+
+    def _remove_unused_chunks(self, conn):
+        conn.execute("DELETE FROM chunks WHERE sha1 NOT IN (SELECT sha1 FROM files)")
+
+    def _query(self, sql, values=()):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, values).fetchall()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self._db_file, timeout=60)
+
+
+def get_file_record(path, package, f, st):
+    return {FILE_KEY_PATH: path, FILE_KEY_PACKAGE: package, FILE_KEY_SHA1: f[CommonConsts.MF_KEY_FILES_ATTR_SHA1],
+            FILE_KEY_MODE: f[CommonConsts.MF_KEY_FILES_ATTR_MODE], FILE_KEY_SIZE: st[0], FILE_KEY_MTIME: st[1]}
+
+def open_install_database(install_dir):
+    """Opens the install database of install_dir, building it from the stored manifests if the root has none yet."""
+    etc_dir = os.path.join(install_dir, CommonConsts.INSTALL_ETC_PACKAGES_DIR)
+    db_file = os.path.join(etc_dir, CommonConsts.INSTALL_DB_FILE)
+    exists = os.path.exists(db_file)
+    CommonUtils.make_dirs(etc_dir)
+    db = InstallDatabase(db_file)
+    if not exists:
+        _rebuild(db, install_dir, etc_dir)
+    return db
+
+def _rebuild(db, install_dir, etc_dir):
+    log = logger.Logger.get_logger()
+    exts = tuple("." + ext for ext in CommonConsts.MF_EXTS)
+    manifests = sorted(mfn for mfn in os.listdir(etc_dir) if mfn.endswith(exts))
+    for mfn in manifests:
+        try:
+            manifest = ManifestFile.load_file(os.path.join(etc_dir, mfn))
+        except Exception as e:
+            log.warning("Ignoring unreadable installed manifest: {0}. Error is {1}".format(mfn, e))
+            continue
+        package = os.path.splitext(mfn)[0]
+        records = []
+        for f in manifest.get(CommonConsts.MF_KEY_FILES, []):
+            path = f[CommonConsts.MF_KEY_FILES_ATTR_PATH]
+            try:
+                st = CommonUtils.get_stat_snapshot(os.stat(os.path.join(install_dir, path)))
+            except OSError:
+                continue
+            records.append(get_file_record(path, package, f, st))
+        db.put_package(package, mfn, list(manifest.get(CommonConsts.MF_KEY_DEPENDS, [])), records, os.path.getmtime(os.path.join(etc_dir, mfn)))
+    if manifests:
+        log.info("Built install database of {0} from {1} installed manifests.".format(install_dir, len(manifests)))
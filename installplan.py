@@ -0,0 +1,282 @@
+import os
+import logger
+
+from commons import CommonUtils, CommonConsts, DepotFileNotFoundError
+from parallel import WorkerPool
+from manifestutils import ManifestFile, ManifestDiff
+from depresolver import PackageNode, DependencyResolver
+from depinstall import load_depot_manifest
+from transport import get_transport
+from packfile import PackfileIndex, get_pack_reads
+from journal import InstallJournal, JOURNAL_OP_WRITE
+from chunking import load_depot_recipes
+from installdb import InstallDatabase
+
+PLAN_ACTION_INSTALL = "install"
+PLAN_ACTION_UPDATE = "update"
+PLAN_ACTION_UNCHANGED = "unchanged"
+PLAN_ACTION_SKIP = "skip"
+
+SOURCE_CACHE = "cache"
+SOURCE_PACK = "pack"
+SOURCE_DEPOT = "depot"
+SOURCE_CHUNKS = "chunks"
+
+
+class InstallPlanner:
+    """Works out what installing a package would do, without writing anything.
+
+    The full dependency graph is resolved from the depot manifests and every package is compared with
+    the manifest and journal recorded in <install_dir>/etc/packages, the way PackageInstaller
+    would: a package that is not installed is installed with its dependencies, an installed package is
+    updated file by file and its dependencies are skipped. Files to fetch are attributed to the blob
+    cache at cache_dir, the packfile of the package, the loose depot blob or, for files the depot stores
+    as chunks, the chunks no installed file holds; the bytes to transfer are the stored sizes asked
+    from the depot and the packfile reads. Files the installer would hash before
+    deciding whether to fetch them are listed for verification.
+    """
+
+    def __init__(self, name, version, platform, install_dir, depot_location, jobs=1, dep_jobs=1, verify=False,
+                 cache_dir=None, transport=None, use_packs=True):
+        self._log = logger.Logger.get_logger()
+        self._name = name
+        self._version = version
+        self._platform = platform
+        self._install_dir = install_dir
+        self._depot_location = depot_location
+        self._jobs = max(1, jobs)
+        self._dep_jobs = max(1, dep_jobs)
+        self._verify = verify
+        self._cache_dir = cache_dir
+        self._max_connections = self._jobs * self._dep_jobs
+        self._transport = transport or get_transport(depot_location, self._max_connections)
+        self._use_packs = use_packs
+        self._etc_dir = os.path.join(install_dir, CommonConsts.INSTALL_ETC_PACKAGES_DIR)
+        db_file = os.path.join(self._etc_dir, CommonConsts.INSTALL_DB_FILE)
+        self._install_db = InstallDatabase(db_file) if os.path.exists(db_file) else None
+
+    def plan(self):
+        """Returns the plan as a dictionary, with the packages in the order they would be installed."""
+        mfn = CommonUtils.generate_manifest_filename(self._name, self._version, self._platform, "json")
+        root = PackageNode(self._name, self._version, self._platform, mfn)
+        graph = DependencyResolver(lambda m: load_depot_manifest(self._transport, m), self._dep_jobs, True).resolve(root)
+        root_installed = self._get_installed_manifest(mfn) is not None
+        packages = []
+        for package_mfn in graph.topological_order():
+            node = graph.get_package(package_mfn)
+            if root_installed and package_mfn != mfn:
+                packages.append(self._skipped_package(node))
+            else:
+                packages.append(self._plan_package(node))
+        self._add_transfer_sizes(packages)
+        plan = {"package": os.path.splitext(mfn)[0], "install_dir": self._install_dir, "depot": self._depot_location,
+                "packages": packages, "totals": self._get_totals(packages),
+                "concurrency": self._get_concurrency(graph, packages, mfn)}
+        plan["noop"] = all(p["action"] in (PLAN_ACTION_UNCHANGED, PLAN_ACTION_SKIP) for p in packages)
+        return plan
+
+    def _skipped_package(self, node):
+        return {"package": os.path.splitext(node.manifest_filename)[0], "manifest": node.manifest_filename,
+                "action": PLAN_ACTION_SKIP, "resume": False, "fetch": [], "verify": [], "chmod": [], "remove": [],
+                "unchanged": 0, "pack_reads": 0, "pack_bytes": 0}
+
+    def _plan_package(self, node):
+        manifest = node.manifest
+        files = manifest.get(CommonConsts.MF_KEY_FILES, [])
+        committed = self._get_committed(node.manifest_filename)
+        installed = self._get_installed_manifest(node.manifest_filename)
+        result = self._skipped_package(node)
+        result["resume"] = bool(committed)
+        if installed is None:
+            result["action"] = PLAN_ACTION_INSTALL
+            prefetch = files
+            to_install = []
+            for f in files:
+                if self._is_committed(f, committed):
+                    continue
+                if os.path.exists(self._get_destination_file(f)):
+                    result["verify"].append(f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+                else:
+                    to_install.append(f)
+        else:
+            diff = ManifestDiff(installed, manifest)
+            prefetch = diff.added + diff.changed
+            to_install = [f for f in diff.added + diff.changed if not self._is_committed(f, committed)]
+            result["remove"] = [f[CommonConsts.MF_KEY_FILES_ATTR_PATH] for f in diff.removed if os.path.lexists(self._get_destination_file(f))]
+            result["chmod"] = [f[CommonConsts.MF_KEY_FILES_ATTR_PATH] for f in diff.mode_changed]
+            for f in diff.unchanged:
+                destfile = self._get_destination_file(f)
+                if not os.path.exists(destfile):
+                    to_install.append(f)
+                elif self._verify:
+                    result["verify"].append(f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+                else:
+                    result["unchanged"] += 1
+            if not (to_install or result["remove"] or result["chmod"] or result["verify"]):
+                result["action"] = PLAN_ACTION_UNCHANGED
+            else:
+                result["action"] = PLAN_ACTION_UPDATE
+        recipes = load_depot_recipes(self._transport, node.manifest_filename) if to_install else {}
+        result["fetch"] = [self._plan_fetch(f) for f in to_install]
+        self._plan_chunks(result, recipes)
+        self._plan_pack(result, [f for f in prefetch if f[CommonConsts.MF_KEY_FILES_ATTR_SHA1] not in recipes])
+        return result
+
+    def _plan_fetch(self, f):
+        sha1 = f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+        if self._is_cached(sha1):
+            return {"path": f[CommonConsts.MF_KEY_FILES_ATTR_PATH], "sha1": sha1, "source": SOURCE_CACHE, "bytes": 0}
+        return {"path": f[CommonConsts.MF_KEY_FILES_ATTR_PATH], "sha1": sha1, "source": SOURCE_DEPOT, "bytes": None}
+
+    """Attributes the files the depot stores as chunks to their chunks, listing those no installed file holds."""
+    def _plan_chunks(self, result, recipes):
+        fetches = [fetch for fetch in result["fetch"] if fetch["source"] == SOURCE_DEPOT and fetch["sha1"] in recipes]
+        if not fetches:
+            return
+        chunks = set(chunk for fetch in fetches for chunk, size in recipes[fetch["sha1"]])
+        located = self._install_db.locate_chunks(chunks) if self._install_db else {}
+        for fetch in fetches:
+            recipe = recipes[fetch["sha1"]]
+            fetch["source"] = SOURCE_CHUNKS
+            fetch["chunks"] = [chunk for chunk, size in recipe if chunk not in located]
+            fetch["reused_chunks"] = len(recipe) - len(fetch["chunks"])
+
+    def _is_cached(self, sha1):
+        return self._cache_dir is not None and os.path.exists(os.path.join(self._cache_dir, CommonUtils.generate_blob_path(sha1)))
+
+    """Attributes the files to fetch to the packfile of the package where the installer would extract them from it,
+    given the files whose blobs it prefetches, and adds the packfile reads and the bytes they transfer."""
+    def _plan_pack(self, result, prefetch):
+        missing = set(f[CommonConsts.MF_KEY_FILES_ATTR_SHA1] for f in prefetch if not self._is_cached(f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]))
+        if self._use_packs and len(missing) >= CommonConsts.PACKFILE_MIN_BLOBS:
+            manifest_filename = result["manifest"]
+            pack = os.path.join(CommonConsts.SW_DEPOT_PACKS_DIR, CommonUtils.generate_packfile_name(manifest_filename))
+            try:
+                index = PackfileIndex.read(self._transport, pack)
+            except DepotFileNotFoundError:
+                index = None
+            except (IOError, ValueError) as e:
+                self._log.warning("Ignoring unreadable packfile: {0}. Error is {1}".format(pack, e))
+                index = None
+            if index is not None:
+                entries = sorted((index.get(sha1) for sha1 in missing if sha1 in index), key=lambda e: e.offset)
+                if entries:
+                    reads = get_pack_reads(index, entries)
+                    result["pack_reads"] = len(reads)
+                    for group, start, length in reads:
+                        result["pack_bytes"] += index.data_end - start if length is None else length
+                for fetch in result["fetch"]:
+                    if fetch["source"] == SOURCE_DEPOT and fetch["sha1"] in missing and fetch["sha1"] in index:
+                        fetch["source"] = SOURCE_PACK
+                        fetch["bytes"] = 0
+
+    """Asks the depot for the stored size of every loose blob and chunk to fetch, once per blob."""
+    def _add_transfer_sizes(self, packages):
+        fetches = [fetch for p in packages for fetch in p["fetch"] if fetch["source"] in (SOURCE_DEPOT, SOURCE_CHUNKS)]
+        sha1s = set()
+        for fetch in fetches:
+            sha1s.update(fetch["chunks"] if fetch["source"] == SOURCE_CHUNKS else [fetch["sha1"]])
+        sha1s = sorted(sha1s)
+        paths = [os.path.join(CommonConsts.SW_DEPOT_DATAFILES_DIR, CommonUtils.generate_blob_path(sha1)) for sha1 in sha1s]
+        sizes = dict(zip(sha1s, WorkerPool(self._max_connections).map(self._transport.size, paths)))
+        for fetch in fetches:
+            if fetch["source"] == SOURCE_CHUNKS:
+                fetch["bytes"] = sum(sizes[chunk] for chunk in fetch["chunks"])
+            else:
+                fetch["bytes"] = sizes[fetch["sha1"]]
+
+    def _get_totals(self, packages):
+        totals = {"packages": len(packages), "files_to_fetch": 0, "bytes_to_transfer": 0, "files_from_cache": 0,
+                  "files_to_verify": 0, "files_to_chmod": 0, "files_to_remove": 0, "files_unchanged": 0, "pack_reads": 0}
+        for action in (PLAN_ACTION_INSTALL, PLAN_ACTION_UPDATE, PLAN_ACTION_UNCHANGED, PLAN_ACTION_SKIP):
+            totals["packages_" + action] = len([p for p in packages if p["action"] == action])
+        blobs = set()
+        for p in packages:
+            for fetch in p["fetch"]:
+                if fetch["source"] == SOURCE_CACHE:
+                    totals["files_from_cache"] += 1
+                else:
+                    totals["files_to_fetch"] += 1
+                    totals["bytes_to_transfer"] += fetch["bytes"]
+                    blobs.add(fetch["sha1"])
+            totals["bytes_to_transfer"] += p["pack_bytes"]
+            totals["files_to_verify"] += len(p["verify"])
+            totals["files_to_chmod"] += len(p["chmod"])
+            totals["files_to_remove"] += len(p["remove"])
+            totals["files_unchanged"] += p["unchanged"]
+            totals["pack_reads"] += p["pack_reads"]
+        totals["unique_blobs_to_fetch"] = len(blobs)
+        return totals
+
+    """Expected peak concurrency: dependencies with work, dep_jobs at a time, as wide as the widest level of the graph,
+    each with up to jobs file workers, and the HTTP connections they share."""
+    def _get_concurrency(self, graph, packages, root_mfn):
+        busy = dict((p["manifest"], len(p["fetch"]) + len(p["verify"])) for p in packages if p["action"] not in (PLAN_ACTION_UNCHANGED, PLAN_ACTION_SKIP))
+        depth = {}
+        for mfn in graph.topological_order():
+            depth[mfn] = max([depth[d] + 1 for d in graph.dependencies(mfn)] or [0])
+        widths = {}
+        for mfn in busy:
+            if mfn != root_mfn:
+                widths[depth[mfn]] = widths.get(depth[mfn], 0) + 1
+        peak_packages = min(self._dep_jobs, max(widths.values() or [1 if busy else 0]))
+        peak_workers = min(self._jobs, max(busy.values() or [0])) * peak_packages
+        return {"packages": peak_packages, "file_workers": peak_workers, "connections": min(peak_workers, self._max_connections)}
+
+    def _get_installed_manifest(self, manifest_filename):
+        for mfn in CommonUtils.get_manifest_filename_variants(manifest_filename):
+            path = os.path.join(self._etc_dir, mfn)
+            if os.path.exists(path):
+                try:
+                    return ManifestFile.load_file(path)
+                except Exception as e:
+                    self._log.warning("Ignoring unreadable installed manifest: {0}. Error is {1}".format(path, e))
+        return None
+
+    def _get_committed(self, manifest_filename):
+        journal = InstallJournal(os.path.join(self._etc_dir, CommonUtils.generate_journal_filename(manifest_filename)))
+        return dict((r["path"], r) for r in journal.load() if r["op"] == JOURNAL_OP_WRITE)
+
+    def _is_committed(self, f, committed):
+        r = committed.get(f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        if r is None or r["sha1"] != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
+            return False
+        try:
+            return CommonUtils.get_stat_snapshot(os.stat(self._get_destination_file(f))) == r["stat"]
+        except OSError:
+            return False
+
+    def _get_destination_file(self, f):
+        return os.path.join(self._install_dir, f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+
+    @staticmethod
+    def format_plan(plan):
+        totals = plan["totals"]
+        lines = []
+        for p in plan["packages"]:
+            line = "{0}: {1}".format(p["package"], p["action"])
+            if p["action"] not in (PLAN_ACTION_UNCHANGED, PLAN_ACTION_SKIP):
+                line += ", {0} files to fetch ({1} bytes), {2} to verify, {3} to chmod, {4} to remove".format(
+                    len(p["fetch"]), sum(fetch["bytes"] for fetch in p["fetch"]) + p["pack_bytes"], len(p["verify"]), len(p["chmod"]), len(p["remove"]))
+            if p["resume"]:
+                line += ", resuming an interrupted install"
+            lines.append(line)
+            for fetch in p["fetch"]:
+                line = "    fetch from {0}: {1} ({2} bytes".format(fetch["source"], fetch["path"], fetch["bytes"])
+                if fetch["source"] == SOURCE_CHUNKS:
+                    line += ", {0} chunks, {1} more held by installed files".format(len(fetch["chunks"]), fetch["reused_chunks"])
+                lines.append(line + ")")
+            for key in ("verify", "chmod", "remove"):
+                for path in p[key]:
+                    lines.append("    {0}: {1}".format(key, path))
+        if plan["noop"]:
+            lines.append("Nothing to do: {0} is installed and unchanged.".format(plan["package"]))
+        else:
+            lines.append("{0} packages to install, {1} to update, {2} unchanged, {3} skipped.".format(
+                totals["packages_install"], totals["packages_update"], totals["packages_unchanged"], totals["packages_skip"]))
+            lines.append("{0} files to fetch ({1} unique blobs), {2} bytes to transfer, {3} files from the blob cache, {4} packfile reads.".format(
+                totals["files_to_fetch"], totals["unique_blobs_to_fetch"], totals["bytes_to_transfer"], totals["files_from_cache"],
+                totals["pack_reads"]))
+            lines.append("Peak concurrency: {0} packages, {1} file workers, {2} depot connections.".format(
+                plan["concurrency"]["packages"], plan["concurrency"]["file_workers"], plan["concurrency"]["connections"]))
+        return "\n".join(lines)
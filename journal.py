@@ -0,0 +1,70 @@
+import os
+import json
+import threading
+import logger
+
+from commons import CommonConsts
+
+JOURNAL_OP_WRITE = "write"
+JOURNAL_OP_REMOVE = "remove"
+JOURNAL_OP_CHMOD = "chmod"
+JOURNAL_OP_BACKUP = "backup"
+
+
+class InstallJournal:
+    """Append-only record of the changes an install makes to the install tree, one JSON object per line.
+
+    Records are flushed as they are written and synced to disk every JOURNAL_SYNC_INTERVAL records,
+    so after a crash the journal lists every change that reached the tree, save for a torn last line.
+    Records written with sync=True are on disk before record returns, for changes that must never go unrecorded.
+    """
+
+    def __init__(self, path):
+        self._log = logger.Logger.get_logger()
+        self._path = path
+        self._file = None
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self._path)
+
+    def load(self):
+        """Returns the records of the journal, ignoring a last line left incomplete by a crash."""
+        if not self.exists():
+            return []
+        records = []
+        with open(self._path, "rb") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    self._log.warning("Ignoring incomplete install journal record: {0}".format(self._path))
+                    break
+        return records
+
+    def record(self, entry, sync=False):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self._path, "ab")
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            if sync or self._unsynced >= CommonConsts.JOURNAL_SYNC_INTERVAL:
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+    def remove(self):
+        self.close()
+        if self.exists():
+            os.remove(self._path)
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
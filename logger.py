@@ -1,13 +1,27 @@
-import logging
-
 global _logger
-
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-_logger = logging.getLogger()
+_logger = None
+_verbose = False
 
 class Logger:
+    """The root logger. It is configured when first used rather than on import, and logging itself is only imported
+    then, so commands that log nothing start faster."""
 
     @staticmethod
     def get_logger():
+        global _logger
+        if _logger is None:
+            import logging
+            logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+            logger = logging.getLogger()
+            logger.setLevel(logging.DEBUG if _verbose else logging.INFO)
+            _logger = logger
         return _logger
 
+    @staticmethod
+    def set_verbose(verbose):
+        """Per-file debug messages are only formatted in verbose mode, they cost too much on large installs."""
+        global _verbose
+        _verbose = verbose
+        if _logger is not None:
+            import logging
+            _logger.setLevel(logging.DEBUG if verbose else logging.INFO)
@@ -1,47 +1,142 @@
 
 import os
-import hashlib
 import stat
 import json
+import time
+import logger
 
 from commons import CommonUtils, CommonConsts, ResourceNotFoundError
+from hashutils import ParallelHasher
+from parallel import POOL_TYPE_THREAD
+from binmanifest import BinaryManifest, BinaryManifestWriter, is_binary_manifest, MAGIC
 
 class ManifestGenerator:
-    def __init__(self, package_name, version, platform, stage_dir, _target_file_path):
+    """Generates the manifest of a staging directory.
+
+    File hashes are looked up in a HashCache first, stored at hash_cache_file or next to the staging
+    directory by default, so that only files changed since the last run are hashed again. The
+    remaining files are hashed by a ParallelHasher with jobs workers of the given pool_type.
+    manifest_format is CommonConsts.MF_EXT_JSON or CommonConsts.MF_EXT_BINARY.
+    """
+    def __init__(self, package_name, version, platform, stage_dir, _target_file_path, hash_cache_file=None, use_hash_cache=True,
+                 jobs=None, pool_type=POOL_TYPE_THREAD, manifest_format=CommonConsts.MF_EXT_JSON):
         self._package_name = package_name
         self._version = version
         self._platform = platform
         self._staging_dir = stage_dir
         self._target_file_path = _target_file_path
+        self._hash_cache_file = hash_cache_file
+        self._use_hash_cache = use_hash_cache
+        self._hasher = ParallelHasher(jobs, pool_type)
+        self._manifest_format = manifest_format
 
 
     def generate_manifest(self):
         manifest = {CommonConsts.MF_KEY_BUILD:[], CommonConsts.MF_KEY_DEPENDS:[], CommonConsts.MF_KEY_DIRS:[], CommonConsts.MF_KEY_FILES: []}
         if not os.path.exists(self._staging_dir):
             raise ResourceNotFoundError("Staging directory path not available. Path: {0}".format(self._staging_dir))
+        fullpaths = []
         for dirpath, dirnames, files in os.walk(self._staging_dir):
             dir_rel_path = os.path.relpath(dirpath, self._staging_dir)
             if dir_rel_path != ".":
                 manifest[CommonConsts.MF_KEY_DIRS].append({CommonConsts.MF_KEY_FILES_ATTR_PATH:dir_rel_path})
             for file_ in files:
-                fullpath = os.path.join(dirpath, file_)
-                sha1 = HashGenerator(fullpath).generate_hash()
-                filename = os.path.relpath(fullpath, self._staging_dir)
-                mode = CommonUtils.get_filepermission(fullpath)
-                manifest[CommonConsts.MF_KEY_FILES].append({CommonConsts.MF_KEY_FILES_ATTR_PATH: filename, CommonConsts.MF_KEY_FILES_ATTR_SHA1: sha1,
-                                      CommonConsts.MF_KEY_FILES_ATTR_MODE: mode})
+                fullpaths.append(os.path.join(dirpath, file_))
+
+        hash_cache = self._get_hash_cache()
+        if hash_cache:
+            sha1s = hash_cache.get_hashes(fullpaths, self._hasher)
+            hash_cache.save()
+        else:
+            sha1s = self._hasher.hash_files(fullpaths)
+        for fullpath, sha1 in zip(fullpaths, sha1s):
+            filename = os.path.relpath(fullpath, self._staging_dir)
+            mode = CommonUtils.get_filepermission(fullpath)
+            manifest[CommonConsts.MF_KEY_FILES].append({CommonConsts.MF_KEY_FILES_ATTR_PATH: filename, CommonConsts.MF_KEY_FILES_ATTR_SHA1: sha1,
+                                  CommonConsts.MF_KEY_FILES_ATTR_MODE: mode})
 
         if self._target_file_path is None:
+            if self._manifest_format == CommonConsts.MF_EXT_BINARY:
+                return BinaryManifestWriter.to_bytes(manifest)
             return json.dumps(manifest)
         self._write_to_file(manifest)
 
+    def _get_hash_cache(self):
+        if not self._use_hash_cache:
+            return None
+        return HashCache(self._hash_cache_file or HashCache.default_location(self._staging_dir))
+
 
     def _write_to_file(self, manifest):
-        with open(os.path.join(self._target_file_path, self._generate_file_name()), "w") as f:
-            f.write(json.dumps(manifest))
+        ManifestFile.write_file(manifest, os.path.join(self._target_file_path, self._generate_file_name()))
 
     def _generate_file_name(self):
-        return CommonUtils.generate_manifest_filename(self._package_name, self._version, self._platform, "json")
+        return CommonUtils.generate_manifest_filename(self._package_name, self._version, self._platform, self._manifest_format)
+
+
+class ManifestFile:
+    """Reads and writes manifests in either the JSON or the binary format.
+
+    Loaded JSON manifests are dictionaries, binary ones are BinaryManifest objects with the same
+    interface; the format is told apart by the content, not by the file name.
+    """
+
+    @staticmethod
+    def load(f):
+        return ManifestFile.loads(f.read())
+
+    @staticmethod
+    def loads(data):
+        if is_binary_manifest(data):
+            return BinaryManifest(data)
+        return json.loads(data)
+
+    @staticmethod
+    def load_file(path):
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) == MAGIC:
+                return BinaryManifest.open(path)
+            f.seek(0)
+            return json.load(f)
+
+    @staticmethod
+    def get_format(manifest):
+        if isinstance(manifest, BinaryManifest):
+            return CommonConsts.MF_EXT_BINARY
+        return CommonConsts.MF_EXT_JSON
+
+    @staticmethod
+    def write_file(manifest, path):
+        """Writes manifest to path, in the binary format if path has the binary manifest extension."""
+        with open(path, "wb") as f:
+            if isinstance(manifest, BinaryManifest):
+                f.write(manifest.to_bytes())
+            elif path.endswith("." + CommonConsts.MF_EXT_BINARY):
+                f.write(BinaryManifestWriter.to_bytes(manifest))
+            else:
+                json.dump(manifest, f)
+
+
+class ManifestDiff:
+    """File level difference between an installed manifest and a new manifest of a package, matched by path."""
+
+    def __init__(self, old_manifest, new_manifest):
+        old_files = dict((f[CommonConsts.MF_KEY_FILES_ATTR_PATH], f) for f in old_manifest.get(CommonConsts.MF_KEY_FILES, []))
+        self.added = []
+        self.changed = []
+        self.mode_changed = []
+        self.unchanged = []
+        for f in new_manifest.get(CommonConsts.MF_KEY_FILES, []):
+            old = old_files.pop(f[CommonConsts.MF_KEY_FILES_ATTR_PATH], None)
+            if old is None:
+                self.added.append(f)
+            elif old[CommonConsts.MF_KEY_FILES_ATTR_SHA1] != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
+                self.changed.append(f)
+            elif old[CommonConsts.MF_KEY_FILES_ATTR_MODE] != f[CommonConsts.MF_KEY_FILES_ATTR_MODE]:
+                self.mode_changed.append(f)
+            else:
+                self.unchanged.append(f)
+        self.removed = sorted(old_files.values(), key=lambda f: f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
 
 
 class HashGenerator:
@@ -54,12 +149,81 @@ class HashGenerator:
         return cls(args.abs_file_name)
 
     def generate_hash(self, algo="sha1"):
-        contents = open(self._abs_file_name, 'rb').read()
         if algo == "sha1":
-            return hashlib.sha1(contents).hexdigest()
+            return CommonUtils.get_filehash(self._abs_file_name, algo)
         else:
             raise ValueError("Not Supported algo")
 
 
+class HashCache:
+    """Persistent cache of file sha1s keyed by path and validated by (size, mtime_ns, inode).
+
+    Files modified less than RACY_WINDOW_NS before the cache is saved are not stored, since a later
+    change within the same mtime tick would go unnoticed.
+    """
+
+    FORMAT_VERSION = 1
+    RACY_WINDOW_NS = 2 * 1000000000
+
+    def __init__(self, cache_file):
+        self._cache_file = cache_file
+        self._log = logger.Logger.get_logger()
+        self._entries = self._load()
+        self._seen = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def default_location(stage_dir):
+        return os.path.normpath(os.path.abspath(stage_dir)) + CommonConsts.HASH_CACHE_FILE_SUFFIX
+
+    @staticmethod
+    def get_stat_key(st):
+        return CommonUtils.get_stat_snapshot(st) + [st.st_ino]
+
+    def get_hashes(self, paths, hasher):
+        """Returns the sha1 of every path in order, hashing only the files without a valid entry with hasher."""
+        paths = [os.path.abspath(p) for p in paths]
+        keys = [HashCache.get_stat_key(os.stat(p)) for p in paths]
+        sha1s = []
+        misses = []
+        for i, (path, key) in enumerate(zip(paths, keys)):
+            entry = self._entries.get(path)
+            if entry is not None and entry[:3] == key:
+                sha1s.append(entry[3])
+            else:
+                sha1s.append(None)
+                misses.append(i)
+        for i, sha1 in zip(misses, hasher.hash_files([paths[i] for i in misses])):
+            sha1s[i] = sha1
+        for path, key, sha1 in zip(paths, keys, sha1s):
+            self._seen[path] = key + [sha1]
+        self.hits += len(paths) - len(misses)
+        self.misses += len(misses)
+        return sha1s
+
+    def save(self):
+        """Stores the entries of the files looked up since the cache was loaded; entries of other files are dropped."""
+        now_ns = int(time.time() * 1000000000)
+        entries = dict((p, e) for p, e in self._seen.iteritems() if now_ns - e[1] > HashCache.RACY_WINDOW_NS)
+        try:
+            CommonUtils.write_json_atomic(self._cache_file, {"version": HashCache.FORMAT_VERSION, "entries": entries})
+        except (IOError, OSError) as e:
+            self._log.warning("Could not save hash cache: {0}. Error is {1}".format(self._cache_file, e))
+        self._log.info("Hash cache: {0} files reused, {1} files hashed.".format(self.hits, self.misses))
+
+    def _load(self):
+        if not os.path.exists(self._cache_file):
+            return {}
+        try:
+            with open(self._cache_file, "rb") as f:
+                cache = json.load(f)
+            if cache.get("version") == HashCache.FORMAT_VERSION:
+                return cache["entries"]
+        except (IOError, ValueError) as e:
+            self._log.warning("Ignoring unreadable hash cache: {0}. Error is {1}".format(self._cache_file, e))
+        return {}
+
+
 
 
@@ -0,0 +1,119 @@
+import os
+import time
+import json
+import threading
+
+METRICS_TOTAL = "total"
+
+
+class Metrics:
+    """Timers and counters of the phases of install and depot commands, per package and in total.
+
+    Timers add up the time spent in a phase by all threads, so with parallel workers a phase can take
+    more seconds than the wall clock time of the command. With trace=True every timed span is also kept
+    as an event for write_trace, which writes the Chrome trace event format (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, trace=False):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._counters = {}
+        self._events = [] if trace else None
+        self._start = time.time()
+
+    def timer(self, phase, package=None):
+        """Context manager timing one span of phase; set bytes on it to account transferred or written bytes."""
+        return _Timer(self, phase, package)
+
+    def record(self, phase, package, start, seconds, nbytes=0):
+        with self._lock:
+            for key in ((METRICS_TOTAL, phase), (package, phase)):
+                if key[0] is None:
+                    continue
+                p = self._phases.setdefault(key, {"count": 0, "seconds": 0.0, "bytes": 0})
+                p["count"] += 1
+                p["seconds"] += seconds
+                p["bytes"] += nbytes
+            if self._events is not None:
+                self._events.append({"name": phase, "cat": package or METRICS_TOTAL, "ph": "X", "pid": os.getpid(),
+                                     "tid": threading.current_thread().ident, "ts": int((start - self._start) * 1000000),
+                                     "dur": int(seconds * 1000000), "args": {"bytes": nbytes}})
+
+    def count(self, name, n=1, package=None):
+        with self._lock:
+            for key in ((METRICS_TOTAL, name), (package, name)):
+                if key[0] is not None:
+                    self._counters[key] = self._counters.get(key, 0) + n
+
+    def to_dict(self):
+        with self._lock:
+            result = {"wall_seconds": time.time() - self._start, "packages": {}}
+            for (package, phase), p in self._phases.items():
+                result["packages"].setdefault(package, {"phases": {}, "counters": {}})["phases"][phase] = dict(p)
+            for (package, name), n in self._counters.items():
+                result["packages"].setdefault(package, {"phases": {}, "counters": {}})["counters"][name] = n
+            return result
+
+    def format_summary(self):
+        stats = self.to_dict()
+        lines = ["Completed in {0:.3f}s (phase seconds add up the time of all workers).".format(stats["wall_seconds"])]
+        packages = sorted(stats["packages"], key=lambda p: (p != METRICS_TOTAL, p))
+        for package in packages:
+            entry = stats["packages"][package]
+            lines.append("{0}:".format(package))
+            lines.append("    {0:<16}{1:>10}{2:>12}{3:>16}".format("phase", "count", "seconds", "bytes"))
+            for phase, p in sorted(entry["phases"].items(), key=lambda item: -item[1]["seconds"]):
+                lines.append("    {0:<16}{1:>10}{2:>12.3f}{3:>16}".format(phase, p["count"], p["seconds"], p["bytes"]))
+            for name, n in sorted(entry["counters"].items()):
+                lines.append("    {0:<16}{1:>10}".format(name, n))
+        return "\n".join(lines)
+
+    def write_trace(self, path):
+        with self._lock:
+            events = list(self._events or [])
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "metrics": self.to_dict()}, f)
+
+
+class NullMetrics:
+    """Metrics that records nothing, used when no statistics are asked for."""
+
+    def timer(self, phase, package=None):
+        return _NULL_TIMER
+
+    def record(self, phase, package, start, seconds, nbytes=0):
+        pass
+
+    def count(self, name, n=1, package=None):
+        pass
+
+
+class _Timer:
+
+    def __init__(self, metrics, phase, package):
+        self._metrics = metrics
+        self._phase = phase
+        self._package = package
+        self.bytes = 0
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self._metrics.record(self._phase, self._package, self._start, time.time() - self._start, self.bytes)
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+_NULL_TIMER = _NullTimer()
+NULL_METRICS = NullMetrics()
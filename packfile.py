@@ -0,0 +1,231 @@
+import os
+import zlib
+import struct
+import hashlib
+import binascii
+
+from commons import CommonUtils, CommonConsts, ChecksumError
+from blobcodec import BlobReader
+
+'''
+Packfile layout (little endian):
+
+    header      magic, format version, flags and entry count
+    index       one entry per blob, sorted by sha1: <20 byte sha1><u8 codec><u64 offset><u64 stored length><u64 size>
+    data        the stored bytes of every blob, in the order of the files in the package manifest
+
+Offsets are from the start of the packfile. A blob is stored zlib compressed if that makes it small enough,
+as it is otherwise.
+'''
+MAGIC = "V20P"
+FORMAT_VERSION = 1
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODECS = (CODEC_NONE, CODEC_ZLIB)
+
+_HEADER = struct.Struct("<4sHHI")
+_ENTRY = struct.Struct("<20sBQQQ")
+
+
+def get_pack_ranges(entries):
+    """Groups entries, sorted by offset, into (entries, start, length) ranges, joining entries less than PACKFILE_MAX_GAP apart."""
+    ranges = []
+    group = [entries[0]]
+    for e in entries[1:]:
+        if e.offset - group[-1].end() > CommonConsts.PACKFILE_MAX_GAP:
+            ranges.append((group, group[0].offset, group[-1].end() - group[0].offset))
+            group = []
+        group.append(e)
+    ranges.append((group, group[0].offset, group[-1].end() - group[0].offset))
+    return ranges
+
+def get_pack_reads(index, entries):
+    """Returns the (entries, start, length) reads that extract entries, sorted by offset, from the packfile of index:
+    one sequential read of the whole packfile if they make up most of it, ranged reads of the parts holding them otherwise."""
+    if sum(e.stored_length for e in entries) >= index.data_size * CommonConsts.PACKFILE_SEQUENTIAL_RATIO:
+        return [(entries, 0, None)]
+    return get_pack_ranges(entries)
+
+
+class PackEntry:
+
+    def __init__(self, sha1, codec, offset, stored_length, size):
+        self.sha1 = sha1
+        self.codec = codec
+        self.offset = offset
+        self.stored_length = stored_length
+        self.size = size
+
+    def end(self):
+        return self.offset + self.stored_length
+
+    def pack(self):
+        return _ENTRY.pack(binascii.unhexlify(self.sha1), self.codec, self.offset, self.stored_length, self.size)
+
+    @staticmethod
+    def unpack(data, pos):
+        sha1, codec, offset, stored_length, size = _ENTRY.unpack_from(data, pos)
+        if codec not in CODECS:
+            raise ValueError("Not supported packfile codec: {0}".format(codec))
+        return PackEntry(binascii.hexlify(sha1), codec, offset, stored_length, size)
+
+
+class PackfileWriter:
+
+    def __init__(self, compress=True):
+        self._compress = compress
+
+    def write(self, path, blobs):
+        """Writes the blobs, a sequence of unique (sha1, stored blob path), to the packfile path. Returns the entries."""
+        entries = []
+        temp = path + CommonConsts.TEMP_FILE_SUFFIX
+        with open(temp, "w+b") as f:
+            f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(blobs)))
+            f.write("\0" * (_ENTRY.size * len(blobs)))
+            for sha1, blob_path in blobs:
+                entries.append(self._write_entry(f, sha1, blob_path))
+            f.seek(_HEADER.size)
+            f.write("".join(e.pack() for e in sorted(entries, key=lambda e: e.sha1)))
+        os.rename(temp, path)
+        return entries
+
+    def _write_entry(self, f, sha1, blob_path):
+        offset = f.tell()
+        with BlobReader(blob_path) as src:
+            size = src.size
+            if self._compress and size:
+                compressor = zlib.compressobj(CommonConsts.PACKFILE_ZLIB_LEVEL)
+                while True:
+                    chunk = src.read(CommonConsts.IO_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+                stored_length = f.tell() - offset
+                if stored_length <= size * CommonConsts.PACKFILE_COMPRESS_RATIO:
+                    return PackEntry(sha1, CODEC_ZLIB, offset, stored_length, size)
+                f.seek(offset)
+                f.truncate()
+        with BlobReader(blob_path) as src:
+            CommonUtils.copy_stream(src, f)
+        return PackEntry(sha1, CODEC_NONE, offset, size, size)
+
+
+class PackfileIndex:
+    """Index of a packfile, read with two ranged reads through a depot transport."""
+
+    def __init__(self, entries):
+        self._entries = dict((e.sha1, e) for e in entries)
+        self.data_size = sum(e.stored_length for e in entries)
+        self.data_end = max(e.end() for e in entries) if entries else 0
+
+    def __contains__(self, sha1):
+        return sha1 in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, sha1):
+        return self._entries.get(sha1)
+
+    @staticmethod
+    def read(transport, rel_path):
+        header = transport.read(rel_path, 0, _HEADER.size)
+        if len(header) != _HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a packfile: {0}".format(rel_path))
+        magic, version, flags, count = _HEADER.unpack(header)
+        if version != FORMAT_VERSION:
+            raise ValueError("Not supported packfile version: {0}".format(version))
+        data = transport.read(rel_path, _HEADER.size, count * _ENTRY.size)
+        if len(data) != count * _ENTRY.size:
+            raise ValueError("Truncated packfile index: {0}".format(rel_path))
+        return PackfileIndex([PackEntry.unpack(data, i * _ENTRY.size) for i in xrange(count)])
+
+
+class PackfileExtractor:
+    """File-like sink for the bytes of a packfile from offset start on, which extracts entries as they stream by.
+
+    Each of entries is decompressed to the path returned by dest_func(sha1) and checked against its sha1
+    once complete; bytes of other entries are skipped. The sha1s of the extracted entries are in extracted.
+    """
+
+    def __init__(self, entries, start, dest_func):
+        self._entries = sorted(entries, key=lambda e: e.offset)
+        self._start = start
+        self._dest_func = dest_func
+        self._out = None
+        self.seek(start)
+
+    def seek(self, pos):
+        if pos != self._start:
+            raise IOError("Packfile extraction can only restart from offset {0}".format(self._start))
+        self._abort_entry()
+        self._pos = pos
+        self._next = 0
+        self.extracted = []
+
+    def truncate(self):
+        pass
+
+    def write(self, chunk):
+        pos = 0
+        while pos < len(chunk) and self._next < len(self._entries):
+            e = self._entries[self._next]
+            if self._pos < e.offset:
+                n = min(e.offset - self._pos, len(chunk) - pos)
+            else:
+                n = min(e.end() - self._pos, len(chunk) - pos)
+                self._feed(e, chunk[pos:pos + n])
+            self._pos += n
+            pos += n
+            self._finish_entries()
+        self._pos += len(chunk) - pos
+
+    def close(self):
+        """Completes the empty entries at the end of the range; raises IOError if an entry was cut short."""
+        self._finish_entries()
+        if self._next < len(self._entries):
+            self._abort_entry()
+            raise IOError("Packfile ended before entry: {0}".format(self._entries[self._next].sha1))
+
+    def _finish_entries(self):
+        while self._next < len(self._entries) and self._pos >= self._entries[self._next].end():
+            e = self._entries[self._next]
+            if self._pos == e.end():
+                self._feed(e, "")
+                self._finish(e)
+            self._next += 1
+
+    def _feed(self, e, data):
+        if self._out is None:
+            self._out = open(self._dest_func(e.sha1), "wb")
+            self._digest = hashlib.new("sha1")
+            self._decompressor = zlib.decompressobj() if e.codec == CODEC_ZLIB else None
+            self._size = 0
+        if self._decompressor is not None:
+            try:
+                data = self._decompressor.decompress(data)
+            except zlib.error as error:
+                raise ChecksumError("FATAL: Corrupted packfile entry: {0}. Error is {1}".format(e.sha1, error))
+        self._write(data)
+
+    def _write(self, data):
+        self._out.write(data)
+        self._digest.update(data)
+        self._size += len(data)
+
+    def _finish(self, e):
+        if self._decompressor is not None:
+            self._write(self._decompressor.flush())
+        self._out.close()
+        self._out = None
+        if self._digest.hexdigest() != e.sha1 or self._size != e.size:
+            os.remove(self._dest_func(e.sha1))
+            raise ChecksumError("FATAL: SHA1 doesn't match for packfile entry: {0}".format(e.sha1))
+        self.extracted.append(e.sha1)
+
+    def _abort_entry(self):
+        if self._out is not None:
+            self._out.close()
+            self._out = None
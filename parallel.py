@@ -0,0 +1,164 @@
+import sys
+import Queue
+import threading
+
+POOL_TYPE_THREAD = "thread"
+POOL_TYPE_PROCESS = "process"
+POOL_TYPES = (POOL_TYPE_THREAD, POOL_TYPE_PROCESS)
+
+
+class WorkerPool:
+    """Bounded pool of worker threads or processes that applies a function to a sequence of items.
+
+    The first exception raised by a worker stops all remaining work and is re-raised
+    to the caller, so a batch either completes entirely or fails on its first error.
+    With a process pool, func must be a module level function and items must be picklable.
+    """
+
+    def __init__(self, jobs=1, pool_type=POOL_TYPE_THREAD):
+        if pool_type not in POOL_TYPES:
+            raise ValueError("Not supported pool type: {0}".format(pool_type))
+        self._jobs = max(1, int(jobs))
+        self._pool_type = pool_type
+
+    def map(self, func, items):
+        """Applies func to every item and returns the results in the order of items."""
+        if self._jobs == 1:
+            return [func(item) for item in items]
+        if self._pool_type == POOL_TYPE_PROCESS:
+            return self._map_processes(func, items)
+        return self._map_threads(func, items)
+
+    def _map_processes(self, func, items):
+        import multiprocessing # only process pools need it, and it is slow to import
+        items = list(items)
+        if not items:
+            return []
+        chunksize = max(1, len(items) // (self._jobs * 4))
+        pool = multiprocessing.Pool(min(self._jobs, len(items)))
+        try:
+            return list(pool.imap(func, items, chunksize))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _map_threads(self, func, items):
+        items = list(items)
+        results = [None] * len(items)
+        work = iter(enumerate(items))
+        lock = threading.Lock()
+        failed = threading.Event()
+        errors = []
+
+        def worker():
+            while not failed.is_set():
+                with lock:
+                    try:
+                        index, item = next(work)
+                    except StopIteration:
+                        return
+                try:
+                    results[index] = func(item)
+                except Exception:
+                    with lock:
+                        if not errors:
+                            errors.append(sys.exc_info())
+                    failed.set()
+                    return
+
+        threads = [threading.Thread(target=worker) for _ in range(min(self._jobs, len(items)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        return results
+
+
+class Pipeline:
+    """Passes items through stages, each a (function, workers) pair run by its own worker threads,
+    connected by queues of at most queue_size items.
+
+    A stage function returning None drops the item; the results of the last stage are returned in the
+    order they complete. The bounded queues make a fast stage wait for a slow one instead of running
+    ahead of it. The first exception raised in any stage cancels the pipeline: no more items are fed
+    in, the items in flight are drained without being processed, and the error is re-raised to the
+    caller once all workers have stopped.
+    """
+
+    def __init__(self, stages, queue_size=64):
+        self._stages = [(func, max(1, int(workers))) for func, workers in stages]
+        self._queue_size = queue_size
+
+    def run(self, items):
+        queues = [Queue.Queue(self._queue_size) for _ in self._stages]
+        remaining = [workers for func, workers in self._stages]
+        results = []
+        errors = []
+        lock = threading.Lock()
+        cancelled = threading.Event()
+
+        def cancel():
+            with lock:
+                if not errors:
+                    errors.append(sys.exc_info())
+            cancelled.set()
+
+        def stop_stage(index):
+            if index < len(self._stages):
+                for _ in range(self._stages[index][1]):
+                    queues[index].put(_STOP)
+
+        def feeder():
+            try:
+                for item in items:
+                    if cancelled.is_set():
+                        break
+                    queues[0].put(item)
+            except Exception:
+                cancel()
+            stop_stage(0)
+
+        def worker(index):
+            func = self._stages[index][0]
+            while True:
+                item = queues[index].get()
+                if item is _STOP:
+                    break
+                if cancelled.is_set():
+                    continue
+                try:
+                    result = func(item)
+                except Exception:
+                    cancel()
+                    continue
+                if result is None:
+                    continue
+                if index + 1 < len(self._stages):
+                    queues[index + 1].put(result)
+                else:
+                    with lock:
+                        results.append(result)
+            with lock:
+                remaining[index] -= 1
+                last = remaining[index] == 0
+            if last:
+                stop_stage(index + 1)
+
+        threads = [threading.Thread(target=feeder)]
+        for index, (func, workers) in enumerate(self._stages):
+            threads.extend(threading.Thread(target=worker, args=(index,)) for _ in range(workers))
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        return results
+
+_STOP = object()
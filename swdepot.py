@@ -1,90 +1,339 @@
 import os
-import hashlib
-import shutil
+import stat
+import time
 import json
 
-from commons import CommonConsts, CommonUtils, ChecksumError, PermissionError, PackageExistsError
+import logger
+from commons import CommonConsts, CommonUtils, PermissionError, PackageExistsError
+from parallel import POOL_TYPE_THREAD
+import depotindex
+from depotindex import DepotIndex
+from metrics import NULL_METRICS
+
+'''
+Only the depot index is needed to query a depot; the modules publishing packages and reading blobs, manifests
+and recipes are imported by the methods using them, so depot list and query start fast.
+'''
+
+def put_blob(args):
+    """Returns whether the blob was written, or the exception storing it raised, so the caller learns which blobs
+    it stored even when some fail."""
+    from blobstore import BlobStore
+    depot_location, src_path, sha1, compress, hardlink = args
+    try:
+        return BlobStore(depot_location).put_blob(src_path, sha1, compress, hardlink)
+    except Exception as e:
+        return e
+
+def put_chunks(args):
+    from blobstore import BlobStore
+    depot_location, src_path, sha1, compress = args
+    return BlobStore(depot_location).put_chunks(src_path, sha1, compress)
+
 
 class SoftwareDepot:
-    def __init__(self, depot_location):
+    """Publishes packages to a software depot directory and queries its index."""
+    def __init__(self, depot_location, jobs=None, pool_type=POOL_TYPE_THREAD, hardlink=False, metrics=None, cache=None):
         self._location = depot_location
+        self._metrics = metrics or NULL_METRICS
+        self._jobs = jobs
+        self._pool_type = pool_type
+        self._pool = None # publishes blobs, reading each staged file once
+        # blobs are reflinked from the staging area where the filesystem supports it; hardlinks are only
+        # safe if staged files are never modified in place afterwards
+        self._hardlink = hardlink
         self._depot_df_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_DATAFILES_DIR)
         self._depot_mf_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_MANIFEST_FILE_DIR)
-        #self._depot_temp_path = os.path.join()
+        self._depot_packs_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_PACKS_DIR)
+        self._depot_packages_path = os.path.join(depot_location, CommonConsts.SW_DEPOT_PACKAGES_DIR)
+        self._blob_store = None
+        self._index_file = os.path.join(depot_location, CommonConsts.SW_DEPOT_INDEX_FILE)
+        self._index = None
+        self._cache = cache # a DepotCache keeping query results while the index is unchanged
 
 
     def list(self):
-        return set(os.listdir(self._depot_mf_path))
+        return set(r[depotindex.INDEX_KEY_MANIFEST] for r in self.query())
 
+    def query(self, package_name=None, version=None, platform=None):
+        """Returns the depot index records of the packages matching the given name, version and platform."""
+        index = self._get_index()
+        if self._cache:
+            return self._cache.get_listing(self._index_file, (package_name, version, platform),
+                                           lambda: index.query(package_name, version, platform))
+        return index.query(package_name, version, platform)
 
-    #TODO:
-    # Create a directory structure on depot too to avoid a conflict if a same files is present in different dirs ??
+    """Rebuilds the depot index from the published manifests, with the package, version and platform recorded when
+    each was published. Manifest names do not tell where a package name ends and its version starts, so for manifests
+    published without that record the version is taken to be the first part of the name starting with a digit."""
+    def reindex(self):
+        from manifestutils import ManifestFile
+        from blobcodec import BlobReader
+        from chunking import get_recipe_size
+        index = self._get_index()
+        index.clear()
+        if not os.path.isdir(self._depot_mf_path):
+            return
+        for mfn in sorted(os.listdir(self._depot_mf_path)):
+            base, ext = os.path.splitext(mfn)
+            if ext[1:] not in CommonConsts.MF_EXTS:
+                continue
+            package_name, version, platform = self._get_package_info(mfn)
+            manifest_file = os.path.join(self._depot_mf_path, mfn)
+            manifest = ManifestFile.load_file(manifest_file)
+            sizes = dict((sha1, get_recipe_size(recipe)) for sha1, recipe in self._load_recipes(mfn).items())
+            for file_ in manifest[CommonConsts.MF_KEY_FILES]:
+                sha1 = file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+                if sha1 not in sizes and self._get_blob_store().has_blob(sha1):
+                    with BlobReader(self._get_blob_store().blob_path(sha1)) as blob:
+                        sizes[sha1] = blob.size
+            total_size = sum(sizes.get(file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1], 0) for file_ in manifest[CommonConsts.MF_KEY_FILES])
+            self._update_index(package_name, version, platform, manifest_file, manifest, total_size, os.path.getmtime(manifest_file))
 
-    def add(self, package_name, version, platform, staging_dir, manifest_filepath):
-        try:
-            manifest_filename = CommonUtils.generate_manifest_filename(package_name, version, platform, "json")
-            if os.path.exists(os.path.join(self._depot_mf_path, manifest_filename)):
-                raise PackageExistsError("Package manifest file already exists in depot. Package name : {0}, manifest file: {1}.\n\
-                                             Either uninstall the package first or use update command to install the package.".format(CommonUtils.generate_package_name(package_name,
-                                                                                                                                                                         version,
-                                                                                                                                                                         platform),
-                                                                                                                                      manifest_filename))
-            input_manifest_file = os.path.join(manifest_filepath, manifest_filename)
-            self._deploy_package(package_name, version, platform, input_manifest_file, staging_dir)
-        except Exception as e:
-            self._cleanup(package_name, version, platform, manifest_filename)
-            raise e
+    """Returns (package name, version, platform) of the published manifest manifest_filename."""
+    def _get_package_info(self, manifest_filename):
+        path = self._get_package_info_path(manifest_filename)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                info = json.load(f)
+            return info[depotindex.INDEX_KEY_PACKAGE], info[depotindex.INDEX_KEY_VERSION], info[depotindex.INDEX_KEY_PLATFORM]
+        parts = os.path.splitext(manifest_filename)[0].split("-")
+        i = next((i for i in range(1, len(parts) - 1) if parts[i][:1].isdigit()), 1)
+        info = "-".join(parts[:i]), parts[i], "-".join(parts[i + 1:])
+        logger.Logger.get_logger().warning("Manifest file: {0} has no package record in depot {1}, indexing it as package {2} version {3} "
+                                           "platform {4}.".format(manifest_filename, self._location, *info))
+        return info
+
+    def _get_package_info_path(self, manifest_filename):
+        return os.path.join(self._depot_packages_path, os.path.splitext(manifest_filename)[0] + ".json")
 
-    def update(self, package_name, version, platform, staging_dir, manifest_filepath):
+
+    def gc(self, dry_run=False, min_age=CommonConsts.DEPOT_GC_MIN_AGE):
+        """Removes the blobs, packfiles and temporary files no manifest reaches; returns the report of DepotCollector."""
+        from depotgc import DepotCollector
+        return DepotCollector(self._location, min_age).collect(dry_run)
+
+    def scrub(self, io_budget=None, checkpoint_file=None, resume=True, limit=None):
+        """Re-hashes the stored blobs with the jobs of the depot; returns the report of DepotScrubber."""
+        from depotgc import DepotScrubber
+        return DepotScrubber(self._location, self._get_jobs(), io_budget, checkpoint_file).scrub(resume, limit)
+
+
+    def serve(self, port=CommonConsts.DEFAULT_DEPOT_HTTP_PORT, host="127.0.0.1"):
+        """Serves the depot over HTTP to installers given its URL as depot location, until interrupted."""
+        from transport import DepotHTTPServer # the HTTP modules are slow to import and only serving needs them
+        server = DepotHTTPServer(self._location, host, port)
         try:
-            manifest_filename = CommonUtils.generate_manifest_filename(package_name, version, platform, "json")
-            input_manifest_file = os.path.join(manifest_filepath, manifest_filename)
-            self._deploy_package(package_name, version, platform, input_manifest_file, staging_dir)
+            server.serve_forever()
+        finally:
+            server.server_close()
 
+
+    """pack=True also writes a packfile of the blobs of the package, which installers fetch in one go.
+    compress=True stores new blobs compressed with the codec that suits each of them. chunk=True stores
+    large files as chunks; packfiles only hold the files stored whole."""
+    def add(self, package_name, version, platform, staging_dir, manifest_filepath, pack=False, compress=False, chunk=False):
+        manifest_filename = CommonUtils.generate_manifest_filename(package_name, version, platform, "json")
+        if self._get_depot_manifest_files(manifest_filename):
+            raise PackageExistsError("Package manifest file already exists in depot. Package name : {0}, manifest file: {1}.\n\
+                                         Either uninstall the package first or use update command to install the package.".format(CommonUtils.generate_package_name(package_name,
+                                                                                                                                                                     version,
+                                                                                                                                                                     platform),
+                                                                                                                                  manifest_filename))
+        try:
+            input_manifest_file = self._get_input_manifest_file(manifest_filepath, manifest_filename)
+            self._deploy_package(package_name, version, platform, input_manifest_file, staging_dir, pack, compress, chunk)
         except Exception as e:
             self._cleanup(package_name, version, platform, manifest_filename)
             raise e
 
+    """A failed update leaves the previously deployed version of the package untouched."""
+    def update(self, package_name, version, platform, staging_dir, manifest_filepath, pack=False, compress=False, chunk=False):
+        manifest_filename = CommonUtils.generate_manifest_filename(package_name, version, platform, "json")
+        input_manifest_file = self._get_input_manifest_file(manifest_filepath, manifest_filename)
+        self._deploy_package(package_name, version, platform, input_manifest_file, staging_dir, pack, compress, chunk)
+
     def delete(self, package_name, version, platform,):
         manifest_filename = CommonUtils.generate_manifest_filename(package_name, version, platform, "json")
         self._cleanup(package_name, version, platform, manifest_filename)
 
 
+    """Returns the binary variant of the manifest in manifest_filepath if there is one, else the JSON one."""
+    def _get_input_manifest_file(self, manifest_filepath, manifest_filename):
+        for mfn in CommonUtils.get_manifest_filename_variants(manifest_filename):
+            if os.path.exists(os.path.join(manifest_filepath, mfn)):
+                return os.path.join(manifest_filepath, mfn)
+        return os.path.join(manifest_filepath, manifest_filename)
+
+    def _get_depot_manifest_files(self, manifest_filename):
+        paths = [os.path.join(self._depot_mf_path, mfn) for mfn in CommonUtils.get_manifest_filename_variants(manifest_filename)]
+        return [p for p in paths if os.path.exists(p)]
 
-    def _deploy_package(self, package_name, version, platform, manifest_file, staging_dir):
+    """Stores the blobs of the package that are not in the blob store yet, in parallel, and then points the package
+    references at the blobs of the manifest. Blobs written by a failed deployment are removed again unless a package
+    references them; blobs another publisher stored meanwhile, and chunks, are left alone, as other packages may be
+    about to reference them."""
+    def _deploy_package(self, package_name, version, platform, manifest_file, staging_dir, pack=False, compress=False, chunk=False):
+        import shutil # imports bz2 and zlib
+        from manifestutils import ManifestFile
         depot_package_name = CommonUtils.generate_package_name(package_name, version, platform)
-        depot_pkg_dest_path = os.path.join(self._depot_df_path, depot_package_name)
-        if not os.path.exists(depot_pkg_dest_path):
-                os.makedirs(depot_pkg_dest_path)
-        with open(manifest_file, "rb") as f:
-            manifest = json.load(f)
-            dirs_m = manifest[CommonConsts.MF_KEY_DIRS]
-            files_m = manifest[CommonConsts.MF_KEY_FILES]
-            for file_ in files_m:
-                fullpath = os.path.join(staging_dir, file_[CommonConsts.MF_KEY_FILES_ATTR_PATH])
-                contents = open(fullpath, 'rb').read()
-                sha1 = hashlib.sha1(contents).hexdigest()
-                if sha1 != file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
-                    raise ChecksumError("FATAL: File modified in staging area before installation: {0}".format(file_[CommonConsts.MF_KEY_FILES_ATTR_PATH]))
-                mode = CommonUtils.get_filepermission(fullpath)
-                if mode != file_["mode"]:
-                    raise PermissionError("FATAL: SHA1 doesn't match for installed file: {0}".format(fullpath))
-                dest_file = os.path.join(depot_pkg_dest_path, sha1)
-                shutil.copy(fullpath, dest_file)
-        shutil.copy(manifest_file, self._depot_mf_path)
+        package = os.path.splitext(os.path.basename(manifest_file))[0]
+        with self._metrics.timer("manifest", package):
+            manifest = ManifestFile.load_file(manifest_file)
+        files_m = manifest[CommonConsts.MF_KEY_FILES]
+        refs = []
+        missing = []
+        chunked = []
+        seen = set()
+        total_size = 0
+        missing_size = 0
+        created = []
+        try:
+            with self._metrics.timer("stat", package):
+                for file_ in files_m:
+                    fullpath = os.path.join(staging_dir, file_[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+                    st = os.stat(fullpath)
+                    total_size += st.st_size
+                    mode = oct(stat.S_IMODE(st.st_mode))
+                    if mode != file_[CommonConsts.MF_KEY_FILES_ATTR_MODE]:
+                        raise PermissionError("FATAL: Permission mode doesn't match for staged file: {0}".format(fullpath))
+                    sha1 = file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+                    if chunk and st.st_size >= CommonConsts.CHUNK_MIN_FILE_SIZE:
+                        if sha1 not in seen:
+                            chunked.append(file_)
+                    else:
+                        refs.append(sha1)
+                        if sha1 not in seen and not self._get_blob_store().has_blob(sha1):
+                            missing.append(file_)
+                            missing_size += st.st_size
+                    seen.add(sha1)
+            with self._metrics.timer("store", package) as t:
+                stored = self._get_pool().map(put_blob, [(self._location, os.path.join(staging_dir, file_[CommonConsts.MF_KEY_FILES_ATTR_PATH]),
+                                                          file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1], compress, self._hardlink) for file_ in missing])
+                t.bytes = missing_size
+            created = [file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1] for file_, result in zip(missing, stored) if result is True]
+            for result in stored:
+                if isinstance(result, Exception):
+                    raise result
+            with self._metrics.timer("chunk", package):
+                recipes = self._get_pool().map(put_chunks, [(self._location, os.path.join(staging_dir, file_[CommonConsts.MF_KEY_FILES_ATTR_PATH]),
+                                                       file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1], compress) for file_ in chunked])
+            recipes = dict(zip([file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1] for file_ in chunked], recipes))
+            for recipe in recipes.values():
+                refs.extend(c for c, size in recipe)
+            self._metrics.count("blobs_stored", len(created), package)
+            self._metrics.count("blobs_shared", len(seen) - len(created) - len(chunked), package)
+            self._metrics.count("files_chunked", len(chunked), package)
+            self._get_blob_store().set_refs(depot_package_name, refs)
+        except Exception:
+            for sha1 in created:
+                self._get_blob_store().remove_blob(sha1)
+            raise
+        for depot_mf in self._get_depot_manifest_files(os.path.basename(manifest_file)):
+            if os.path.basename(depot_mf) != os.path.basename(manifest_file):
+                os.remove(depot_mf)
+        self._write_recipes(os.path.basename(manifest_file), recipes)
+        if pack:
+            with self._metrics.timer("pack", package):
+                self._write_packfile(manifest, os.path.basename(manifest_file), recipes)
+        else:
+            self._remove_packfile(os.path.basename(manifest_file))
+        CommonUtils.make_dirs(self._depot_packages_path)
+        CommonUtils.write_json_atomic(self._get_package_info_path(os.path.basename(manifest_file)),
+                                      {depotindex.INDEX_KEY_PACKAGE: package_name, depotindex.INDEX_KEY_VERSION: version,
+                                       depotindex.INDEX_KEY_PLATFORM: platform})
+        CommonUtils.make_dirs(self._depot_mf_path)
+        depot_mf = os.path.join(self._depot_mf_path, os.path.basename(manifest_file))
+        shutil.copy(manifest_file, depot_mf)
+        with self._metrics.timer("index", package):
+            self._update_index(package_name, version, platform, depot_mf, manifest, total_size, time.time())
+
+    def _update_index(self, package_name, version, platform, manifest_file, manifest, total_size, published):
+        self._get_index().put({depotindex.INDEX_KEY_PACKAGE: package_name,
+                               depotindex.INDEX_KEY_VERSION: version,
+                               depotindex.INDEX_KEY_PLATFORM: platform,
+                               depotindex.INDEX_KEY_MANIFEST: os.path.basename(manifest_file),
+                               depotindex.INDEX_KEY_MANIFEST_SHA1: CommonUtils.get_filehash(manifest_file),
+                               depotindex.INDEX_KEY_TOTAL_SIZE: total_size,
+                               depotindex.INDEX_KEY_FILE_COUNT: len(manifest[CommonConsts.MF_KEY_FILES]),
+                               depotindex.INDEX_KEY_DEPENDS: list(manifest.get(CommonConsts.MF_KEY_DEPENDS, [])),
+                               depotindex.INDEX_KEY_PUBLISHED: published})
+
+    def _get_jobs(self):
+        if not self._jobs:
+            import multiprocessing
+            self._jobs = multiprocessing.cpu_count()
+        return self._jobs
+
+    def _get_pool(self):
+        if self._pool is None:
+            from parallel import WorkerPool
+            self._pool = WorkerPool(self._get_jobs(), self._pool_type)
+        return self._pool
+
+    def _get_blob_store(self):
+        if self._blob_store is None:
+            from blobstore import BlobStore
+            self._blob_store = BlobStore(self._location)
+        return self._blob_store
+
+    """Opens the depot index, building it from the published manifests if the depot has none yet."""
+    def _get_index(self):
+        if self._index is None:
+            exists = os.path.exists(self._index_file)
+            if not exists:
+                CommonUtils.make_dirs(self._location)
+            self._index = DepotIndex(self._index_file)
+            if not exists and os.path.isdir(self._depot_mf_path) and os.listdir(self._depot_mf_path):
+                self.reindex()
+        return self._index
+
+    """Writes the unique blobs of the manifest that are not chunked, in the order of its files, to the packfile of the package."""
+    def _write_packfile(self, manifest, manifest_filename, recipes):
+        blobs = []
+        seen = set(recipes)
+        for file_ in manifest[CommonConsts.MF_KEY_FILES]:
+            sha1 = file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+            if sha1 not in seen:
+                blobs.append((sha1, self._get_blob_store().blob_path(sha1)))
+                seen.add(sha1)
+        CommonUtils.make_dirs(self._depot_packs_path)
+        from packfile import PackfileWriter
+        PackfileWriter().write(os.path.join(self._depot_packs_path, CommonUtils.generate_packfile_name(manifest_filename)), blobs)
+
+    def _write_recipes(self, manifest_filename, recipes):
+        from chunking import get_recipes_path
+        path = os.path.join(self._location, get_recipes_path(manifest_filename))
+        if recipes:
+            CommonUtils.make_dirs(os.path.dirname(path))
+            CommonUtils.write_json_atomic(path, recipes)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def _load_recipes(self, manifest_filename):
+        from chunking import get_recipes_path
+        path = os.path.join(self._location, get_recipes_path(manifest_filename))
+        if not os.path.exists(path):
+            return {}
+        with open(path, "rb") as f:
+            return json.load(f)
+
+    def _remove_packfile(self, manifest_filename):
+        path = os.path.join(self._depot_packs_path, CommonUtils.generate_packfile_name(manifest_filename))
+        if os.path.exists(path):
+            os.remove(path)
 
 
     def _cleanup(self, package_name, version, platform, manifest_filename):
         try:
-            depot_mf = os.path.join(self._depot_mf_path, manifest_filename)
-            if os.path.exists(depot_mf):
+            for depot_mf in self._get_depot_manifest_files(manifest_filename):
                 os.remove(depot_mf)
+            self._remove_packfile(manifest_filename)
+            self._write_recipes(manifest_filename, {})
+            if os.path.exists(self._get_package_info_path(manifest_filename)):
+                os.remove(self._get_package_info_path(manifest_filename))
             depot_pkg = CommonUtils.generate_package_name(package_name, version, platform)
-            depot_df = os.path.join(self._location, CommonConsts.SW_DEPOT_DATAFILES_DIR , depot_pkg)
-            if os.path.exists(depot_df):
-                shutil.rmtree(depot_df)
+            self._get_blob_store().remove_refs(depot_pkg)
+            self._get_index().remove(package_name, version, platform)
         except Exception as e:
             print "Exception while cleanup: ", e
-
-
-
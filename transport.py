@@ -0,0 +1,323 @@
+import os
+import re
+import time
+import errno
+import Queue
+import socket
+import hashlib
+import httplib
+import urllib
+import urlparse
+import posixpath
+import threading
+import BaseHTTPServer
+import SocketServer
+import logger
+
+from commons import CommonUtils, CommonConsts, DepotFileNotFoundError
+
+'''
+Depot transports read files from a software depot by their path relative to the depot root,
+e.g. "manifestfiles/<manifest>" or "datafiles/<sha1[:2]>/<sha1>".
+'''
+
+_BYTE_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def get_transport(depot_location, max_connections=CommonConsts.DEFAULT_HTTP_CONNECTIONS):
+    """Returns the transport for depot_location: an http(s) URL, a file: URL or a filesystem path."""
+    scheme = urlparse.urlparse(depot_location).scheme
+    if scheme in ("http", "https"):
+        return HttpTransport(depot_location, max_connections)
+    if scheme == "file":
+        return FileTransport(urllib.url2pathname(urlparse.urlparse(depot_location).path))
+    if not scheme or len(scheme) == 1: # a windows drive letter is not a scheme
+        return FileTransport(depot_location)
+    raise ValueError("Not supported depot location: {0}".format(depot_location))
+
+
+class FileTransport:
+
+    def __init__(self, root):
+        self._root = root
+
+    def fetch(self, rel_path, dest, start=0, length=None):
+        """Copies the depot file rel_path, or length bytes of it from offset start, to the file object dest in chunks.
+        Returns (size, sha1) of the bytes copied."""
+        digest = hashlib.new("sha1")
+        with self._open(rel_path) as f:
+            if start:
+                f.seek(start)
+            size = CommonUtils.copy_stream(f, dest, digest, length=length)
+        return size, digest.hexdigest()
+
+    def read(self, rel_path, start=0, length=None):
+        with self._open(rel_path) as f:
+            if start:
+                f.seek(start)
+            return f.read() if length is None else f.read(length)
+
+    def size(self, rel_path):
+        path = os.path.join(self._root, rel_path)
+        try:
+            return os.path.getsize(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                raise DepotFileNotFoundError(errno.ENOENT, "File not found in depot", path)
+            raise
+
+    def local_path(self, rel_path):
+        """Path of the depot file rel_path on the local file system; remote transports have no such method."""
+        return os.path.join(self._root, rel_path)
+
+    def close(self):
+        pass
+
+    def _open(self, rel_path):
+        path = os.path.join(self._root, rel_path)
+        try:
+            return open(path, "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise DepotFileNotFoundError(errno.ENOENT, "File not found in depot", path)
+            raise
+
+
+class HttpTransport:
+    """Reads depot files over HTTP from a pool of persistent (keep-alive) connections.
+
+    At most max_connections requests are in flight; threads fetching concurrently each borrow a
+    connection and return it once the response has been read completely. A failed transfer is
+    retried with exponential backoff, resuming with a range request from the last byte received.
+    """
+
+    def __init__(self, base_url, max_connections=CommonConsts.DEFAULT_HTTP_CONNECTIONS, timeout=CommonConsts.DEFAULT_HTTP_TIMEOUT,
+                 retries=CommonConsts.DEFAULT_HTTP_RETRIES, backoff=CommonConsts.DEFAULT_HTTP_BACKOFF):
+        self._log = logger.Logger.get_logger()
+        url = urlparse.urlparse(base_url)
+        self._connection_class = httplib.HTTPSConnection if url.scheme == "https" else httplib.HTTPConnection
+        self._netloc = url.netloc
+        self._base_path = url.path.rstrip("/")
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._slots = threading.BoundedSemaphore(max(1, max_connections))
+        self._idle = Queue.LifoQueue()
+
+    def fetch(self, rel_path, dest, start=0, length=None):
+        """Streams the depot file rel_path, or length bytes of it from offset start, to the file object dest.
+        Returns (size, sha1) of the bytes streamed."""
+        state = {"start": start, "length": length, "size": 0, "digest": hashlib.new("sha1")}
+        if length != 0:
+            self._request(rel_path, self._transfer, dest, state)
+        return state["size"], state["digest"].hexdigest()
+
+    def read(self, rel_path, start=0, length=None):
+        data = []
+        self.fetch(rel_path, _ListWriter(data), start, length)
+        return "".join(data)
+
+    def size(self, rel_path):
+        """Returns the size of the depot file rel_path, asked for with a HEAD request."""
+        return self._request(rel_path, self._head)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+    """Calls transfer(path, *args) for the URL path of rel_path, retrying it on connection and HTTP errors."""
+    def _request(self, rel_path, transfer, *args):
+        path = urllib.quote(self._base_path + "/" + rel_path.replace(os.sep, "/"))
+        attempt = 0
+        while True:
+            try:
+                return transfer(path, *args)
+            except DepotFileNotFoundError:
+                raise
+            except (IOError, socket.error, httplib.HTTPException) as e:
+                attempt += 1
+                if attempt > self._retries:
+                    raise IOError("Error while fetching {0} from depot {1} after {2} attempts. Error is {3}".format(path, self._netloc, attempt, e))
+                delay = self._backoff * (2 ** (attempt - 1))
+                self._log.warning("Retrying {0} in {1:.1f}s. Error is {2}".format(path, delay, e))
+                time.sleep(delay)
+
+    def _transfer(self, path, dest, state):
+        conn = self._acquire()
+        reusable = False
+        try:
+            headers = {}
+            ranged = state["start"] or state["length"] is not None
+            if ranged or state["size"]:
+                last = "" if state["length"] is None else state["start"] + state["length"] - 1
+                headers["Range"] = "bytes={0}-{1}".format(state["start"] + state["size"], last)
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+            if response.status == httplib.NOT_FOUND:
+                response.read()
+                reusable = not response.will_close
+                raise DepotFileNotFoundError(errno.ENOENT, "File not found in depot", path)
+            if response.status == httplib.OK and ranged:
+                raise ValueError("Depot server {0} does not support range requests.".format(self._netloc))
+            if response.status == httplib.OK and state["size"]:
+                # the server ignored the range of a resumed transfer, start over
+                dest.seek(0)
+                dest.truncate()
+                state["size"] = 0
+                state["digest"] = hashlib.new("sha1")
+            elif response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE and state["size"] and state["length"] is None:
+                # a resumed transfer already got the whole file
+                response.read()
+                reusable = not response.will_close
+                return
+            elif response.status not in (httplib.OK, httplib.PARTIAL_CONTENT):
+                raise IOError("HTTP error {0} {1} for {2}".format(response.status, response.reason, path))
+            expected = response.length
+            received = 0
+            while True:
+                chunk = response.read(CommonConsts.IO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                dest.write(chunk)
+                state["digest"].update(chunk)
+                state["size"] += len(chunk)
+                received += len(chunk)
+            # httplib returns what it got when the connection closes early; the retry resumes from state["size"]
+            if expected is not None and received < expected:
+                raise IOError("Incomplete response for {0}: got {1} of {2} bytes".format(path, received, expected))
+            reusable = not response.will_close
+        finally:
+            self._release(conn, reusable)
+
+    def _head(self, path):
+        conn = self._acquire()
+        reusable = False
+        try:
+            conn.request("HEAD", path)
+            response = conn.getresponse()
+            response.read()
+            reusable = not response.will_close
+            if response.status == httplib.NOT_FOUND:
+                raise DepotFileNotFoundError(errno.ENOENT, "File not found in depot", path)
+            if response.status != httplib.OK:
+                raise IOError("HTTP error {0} {1} for {2}".format(response.status, response.reason, path))
+            return int(response.getheader("Content-Length"))
+        finally:
+            self._release(conn, reusable)
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            return self._connection_class(self._netloc, timeout=self._timeout)
+
+    def _release(self, conn, reusable):
+        if reusable:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+
+class _ListWriter:
+    def __init__(self, data):
+        self._data = data
+
+    def write(self, chunk):
+        self._data.append(chunk)
+
+    def seek(self, pos):
+        del self._data[pos:]
+
+    def truncate(self):
+        pass
+
+
+class DepotHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a depot directory over HTTP/1.1 with keep-alive and range requests."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, depot_location, host="127.0.0.1", port=CommonConsts.DEFAULT_DEPOT_HTTP_PORT):
+        self.depot_location = os.path.abspath(depot_location)
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), DepotRequestHandler)
+
+    def get_url(self):
+        return "http://{0}:{1}".format(*self.server_address[:2])
+
+
+class DepotRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+    def _send(self, with_body):
+        path = self._translate_path(self.path)
+        if path is None or not os.path.isfile(path):
+            self.send_response(httplib.NOT_FOUND)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        size = os.path.getsize(path)
+        start, end = self._parse_range(size)
+        if start is not None and end is None:
+            self.send_response(httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header("Content-Range", "bytes */{0}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        with open(path, "rb") as f:
+            if start is None:
+                self.send_response(httplib.OK)
+                start, end = 0, size - 1
+            else:
+                self.send_response(httplib.PARTIAL_CONTENT)
+                self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, size))
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            if with_body:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(CommonConsts.IO_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+
+    """Returns (start, end) of the single byte range requested, (None, None) to send the whole file when there is no
+    range or it is malformed, or (size, None) when no byte of the file is in the range."""
+    def _parse_range(self, size):
+        match = _BYTE_RANGE_RE.match(self.headers.getheader("Range") or "")
+        if not match or not any(match.groups()):
+            return None, None
+        first, last = match.groups()
+        if not first:
+            # a suffix range asks for the last bytes of the file
+            if not int(last) or not size:
+                return size, None
+            return max(0, size - int(last)), size - 1
+        start = int(first)
+        if last and int(last) < start:
+            return None, None
+        if start >= size:
+            return size, None
+        return start, min(int(last), size - 1) if last else size - 1
+
+    def _translate_path(self, url_path):
+        path = posixpath.normpath(urllib.unquote(urlparse.urlparse(url_path).path))
+        parts = [p for p in path.split("/") if p and p not in (".", "..")]
+        return os.path.join(self.server.depot_location, *parts)
+
+    def log_message(self, format, *args):
+        logger.Logger.get_logger().debug("Depot server: " + format % args)
@@ -1,4 +1,5 @@
 import unittest
+import sys
 import os
 import os.path
 import urllib
@@ -6,12 +7,33 @@ import tarfile
 import subprocess
 import shutil
 import json
+import httplib
+import cStringIO
+import threading
+import time
+import socket
 import logger
 
-from commons import CommonConsts, CommonUtils, ResourceNotFoundError
-from manifestutils import ManifestGenerator
+from commons import CommonConsts, CommonUtils, ResourceNotFoundError, ChecksumError, CyclicDependencyError, DepotFileNotFoundError, \
+    PackageInUseError
+from manifestutils import ManifestGenerator, ManifestFile
 from swdepot import SoftwareDepot
-from depinstall import PackageInstaller
+from depinstall import PackageInstaller, PipelinedPackageInstaller, PackageUninstaller
+from parallel import POOL_TYPE_PROCESS, POOL_TYPE_THREAD, WorkerPool, Pipeline
+from blobcache import BlobCache
+from verifier import InstallVerifier, VERIFY_MODE_QUICK, VERIFY_MODE_DEEP
+from transport import DepotHTTPServer, DepotRequestHandler, HttpTransport
+from packfile import PackfileIndex, PackfileExtractor
+from blobstore import BlobStore
+from blobcodec import BlobDecoder, encode_blob, CODEC_NONE, CODEC_ZLIB
+from metrics import Metrics, METRICS_TOTAL
+import benchmark
+from installplan import InstallPlanner, PLAN_ACTION_INSTALL, PLAN_ACTION_UPDATE, PLAN_ACTION_SKIP, SOURCE_PACK, SOURCE_CHUNKS
+from installdb import open_install_database
+from depotgc import get_depot_blobs, BLOB_STATUS_CORRUPT, DepotScrubber
+from v20daemon import VoltronDaemon
+import v20client
+import voltron20
 
 # directory paths from current directory
 DIR_UNITTEST_RT = os.path.join("/tmp", "v20unittestruntime")
@@ -32,6 +54,26 @@ SNAPPY_PLATFORM = "ubuntu-12.04"
 SNAPPY_MANIFEST_FILENAME = "snappy-1.0.5-ubuntu-12.04.json"
 SNAPPY_INSTALLDIR = DIR_INSTALL
 SNAPPY_INSTALDIR_ETC_MF = os.path.join(DIR_INSTALL, "etc", "packages", SNAPPY_MANIFEST_FILENAME)
+SNAPPY_PACKFILE = os.path.join(CommonConsts.SW_DEPOT_PACKS_DIR, "snappy-1.0.5-ubuntu-12.04.v20pack")
+
+class _TruncatingRequestHandler(DepotRequestHandler):
+    """Closes the connection halfway through the body of every request without a range."""
+
+    def do_GET(self):
+        if self.headers.getheader("Range"):
+            return DepotRequestHandler.do_GET(self)
+        with open(self._translate_path(self.path), "rb") as f:
+            data = f.read()
+        self.send_response(httplib.OK)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data[:len(data) // 2])
+        self.close_connection = 1
+
+def _set_refs(args):
+    package, sha1s = args
+    BlobStore(DIR_DEPOT).set_refs(package, sha1s)
+
 
 class BaseTestCase(unittest.TestCase):
 
@@ -130,6 +172,28 @@ class BaseTestCase(unittest.TestCase):
         sd = SoftwareDepot(DIR_DEPOT)
         sd.add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, os.path.join(DIR_DEPOT_TEMP))
 
+    def add_meta_package_to_depot(self, package_name, depends):
+        '''
+        Adds a package without files that only depends on the given (package name, version, platform) tuples.
+        '''
+        mfn = CommonUtils.generate_manifest_filename(package_name, SNAPPY_VERSION, SNAPPY_PLATFORM, "json")
+        manifest = {CommonConsts.MF_KEY_BUILD: [], CommonConsts.MF_KEY_DIRS: [], CommonConsts.MF_KEY_FILES: [],
+                    CommonConsts.MF_KEY_DEPENDS: [{CommonConsts.MF_KEY_DEPENDS_ATTR_PACKAGE: n, CommonConsts.MF_KEY_DEPENDS_ATTR_VERSION: v,
+                                                   CommonConsts.MF_KEY_DEPENDS_ATTR_PLATFORM: p,
+                                                   CommonConsts.MF_KEY_DEPENDS_ATTR_MANIFEST: CommonUtils.generate_manifest_filename(n, v, p, "json")}
+                                                  for n, v, p in depends]}
+        with open(os.path.join(DIR_DEPOT_TEMP, mfn), "w") as f:
+            json.dump(manifest, f)
+        sd = SoftwareDepot(DIR_DEPOT)
+        sd.add(package_name, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP)
+
+    def corrupt_depot_blob(self):
+        for dirpath, dirnames, files in os.walk(DIR_DEPOT_DATAFILES):
+            if files:
+                with open(os.path.join(dirpath, sorted(files)[0]), "wb") as f:
+                    f.write("corrupted")
+                return
+
 
 class ManifestTestCases(BaseTestCase):
     def test_genfile(self):
@@ -146,6 +210,36 @@ class ManifestTestCases(BaseTestCase):
         assert len(manifest[CommonConsts.MF_KEY_DIRS]) == 5
         assert len(manifest[CommonConsts.MF_KEY_FILES]) == 16
 
+    def test_genfile_hash_cache(self):
+        stage_dir = os.path.join(DIR_DEPOT_TEMP, "stage")
+        cache_file = os.path.join(DIR_DEPOT_TEMP, "stage.v20hashcache")
+        shutil.copytree(DIR_SNAPPY_STAGING, stage_dir)
+        for dirpath, dirnames, files in os.walk(stage_dir):
+            for file_ in files:
+                os.utime(os.path.join(dirpath, file_), (1000000000, 1000000000))
+        m = ManifestGenerator(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, stage_dir, None, cache_file)
+        m.generate_manifest()
+        with open(cache_file) as f:
+            cache = json.load(f)
+        assert len(cache["entries"]) == 16
+        # a cached entry with an unchanged stat is trusted without hashing the file again
+        path = os.path.join(stage_dir, "include", "snappy.h")
+        cache["entries"][path][3] = "cached"
+        with open(cache_file, "w") as f:
+            json.dump(cache, f)
+        manifest = json.loads(m.generate_manifest())
+        sha1s = dict((f_[CommonConsts.MF_KEY_FILES_ATTR_PATH], f_[CommonConsts.MF_KEY_FILES_ATTR_SHA1]) for f_ in manifest[CommonConsts.MF_KEY_FILES])
+        assert sha1s[os.path.join("include", "snappy.h")] == "cached"
+
+    def test_genfile_parallel_hashing(self):
+        serial = ManifestGenerator(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, None,
+                                   use_hash_cache=False, jobs=1).generate_manifest()
+        threads = ManifestGenerator(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, None,
+                                    use_hash_cache=False, jobs=4).generate_manifest()
+        processes = ManifestGenerator(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, None,
+                                      use_hash_cache=False, jobs=4, pool_type=POOL_TYPE_PROCESS).generate_manifest()
+        assert json.loads(serial) == json.loads(threads) == json.loads(processes)
+
     # Negative testing
     def test_genfile_when_stagingdir_notpresent(self):
         error = False
@@ -177,6 +271,245 @@ class SWDepoTestCases(BaseTestCase):
         assert not os.path.exists(os.path.join(DIR_DEPOT_MANIFESTFILES, SNAPPY_MANIFEST_FILENAME))
         assert not os.path.exists(os.path.join(DIR_DEPOT_DATAFILES, os.path.basename(SNAPPY_MANIFEST_FILENAME)))
 
+    def test_depot_shared_blobs(self):
+        self._add_snappy_to_depot()
+        ManifestGenerator(SNAPPY_PKG_NAME, "1.0.6", SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP).generate_manifest()
+        sd = SoftwareDepot(DIR_DEPOT)
+        sd.add(SNAPPY_PKG_NAME, "1.0.6", SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP)
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_DEPOT_DATAFILES) == 14
+        self._delete_snappy_from_depot()
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_DEPOT_DATAFILES) == 14
+        sd.delete(SNAPPY_PKG_NAME, "1.0.6", SNAPPY_PLATFORM)
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_DEPOT_DATAFILES) == 0
+
+    def test_depot_concurrent_refs(self):
+        store = BlobStore(DIR_DEPOT)
+        shared = "ab" * 20
+        CommonUtils.make_dirs(os.path.dirname(store.blob_path(shared)))
+        with open(store.blob_path(shared), "wb") as f:
+            f.write("shared")
+        packages = [("pkg{0}".format(i), [shared, "{0:040x}".format(i)]) for i in range(32)]
+        for pool_type in (POOL_TYPE_THREAD, POOL_TYPE_PROCESS):
+            WorkerPool(8, pool_type).map(_set_refs, packages)
+            assert BlobStore(DIR_DEPOT).get_refcount(shared) == 32
+            WorkerPool(8, pool_type).map(_set_refs, [(package, [shared]) for package, sha1s in packages[1:]])
+            WorkerPool(8, pool_type).map(_set_refs, [(package, []) for package, sha1s in packages[1:]])
+            assert BlobStore(DIR_DEPOT).get_refcount(shared) == 1 and store.has_blob(shared)
+            _set_refs((packages[0][0], []))
+            assert not store.has_blob(shared)
+            with open(store.blob_path(shared), "wb") as f:
+                f.write("shared")
+
+    def test_depot_add_compressed(self):
+        sd = SoftwareDepot(DIR_DEPOT)
+        sd.add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, compress=True)
+        with open(os.path.join(DIR_DEPOT_TEMP, SNAPPY_MANIFEST_FILENAME)) as f:
+            files = json.load(f)[CommonConsts.MF_KEY_FILES]
+        store = BlobStore(DIR_DEPOT)
+        compressed = 0
+        for file_ in files:
+            sha1 = file_[CommonConsts.MF_KEY_FILES_ATTR_SHA1]
+            with store.open_blob(sha1) as blob:
+                assert blob.size == os.path.getsize(os.path.join(DIR_SNAPPY_STAGING, file_[CommonConsts.MF_KEY_FILES_ATTR_PATH]))
+                if blob.codec != CODEC_NONE:
+                    compressed += 1
+                    assert os.path.getsize(store.blob_path(sha1)) < blob.size
+        assert compressed > 0
+
+    def test_blob_codec_magic_content(self):
+        src = os.path.join(DIR_DEPOT_TEMP, "magic")
+        with open(src, "wb") as f:
+            f.write("V20Z" + "x" * 1024)
+        for codec in (CODEC_NONE, CODEC_ZLIB):
+            stored = src + ".blob"
+            encode_blob(src, stored, codec)
+            out = os.path.join(DIR_DEPOT_TEMP, "decoded")
+            with open(out, "wb") as f:
+                decoder = BlobDecoder(f)
+                with open(stored, "rb") as blob:
+                    decoder.write(blob.read(3))
+                    decoder.write(blob.read())
+                decoder.close()
+            assert decoder.hexdigest() == CommonUtils.get_filehash(src)
+            assert CommonUtils.get_filehash(out) == CommonUtils.get_filehash(src)
+
+    def test_depot_add_parallel(self):
+        sd = SoftwareDepot(DIR_DEPOT, jobs=4, pool_type=POOL_TYPE_PROCESS)
+        sd.add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, compress=True)
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_DEPOT_DATAFILES) == 14
+
+    def test_depot_add_hardlink(self):
+        sd = SoftwareDepot(DIR_DEPOT, hardlink=True)
+        sd.add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP)
+        staged = os.path.join(DIR_SNAPPY_STAGING, "include", "snappy.h")
+        blob = BlobStore(DIR_DEPOT).blob_path(CommonUtils.get_filehash(staged))
+        assert os.stat(blob).st_ino == os.stat(staged).st_ino
+
+    # Negative testing
+    def test_depot_add_when_staged_file_modified(self):
+        staging = os.path.join(DIR_DEPOT_TEMP, "staging")
+        shutil.copytree(DIR_SNAPPY_STAGING, staging, symlinks=True)
+        with open(os.path.join(staging, "include", "snappy.h"), "a") as f:
+            f.write("modified")
+        error = False
+        try:
+            SoftwareDepot(DIR_DEPOT, jobs=4).add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP)
+        except ChecksumError as e:
+            error = True
+        assert error
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_DEPOT_DATAFILES) == 0
+        assert not SoftwareDepot(DIR_DEPOT).list()
+
+    def test_depot_add_failed_keeps_blobs_stored_meanwhile(self):
+        staging = os.path.join(DIR_DEPOT_TEMP, "staging")
+        shutil.copytree(DIR_SNAPPY_STAGING, staging, symlinks=True)
+        with open(os.path.join(staging, "include", "snappy.h"), "a") as f:
+            f.write("modified")
+        # another publisher stores a blob of the package after the add found it missing
+        shared = os.path.join(DIR_SNAPPY_STAGING, "lib", "libsnappy.la")
+        shared_sha1 = CommonUtils.get_filehash(shared)
+        BlobStore(DIR_DEPOT).put_blob(shared, shared_sha1)
+        has_blob = BlobStore.has_blob
+        asked = []
+        def has_blob_stored_meanwhile(store, sha1):
+            if sha1 == shared_sha1 and not asked:
+                asked.append(sha1)
+                return False
+            return has_blob(store, sha1)
+        BlobStore.has_blob = has_blob_stored_meanwhile
+        error = False
+        try:
+            SoftwareDepot(DIR_DEPOT, jobs=4).add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP)
+        except ChecksumError as e:
+            error = True
+        finally:
+            BlobStore.has_blob = has_blob
+        assert error
+        assert BlobStore(DIR_DEPOT).has_blob(shared_sha1)
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_DEPOT_DATAFILES) == 1
+
+    def test_depot_query(self):
+        self._add_snappy_to_depot()
+        self.add_meta_package_to_depot("snappy-tools", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        sd = SoftwareDepot(DIR_DEPOT)
+        assert len(sd.query(platform=SNAPPY_PLATFORM)) == 2
+        assert len(sd.query(platform="centos-6")) == 0
+        (snappy,) = sd.query(SNAPPY_PKG_NAME)
+        assert snappy["file_count"] == 16
+        assert snappy["total_size"] == sum(os.path.getsize(os.path.join(dirpath, f)) for dirpath, dirnames, files in os.walk(DIR_SNAPPY_STAGING) for f in files)
+        (tools,) = sd.query("snappy-tools", SNAPPY_VERSION, SNAPPY_PLATFORM)
+        assert [d[CommonConsts.MF_KEY_DEPENDS_ATTR_PACKAGE] for d in tools["depends"]] == [SNAPPY_PKG_NAME]
+        sd.delete("snappy-tools", SNAPPY_VERSION, SNAPPY_PLATFORM)
+        assert [r["package"] for r in sd.query()] == [SNAPPY_PKG_NAME]
+
+    def test_depot_reindex(self):
+        self._add_snappy_to_depot()
+        self.add_meta_package_to_depot("snappy-tools", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        expected = SoftwareDepot(DIR_DEPOT).query()
+        # a depot without an index is indexed from its manifests when it is first queried
+        os.remove(os.path.join(DIR_DEPOT, CommonConsts.SW_DEPOT_INDEX_FILE))
+        records = SoftwareDepot(DIR_DEPOT).query()
+        for r in expected + records:
+            del r["published"]
+        assert records == expected
+
+    def test_depot_reindex_version_with_dashes(self):
+        manifest = {CommonConsts.MF_KEY_BUILD: [], CommonConsts.MF_KEY_DIRS: [], CommonConsts.MF_KEY_FILES: []}
+        with open(os.path.join(DIR_DEPOT_TEMP, "libevent-2.0.11-stable-linux.json"), "w") as f:
+            json.dump(manifest, f)
+        sd = SoftwareDepot(DIR_DEPOT)
+        sd.add("libevent", "2.0.11-stable", "linux", DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP)
+        sd.reindex()
+        assert [(r["package"], r["version"], r["platform"]) for r in sd.query()] == [("libevent", "2.0.11-stable", "linux")]
+        # manifests published without a package record are indexed by their name
+        os.remove(os.path.join(DIR_DEPOT, CommonConsts.SW_DEPOT_PACKAGES_DIR, "libevent-2.0.11-stable-linux.json"))
+        sd.reindex()
+        assert [(r["package"], r["version"], r["platform"]) for r in sd.query()] == [("libevent", "2.0.11", "stable-linux")]
+        sd.delete("libevent", "2.0.11", "stable-linux")
+        assert not sd.query()
+
+    def test_depot_gc(self):
+        self._add_snappy_to_depot()
+        ManifestGenerator(SNAPPY_PKG_NAME, "1.0.6", SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP).generate_manifest()
+        ManifestGenerator(SNAPPY_PKG_NAME, "1.0.7", SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP).generate_manifest()
+        sd = SoftwareDepot(DIR_DEPOT)
+        sd.add(SNAPPY_PKG_NAME, "1.0.6", SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, pack=True)
+        sd.add(SNAPPY_PKG_NAME, "1.0.7", SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, pack=True)
+        # manifests overwritten or removed out of band leave references, packfiles and blobs behind
+        os.remove(os.path.join(DIR_DEPOT_MANIFESTFILES, "snappy-1.0.6-ubuntu-12.04.json"))
+        packs = os.path.join(DIR_DEPOT, CommonConsts.SW_DEPOT_PACKS_DIR)
+        for name in ("snappy-1.0.6-ubuntu-12.04.v20pack", "snappy-1.0.7-ubuntu-12.04.v20pack"):
+            os.utime(os.path.join(packs, name), (0, 0))
+        recipes = os.path.join(DIR_DEPOT, CommonConsts.SW_DEPOT_RECIPES_DIR)
+        CommonUtils.make_dirs(recipes)
+        for name in ("gone-1.0-linux.json", "adding-1.0-linux.json"):
+            with open(os.path.join(recipes, name), "wb") as f:
+                f.write("{}")
+        os.utime(os.path.join(recipes, "gone-1.0-linux.json"), (0, 0))
+        package_records = os.path.join(DIR_DEPOT, CommonConsts.SW_DEPOT_PACKAGES_DIR)
+        os.utime(os.path.join(package_records, "snappy-1.0.6-ubuntu-12.04.json"), (0, 0))
+        store = BlobStore(DIR_DEPOT)
+        old = store.blob_path("ab" * 20)
+        for path in (old, old + CommonConsts.TEMP_FILE_SUFFIX, store.blob_path("cd" * 20)):
+            CommonUtils.make_dirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write("orphan")
+        os.utime(old, (0, 0))
+        os.utime(old + CommonConsts.TEMP_FILE_SUFFIX, (0, 0))
+        missing = get_depot_blobs(DIR_DEPOT)[0]
+        os.remove(missing[1])
+
+        report = sd.gc(dry_run=True)
+        assert report["removed_blobs"] == ["ab" * 20]
+        assert os.path.exists(old)
+        report = sd.gc()
+        assert report["removed_blobs"] == ["ab" * 20]
+        assert len(report["removed_temp_files"]) == 1
+        assert report["removed_packs"] == ["snappy-1.0.6-ubuntu-12.04.v20pack"]
+        assert os.path.exists(os.path.join(packs, "snappy-1.0.7-ubuntu-12.04.v20pack"))
+        assert report["removed_recipes"] == ["gone-1.0-linux.json"]
+        assert os.path.exists(os.path.join(recipes, "adding-1.0-linux.json"))
+        assert report["removed_package_records"] == ["snappy-1.0.6-ubuntu-12.04.json"]
+        assert os.path.exists(os.path.join(package_records, "snappy-1.0.7-ubuntu-12.04.json"))
+        assert report["missing_blobs"] == [missing[0]]
+        assert report["bytes_freed"] > 12
+        assert not os.path.exists(os.path.dirname(old))
+        assert os.path.exists(store.blob_path("cd" * 20))
+        assert sd.gc(min_age=0)["removed_blobs"] == ["cd" * 20]
+        assert store.get_refs("snappy-1.0.6-ubuntu-12.04") == set()
+        assert store.get_refcount(get_depot_blobs(DIR_DEPOT)[0][0]) == 2
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_DEPOT_DATAFILES) == 13
+
+    def test_depot_scrub(self):
+        SoftwareDepot(DIR_DEPOT).add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, compress=True)
+        self.corrupt_depot_blob()
+        store = BlobStore(DIR_DEPOT)
+        sd = SoftwareDepot(DIR_DEPOT, jobs=4)
+        report = sd.scrub(io_budget=100 * 1024 * 1024, limit=5)
+        assert not report["complete"]
+        assert report["checked"] == 5
+        assert os.path.exists(os.path.join(DIR_DEPOT, CommonConsts.DEPOT_SCRUB_CHECKPOINT_FILE))
+        report = sd.scrub()
+        assert report["complete"]
+        assert report["checked"] == 14
+        assert [open(store.blob_path(sha1)).read() for sha1 in report[BLOB_STATUS_CORRUPT]] == ["corrupted"]
+        assert not report["ok"]
+        assert not os.path.exists(os.path.join(DIR_DEPOT, CommonConsts.DEPOT_SCRUB_CHECKPOINT_FILE))
+        assert sd.scrub(resume=False)["checked"] == 14
+
+    def test_depot_scrub_budget_counts_stored_bytes(self):
+        SoftwareDepot(DIR_DEPOT).add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, compress=True)
+        scrubber = DepotScrubber(DIR_DEPOT, io_budget=100 * 1024 * 1024)
+        consume = scrubber._throttle.consume
+        charged = []
+        def counting_consume(n):
+            charged.append(n)
+            consume(n)
+        scrubber._throttle.consume = counting_consume
+        report = scrubber.scrub(resume=False)
+        stored = sum(os.path.getsize(path) for sha1, path in get_depot_blobs(DIR_DEPOT))
+        assert sum(charged) == stored < report["bytes"]
+
     def test_depot_list(self):
         self._add_snappy_to_depot()
         sd = SoftwareDepot(DIR_DEPOT)
@@ -210,6 +543,68 @@ class SWDepoTestCases(BaseTestCase):
         sd = SoftwareDepot(DIR_DEPOT)
         sd.list()
 
+class VerifyTestCases(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.generate_manifest_file()
+        self.add_snappy_to_depot()
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        self.package = os.path.splitext(SNAPPY_MANIFEST_FILENAME)[0]
+
+    def test_verify_clean(self):
+        report = InstallVerifier(DIR_INSTALL, jobs=4).verify()
+        assert report["ok"]
+        assert report["packages"][self.package]["files"] == 16
+
+    def test_verify_changes(self):
+        os.remove(os.path.join(DIR_INSTALL, "include", "snappy.h"))
+        os.chmod(os.path.join(DIR_INSTALL, "include", "snappy-c.h"), 0600)
+        with open(os.path.join(DIR_INSTALL, "lib", "libsnappy.la"), "w") as f:
+            f.write("modified content")
+        result = InstallVerifier(DIR_INSTALL, jobs=4).verify()["packages"][self.package]
+        assert not result["ok"]
+        assert result["missing"] == [os.path.join("include", "snappy.h")]
+        assert result["mode_changed"] == [os.path.join("include", "snappy-c.h")]
+        assert result["modified"] == [os.path.join("lib", "libsnappy.la")]
+
+    def test_verify_deep(self):
+        path = os.path.join(DIR_INSTALL, "include", "snappy.h")
+        os.utime(path, (1000000000, 1000000000))
+        # reinstalling records the new mtime in the install snapshot
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        with open(path, "r+") as f:
+            f.write("X")
+        os.utime(path, (1000000000, 1000000000))
+        assert InstallVerifier(DIR_INSTALL, mode=VERIFY_MODE_QUICK).verify()["ok"]
+        assert not InstallVerifier(DIR_INSTALL, mode=VERIFY_MODE_DEEP).verify()["ok"]
+
+
+class BinaryManifestTestCases(BaseTestCase):
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        m = ManifestGenerator(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP,
+                              manifest_format=CommonConsts.MF_EXT_BINARY)
+        m.generate_manifest()
+        self.mf_path = os.path.join(DIR_DEPOT_TEMP, CommonUtils.generate_manifest_filename(SNAPPY_PKG_NAME, SNAPPY_VERSION,
+                                                                                           SNAPPY_PLATFORM, CommonConsts.MF_EXT_BINARY))
+
+    def test_binary_manifest(self):
+        json_manifest = json.loads(ManifestGenerator(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, None).generate_manifest())
+        manifest = ManifestFile.load_file(self.mf_path)
+        assert set(json_manifest) == set(manifest)
+        assert manifest[CommonConsts.MF_KEY_DIRS] == json_manifest[CommonConsts.MF_KEY_DIRS]
+        files = sorted(json_manifest[CommonConsts.MF_KEY_FILES], key=lambda f: f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        assert list(manifest[CommonConsts.MF_KEY_FILES]) == files
+        assert manifest.find_file(files[3][CommonConsts.MF_KEY_FILES_ATTR_PATH]) == files[3]
+        assert manifest.find_file("missing") is None
+
+    def test_install_binary_manifest(self):
+        self.add_snappy_to_depot()
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4).install()
+        assert os.path.exists(os.path.join(DIR_INSTALL, "etc", "packages", os.path.basename(self.mf_path)))
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 19
+
+
 class PackageInstallTestCases(BaseTestCase):
 
     def setUp(self):
@@ -221,14 +616,709 @@ class PackageInstallTestCases(BaseTestCase):
         PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
 
         assert os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
-        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 17
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 19
 
     def test_install_update(self):
         PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
         assert os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
         PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
         assert os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
-        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 17
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 19
+
+    def test_install_update_delta(self):
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        with open(SNAPPY_INSTALDIR_ETC_MF) as f:
+            installed = json.load(f)
+        first = installed[CommonConsts.MF_KEY_FILES][0]
+        mode = first[CommonConsts.MF_KEY_FILES_ATTR_MODE]
+        first[CommonConsts.MF_KEY_FILES_ATTR_MODE] = "0600"
+        os.chmod(os.path.join(DIR_INSTALL, first[CommonConsts.MF_KEY_FILES_ATTR_PATH]), 0600)
+        with open(SNAPPY_INSTALDIR_ETC_MF, "w") as f:
+            json.dump(installed, f)
+        mf_path = os.path.join(DIR_DEPOT_TEMP, SNAPPY_MANIFEST_FILENAME)
+        with open(mf_path) as f:
+            manifest = json.load(f)
+        removed = manifest[CommonConsts.MF_KEY_FILES].pop()
+        with open(mf_path, "w") as f:
+            json.dump(manifest, f)
+        SoftwareDepot(DIR_DEPOT).update(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP)
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        assert not os.path.exists(os.path.join(DIR_INSTALL, removed[CommonConsts.MF_KEY_FILES_ATTR_PATH]))
+        assert CommonUtils.get_filepermission(os.path.join(DIR_INSTALL, first[CommonConsts.MF_KEY_FILES_ATTR_PATH])) == mode
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 18
+
+    def test_install_update_verify(self):
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        with open(os.path.join(DIR_SNAPPY_STAGING, "include", "snappy.h")) as f:
+            contents = f.read()
+        modified = os.path.join(DIR_INSTALL, "include", "snappy.h")
+        with open(modified, "w") as f:
+            f.write("modified")
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        with open(modified) as f:
+            assert f.read() == "modified"
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, verify=True).install()
+        with open(modified) as f:
+            assert f.read() == contents
+
+    def test_install_resume(self):
+        fetch_file = PackageInstaller._fetch_file
+        fetched = []
+        limit = [5]
+        def interrupted_fetch_file(installer, f, destfile):
+            if len(fetched) == limit[0]:
+                raise IOError("Connection reset")
+            fetched.append(f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+            return fetch_file(installer, f, destfile)
+        PackageInstaller._fetch_file = interrupted_fetch_file
+        try:
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, use_packs=False).install()
+        except IOError:
+            pass
+        finally:
+            PackageInstaller._fetch_file = fetch_file
+        assert not os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+        assert os.path.exists(os.path.join(DIR_INSTALL, "etc", "packages", "snappy-1.0.5-ubuntu-12.04.v20journal"))
+        limit[0] = 10
+        PackageInstaller._fetch_file = interrupted_fetch_file
+        try:
+            # the files fetched before the interruption are not fetched again
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, use_packs=False).install()
+        except IOError:
+            pass
+        finally:
+            PackageInstaller._fetch_file = fetch_file
+        assert len(set(fetched)) == len(fetched) == 10
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, use_packs=False).install()
+        assert not os.path.exists(os.path.join(DIR_INSTALL, "etc", "packages", "snappy-1.0.5-ubuntu-12.04.v20journal"))
+        assert InstallVerifier(DIR_INSTALL, mode=VERIFY_MODE_DEEP).verify()["ok"]
+
+    # Negative testing
+    def test_install_update_rollback(self):
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        with open(SNAPPY_INSTALDIR_ETC_MF) as f:
+            installed = json.load(f)
+        # the update replaces a file with a corrupted depot blob and removes a file the new manifest does not list
+        changed = installed[CommonConsts.MF_KEY_FILES][0]
+        changed_path = os.path.join(DIR_INSTALL, changed[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        changed_sha1 = CommonUtils.get_filehash(changed_path)
+        changed[CommonConsts.MF_KEY_FILES_ATTR_SHA1] = "0" * 40
+        extra_path = os.path.join(DIR_INSTALL, "extra")
+        with open(extra_path, "w") as f:
+            f.write("extra")
+        installed[CommonConsts.MF_KEY_FILES].append({CommonConsts.MF_KEY_FILES_ATTR_PATH: "extra", CommonConsts.MF_KEY_FILES_ATTR_SHA1: "0" * 40,
+                                                     CommonConsts.MF_KEY_FILES_ATTR_MODE: "0644"})
+        with open(SNAPPY_INSTALDIR_ETC_MF, "w") as f:
+            json.dump(installed, f)
+        with open(os.path.join(DIR_DEPOT_DATAFILES, CommonUtils.generate_blob_path(changed_sha1)), "wb") as f:
+            f.write("corrupted")
+        error = False
+        try:
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        except ChecksumError as e:
+            error = True
+        assert error
+        assert CommonUtils.get_filehash(changed_path) == changed_sha1
+        assert os.path.exists(extra_path)
+        assert not os.path.exists(os.path.join(DIR_INSTALL, "etc", "packages", "snappy-1.0.5-ubuntu-12.04.v20journal"))
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 20
+
+    # Negative testing
+    def test_install_rollback_after_crash_in_backup(self):
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        with open(SNAPPY_INSTALDIR_ETC_MF) as f:
+            installed = json.load(f)
+        changed = installed[CommonConsts.MF_KEY_FILES][0]
+        changed_path = os.path.join(DIR_INSTALL, changed[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        changed_sha1 = CommonUtils.get_filehash(changed_path)
+        changed[CommonConsts.MF_KEY_FILES_ATTR_SHA1] = "0" * 40
+        with open(SNAPPY_INSTALDIR_ETC_MF, "w") as f:
+            json.dump(installed, f)
+        # the update crashes right after moving the file it replaces to its backup name
+        backup_file = PackageInstaller._backup_file
+        def crashing_backup_file(installer, path, rel_path):
+            backup_file(installer, path, rel_path)
+            raise IOError("Crashed")
+        PackageInstaller._backup_file = crashing_backup_file
+        try:
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        except IOError:
+            pass
+        finally:
+            PackageInstaller._backup_file = backup_file
+        assert not os.path.exists(changed_path)
+        assert os.path.exists(changed_path + CommonConsts.BACKUP_FILE_SUFFIX)
+        # the resumed update fails and is rolled back, restoring the file from the backup the crash left
+        with open(os.path.join(DIR_DEPOT_DATAFILES, CommonUtils.generate_blob_path(changed_sha1)), "wb") as f:
+            f.write("corrupted")
+        error = False
+        try:
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        except ChecksumError as e:
+            error = True
+        assert error
+        assert CommonUtils.get_filehash(changed_path) == changed_sha1
+        assert not os.path.exists(changed_path + CommonConsts.BACKUP_FILE_SUFFIX)
+        assert not os.path.exists(os.path.join(DIR_INSTALL, "etc", "packages", "snappy-1.0.5-ubuntu-12.04.v20journal"))
+
+    def test_install_blob_cache(self):
+        cache = BlobCache(os.path.join(DIR_DEPOT_TEMP, "cache"))
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, blob_cache=cache).install()
+        assert cache.misses == 14
+        # the second install root is served from the cache without reading the depot blobs
+        self.corrupt_depot_blob()
+        root2 = os.path.join(DIR_UNITTEST_RT, "v20install2")
+        try:
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, root2, DIR_DEPOT, blob_cache=cache).install()
+            assert cache.misses == 14
+            assert CommonUtils.get_filecount_for_dir_tree(root2) == 19
+        finally:
+            shutil.rmtree(root2)
+
+    def test_blob_cache_materialize(self):
+        cache = BlobCache(os.path.join(DIR_DEPOT_TEMP, "cache"))
+        src = os.path.join(DIR_SNAPPY_STAGING, "lib", "libsnappy.la")
+        sha1 = CommonUtils.get_filehash(src)
+        cache.add(sha1, src)
+        dest = os.path.join(DIR_DEPOT_TEMP, "materialized")
+        # the entry is hashed while it is copied, not read a second time to verify it
+        get_filehash = CommonUtils.__dict__["get_filehash"]
+        CommonUtils.get_filehash = staticmethod(lambda *args: self.fail("cache entry hashed separately"))
+        try:
+            assert cache.materialize(sha1, dest) == os.path.getsize(src)
+            with open(cache.blob_path(sha1), "ab") as f:
+                f.write("corrupted")
+            assert cache.materialize(sha1, dest) is None
+        finally:
+            CommonUtils.get_filehash = get_filehash
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert not os.path.exists(cache.blob_path(sha1))
+        assert not os.path.exists(dest)
+
+    def test_install_blob_cache_modes(self):
+        staging = os.path.join(DIR_DEPOT, "modes")
+        CommonUtils.make_dirs(os.path.join(staging, "bin"))
+        for name, mode in (("a", 0755), ("b", 0644)):
+            with open(os.path.join(staging, "bin", name), "wb") as f:
+                f.write("#!/bin/sh\n")
+            os.chmod(os.path.join(staging, "bin", name), mode)
+        ManifestGenerator("modes", "1.0", SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP).generate_manifest()
+        SoftwareDepot(DIR_DEPOT).add("modes", "1.0", SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP)
+        cache = BlobCache(os.path.join(DIR_DEPOT_TEMP, "cache"))
+        root2 = os.path.join(DIR_INSTALL, "root2")
+        for root in (os.path.join(DIR_INSTALL, "root1"), root2):
+            PackageInstaller("modes", "1.0", SNAPPY_PLATFORM, root, DIR_DEPOT, blob_cache=cache).install()
+        assert cache.hits == 3
+        inodes = set()
+        for root in (os.path.join(DIR_INSTALL, "root1"), root2):
+            for name, mode in (("a", 0755), ("b", 0644)):
+                st = os.stat(os.path.join(root, "bin", name))
+                assert st.st_mode & 07777 == mode and st.st_nlink == 1
+                inodes.add(st.st_ino)
+        assert len(inodes) == 4
+        with open(os.path.join(root2, "bin", "a"), "ab") as f:
+            f.write("changed in place")
+        sha1 = CommonUtils.get_filehash(os.path.join(staging, "bin", "a"))
+        assert CommonUtils.get_filehash(cache.blob_path(sha1)) == sha1
+
+    def test_install_parallel(self):
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4).install()
+        assert os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 19
+
+    # Negative testing
+    def test_install_parallel_when_blob_corrupted(self):
+        self.corrupt_depot_blob()
+        error = False
+        try:
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4).install()
+        except ChecksumError as e:
+            error = True
+        assert error
+        assert not os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+
+    def test_install_dependencies(self):
+        self.add_meta_package_to_depot("snappy-tools", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM),
+                                                       ("snappy-tools", SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        PackageInstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4, dep_jobs=2).install()
+        assert os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 23
+
+    def test_install_packfile(self):
+        SoftwareDepot(DIR_DEPOT).update(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, pack=True)
+        # the blobs come from the packfile, not from the corrupted loose blob
+        self.corrupt_depot_blob()
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4).install()
+        assert os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 19
+
+    def test_install_packfile_corrupted(self):
+        SoftwareDepot(DIR_DEPOT).update(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, pack=True)
+        with open(os.path.join(DIR_DEPOT, SNAPPY_PACKFILE), "r+b") as f:
+            f.seek(-64, os.SEEK_END)
+            f.write("corrupted" * 4)
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4).install()
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 19
+
+    def test_packfile_ranged_reads(self):
+        SoftwareDepot(DIR_DEPOT).update(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, pack=True)
+        server = self.start_depot_server()
+        transport = HttpTransport(server.get_url())
+        try:
+            index = PackfileIndex.read(transport, SNAPPY_PACKFILE)
+            assert len(index) == 14
+            with open(os.path.join(DIR_DEPOT_TEMP, SNAPPY_MANIFEST_FILENAME)) as f:
+                files = json.load(f)[CommonConsts.MF_KEY_FILES]
+            entry = index.get(files[-1][CommonConsts.MF_KEY_FILES_ATTR_SHA1])
+            extractor = PackfileExtractor([entry], entry.offset, lambda sha1: os.path.join(DIR_DEPOT_TEMP, sha1))
+            transport.fetch(SNAPPY_PACKFILE, extractor, entry.offset, entry.stored_length)
+            extractor.close()
+        finally:
+            transport.close()
+            server.shutdown()
+            server.server_close()
+        assert extractor.extracted == [entry.sha1]
+        assert CommonUtils.get_filehash(os.path.join(DIR_DEPOT_TEMP, entry.sha1)) == entry.sha1
+
+    def test_install_compressed_blobs(self):
+        SoftwareDepot(DIR_DEPOT).delete(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)
+        SoftwareDepot(DIR_DEPOT).add(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, compress=True)
+        server = self.start_depot_server()
+        try:
+            PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, server.get_url(), jobs=4).install()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 19
+        assert InstallVerifier(DIR_INSTALL, mode=VERIFY_MODE_DEEP).verify()["ok"]
+
+    def test_install_metrics(self):
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        metrics = Metrics(trace=True)
+        PackageInstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4, metrics=metrics).install()
+        stats = metrics.to_dict()["packages"]
+        snappy = stats[os.path.splitext(SNAPPY_MANIFEST_FILENAME)[0]]
+        assert snappy["counters"]["files_installed"] == 16
+        assert snappy["phases"]["fetch"]["count"] == 16
+        assert snappy["phases"]["fetch"]["bytes"] == stats[METRICS_TOTAL]["phases"]["fetch"]["bytes"] > 0
+        assert "resolve" in stats["snappy-deps-1.0.5-ubuntu-12.04"]["phases"]
+        assert "snappy" in metrics.format_summary()
+        trace_file = os.path.join(DIR_DEPOT_TEMP, "trace.json")
+        metrics.write_trace(trace_file)
+        with open(trace_file) as f:
+            events = json.load(f)["traceEvents"]
+        assert len([e for e in events if e["name"] == "fetch"]) == 16
+
+    def test_install_pipelined(self):
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        server = self.start_depot_server()
+        try:
+            PipelinedPackageInstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, server.get_url(), jobs=4, dep_jobs=2).install()
+            with open(SNAPPY_INSTALDIR_ETC_MF) as f:
+                first = json.load(f)[CommonConsts.MF_KEY_FILES][0]
+            with open(os.path.join(DIR_INSTALL, first[CommonConsts.MF_KEY_FILES_ATTR_PATH]), "a") as f:
+                f.write("modified")
+            PipelinedPackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, server.get_url(), jobs=4, verify=True).install()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 21
+        assert InstallVerifier(DIR_INSTALL, mode=VERIFY_MODE_DEEP).verify()["ok"]
+
+    # Negative testing
+    def test_install_pipelined_cyclic_dependencies(self):
+        self.add_meta_package_to_depot("snappy-a", [("snappy-b", SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        self.add_meta_package_to_depot("snappy-b", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM),
+                                                    ("snappy-a", SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        error = False
+        try:
+            PipelinedPackageInstaller("snappy-a", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, dep_jobs=2).install()
+        except CyclicDependencyError as e:
+            error = True
+        assert error
+        assert not os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+
+    def test_pipeline_stages(self):
+        results = Pipeline([(lambda x: x * 2, 3), (lambda x: x + 1 if x % 4 else None, 2)], queue_size=2).run(xrange(100))
+        assert sorted(results) == [x * 2 + 1 for x in xrange(100) if x % 2]
+
+    # Negative testing
+    def test_pipeline_cancelled_on_error(self):
+        processed = []
+
+        def fail(x):
+            if x == 10:
+                raise ValueError("stage failed")
+            processed.append(x)
+            return x
+
+        error = False
+        try:
+            Pipeline([(fail, 2), (lambda x: x, 1)], queue_size=1).run(xrange(100000))
+        except ValueError:
+            error = True
+        assert error
+        assert len(processed) < 1000
+
+    def test_install_plan(self):
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        server = self.start_depot_server()
+        try:
+            plan = InstallPlanner("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, server.get_url(), jobs=4, dep_jobs=2).plan()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert CommonUtils.get_filecount_for_dir_tree(DIR_INSTALL) == 0
+        assert [(p["package"], p["action"]) for p in plan["packages"]] == [("snappy-1.0.5-ubuntu-12.04", PLAN_ACTION_INSTALL),
+                                                                          ("snappy-deps-1.0.5-ubuntu-12.04", PLAN_ACTION_INSTALL)]
+        with open(os.path.join(DIR_DEPOT_TEMP, SNAPPY_MANIFEST_FILENAME)) as f:
+            files = json.load(f)[CommonConsts.MF_KEY_FILES]
+        blob_size = lambda f: os.path.getsize(os.path.join(DIR_DEPOT_DATAFILES, CommonUtils.generate_blob_path(f[CommonConsts.MF_KEY_FILES_ATTR_SHA1])))
+        assert plan["totals"]["files_to_fetch"] == 16
+        assert plan["totals"]["unique_blobs_to_fetch"] == 14
+        assert plan["totals"]["bytes_to_transfer"] == sum(blob_size(f) for f in files)
+        assert plan["concurrency"] == {"packages": 1, "file_workers": 4, "connections": 4}
+        assert not plan["noop"]
+        assert "16 files to fetch" in InstallPlanner.format_plan(plan)
+
+        PackageInstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        plan = InstallPlanner("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).plan()
+        assert plan["noop"]
+        assert plan["packages"][0]["action"] == PLAN_ACTION_SKIP
+
+    def test_install_plan_update(self):
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        mf_path = os.path.join(DIR_DEPOT_TEMP, SNAPPY_MANIFEST_FILENAME)
+        with open(mf_path) as f:
+            manifest = json.load(f)
+        removed = manifest[CommonConsts.MF_KEY_FILES].pop()
+        with open(mf_path, "w") as f:
+            json.dump(manifest, f)
+        SoftwareDepot(DIR_DEPOT).update(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP, pack=True)
+        os.remove(os.path.join(DIR_INSTALL, manifest[CommonConsts.MF_KEY_FILES][0][CommonConsts.MF_KEY_FILES_ATTR_PATH]))
+        plan = InstallPlanner(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, verify=True).plan()
+        package = plan["packages"][0]
+        assert package["action"] == PLAN_ACTION_UPDATE
+        assert package["remove"] == [removed[CommonConsts.MF_KEY_FILES_ATTR_PATH]]
+        assert [fetch["path"] for fetch in package["fetch"]] == [manifest[CommonConsts.MF_KEY_FILES][0][CommonConsts.MF_KEY_FILES_ATTR_PATH]]
+        assert len(package["verify"]) == 14
+
+        shutil.rmtree(DIR_INSTALL)
+        os.mkdir(DIR_INSTALL)
+        plan = InstallPlanner(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).plan()
+        package = plan["packages"][0]
+        assert set(fetch["source"] for fetch in package["fetch"]) == set([SOURCE_PACK])
+        assert package["pack_reads"] == 1
+        assert plan["totals"]["bytes_to_transfer"] == os.path.getsize(os.path.join(DIR_DEPOT, SNAPPY_PACKFILE))
+
+    def test_install_database(self):
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        PackageInstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, jobs=4).install()
+        with open(SNAPPY_INSTALDIR_ETC_MF) as f:
+            files = json.load(f)[CommonConsts.MF_KEY_FILES]
+        install_db = open_install_database(DIR_INSTALL)
+        snappy = os.path.splitext(SNAPPY_MANIFEST_FILENAME)[0]
+        records = install_db.files(snappy)
+        assert [(r["path"], r["sha1"]) for r in records] == sorted((f[CommonConsts.MF_KEY_FILES_ATTR_PATH], f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]) for f in files)
+        assert install_db.packages() == ["snappy-1.0.5-ubuntu-12.04", "snappy-deps-1.0.5-ubuntu-12.04"]
+        assert install_db.dependents(snappy) == ["snappy-deps-1.0.5-ubuntu-12.04"]
+        path = files[0][CommonConsts.MF_KEY_FILES_ATTR_PATH]
+        assert install_db.owners([path, "missing"]) == {path: records[[r["path"] for r in records].index(path)]}
+        assert [r["path"] for r in install_db.conflicts("other", [path, "missing"])] == [path]
+        assert install_db.conflicts(snappy, [path]) == []
+
+        os.remove(os.path.join(DIR_INSTALL, CommonConsts.INSTALL_ETC_PACKAGES_DIR, CommonConsts.INSTALL_DB_FILE))
+        assert open_install_database(DIR_INSTALL).files(snappy) == records
+
+    def test_uninstall(self):
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        PackageInstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        error = False
+        try:
+            PackageUninstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL).uninstall()
+        except PackageInUseError as e:
+            error = True
+        assert error
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 21
+        assert PackageUninstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL).uninstall() == 0
+        assert PackageUninstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL).uninstall() == 16
+        assert open_install_database(DIR_INSTALL).packages() == []
+        assert sorted(os.listdir(DIR_INSTALL)) == ["etc"]
+        assert os.listdir(os.path.join(DIR_INSTALL, CommonConsts.INSTALL_ETC_PACKAGES_DIR)) == [CommonConsts.INSTALL_DB_FILE]
+
+    # Negative testing
+    def test_uninstall_not_installed(self):
+        error = False
+        try:
+            PackageUninstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL).uninstall()
+        except ResourceNotFoundError as e:
+            error = True
+        assert error
+
+    def test_install_conflict_takeover(self):
+        shutil.copy(os.path.join(DIR_DEPOT_TEMP, SNAPPY_MANIFEST_FILENAME), os.path.join(DIR_DEPOT_TEMP, "snappy-fork-1.0.5-ubuntu-12.04.json"))
+        SoftwareDepot(DIR_DEPOT).add("snappy-fork", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_SNAPPY_STAGING, DIR_DEPOT_TEMP)
+        PackageInstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        PackageInstaller("snappy-fork", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT).install()
+        install_db = open_install_database(DIR_INSTALL)
+        assert install_db.files("snappy-1.0.5-ubuntu-12.04") == []
+        assert len(install_db.files("snappy-fork-1.0.5-ubuntu-12.04")) == 16
+        assert PackageUninstaller(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL).uninstall() == 0
+        assert InstallVerifier(DIR_INSTALL, mode=VERIFY_MODE_DEEP).verify()["ok"]
+
+    def test_install_chunked(self):
+        content = os.urandom(3 * 1024 * 1024)
+        for version, data in (("1.0", content), ("1.1", content[:1000000] + "patched" + content[1000100:])):
+            staging = os.path.join(DIR_DEPOT, "big-" + version)
+            CommonUtils.make_dirs(os.path.join(staging, "lib"))
+            with open(os.path.join(staging, "lib", "libbig.so"), "wb") as f:
+                f.write(data)
+            with open(os.path.join(staging, "lib", "VERSION"), "wb") as f:
+                f.write(version)
+            ManifestGenerator("big", version, SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP).generate_manifest()
+            SoftwareDepot(DIR_DEPOT, jobs=2).add("big", version, SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP, compress=True, chunk=True)
+        sha1 = CommonUtils.get_filehash(os.path.join(DIR_DEPOT, "big-1.1", "lib", "libbig.so"))
+        assert not BlobStore(DIR_DEPOT).has_blob(sha1)
+        assert os.path.exists(os.path.join(DIR_DEPOT, CommonConsts.SW_DEPOT_RECIPES_DIR, "big-1.1-ubuntu-12.04.json"))
+
+        metrics = Metrics()
+        PackageInstaller("big", "1.0", SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, metrics=metrics).install()
+        first = metrics.to_dict()["packages"]["big-1.0-ubuntu-12.04"]
+        assert first["phases"]["fetch"]["bytes"] >= len(content)
+        metrics = Metrics()
+        PackageInstaller("big", "1.1", SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, metrics=metrics).install()
+        second = metrics.to_dict()["packages"]["big-1.1-ubuntu-12.04"]
+        assert second["counters"]["chunks_reused"] > second["counters"]["chunks_fetched"]
+        assert second["phases"]["fetch"]["bytes"] < len(content) / 4
+        assert CommonUtils.get_filehash(os.path.join(DIR_INSTALL, "lib", "libbig.so")) == sha1
+        assert InstallVerifier(DIR_INSTALL, mode=VERIFY_MODE_DEEP).verify(["big-1.1-ubuntu-12.04"])["ok"]
+
+        sd = SoftwareDepot(DIR_DEPOT)
+        sd.delete("big", "1.0", SNAPPY_PLATFORM)
+        report = sd.gc(min_age=0)
+        assert report["removed_blobs"] == [] and report["missing_blobs"] == []
+        root2 = os.path.join(DIR_INSTALL, "root2")
+        plan = InstallPlanner("big", "1.1", SNAPPY_PLATFORM, root2, DIR_DEPOT).plan()
+        (fetch,) = [fetch for fetch in plan["packages"][0]["fetch"] if fetch["source"] == SOURCE_CHUNKS]
+        assert fetch["reused_chunks"] == 0
+        assert 0 < fetch["bytes"] <= plan["totals"]["bytes_to_transfer"]
+        PackageInstaller("big", "1.1", SNAPPY_PLATFORM, root2, DIR_DEPOT, use_packs=False).install()
+        assert CommonUtils.get_filehash(os.path.join(root2, "lib", "libbig.so")) == sha1
+
+    def test_install_http_depot(self):
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        server = self.start_depot_server()
+        try:
+            PackageInstaller("snappy-deps", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, server.get_url(), jobs=4, dep_jobs=2).install()
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 21
+
+    # Negative testing
+    def test_http_depot_file_not_found(self):
+        server = self.start_depot_server()
+        transport = HttpTransport(server.get_url(), retries=0)
+        error = False
+        try:
+            transport.read(os.path.join(CommonConsts.SW_DEPOT_MANIFEST_FILE_DIR, "missing.json"))
+        except DepotFileNotFoundError as e:
+            error = True
+        finally:
+            transport.close()
+            server.shutdown()
+            server.server_close()
+        assert error
+
+    def test_http_depot_ranges(self):
+        path = os.path.join(DIR_DEPOT, "ranges.bin")
+        with open(path, "wb") as f:
+            f.write("0123456789")
+        server = self.start_depot_server()
+        conn = httplib.HTTPConnection(*server.server_address[:2])
+        responses = []
+        try:
+            for byte_range in ("bytes=2-4", "bytes=7-", "bytes=-3", "bytes=-20", "bytes=4-2", "bytes=10-", "bytes=12-15", "bytes=-0"):
+                conn.request("GET", "/ranges.bin", headers={"Range": byte_range})
+                response = conn.getresponse()
+                responses.append((response.status, response.getheader("Content-Range"), response.read()))
+        finally:
+            conn.close()
+            server.shutdown()
+            server.server_close()
+            os.remove(path)
+        assert responses[:5] == [(206, "bytes 2-4/10", "234"), (206, "bytes 7-9/10", "789"), (206, "bytes 7-9/10", "789"),
+                                 (206, "bytes 0-9/10", "0123456789"), (200, None, "0123456789")]
+        assert responses[5:] == [(416, "bytes */10", "")] * 3
+
+    def test_http_depot_resume_truncated(self):
+        path = os.path.join(DIR_DEPOT, "truncated.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(200000))
+        server = self.start_depot_server()
+        server.RequestHandlerClass = _TruncatingRequestHandler
+        transport = HttpTransport(server.get_url(), backoff=0)
+        try:
+            result = transport.fetch("truncated.bin", cStringIO.StringIO())
+        finally:
+            transport.close()
+            server.shutdown()
+            server.server_close()
+        assert result == (200000, CommonUtils.get_filehash(path))
+        os.remove(path)
+
+    def start_depot_server(self):
+        server = DepotHTTPServer(DIR_DEPOT, port=0)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return server
+
+    # Negative testing
+    def test_install_cyclic_dependencies(self):
+        self.add_meta_package_to_depot("snappy-a", [("snappy-b", SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        self.add_meta_package_to_depot("snappy-b", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM),
+                                                    ("snappy-a", SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        error = False
+        try:
+            PackageInstaller("snappy-a", SNAPPY_VERSION, SNAPPY_PLATFORM, DIR_INSTALL, DIR_DEPOT, dep_jobs=2).install()
+        except CyclicDependencyError as e:
+            error = True
+        assert error
+        assert not os.path.exists(SNAPPY_INSTALDIR_ETC_MF)
+
+
+class DaemonTestCases(BaseTestCase):
+
+    def setUp(self):
+        BaseTestCase.setUp(self)
+        self.generate_manifest_file()
+        self.add_snappy_to_depot()
+        self.socket_path = os.path.join(DIR_UNITTEST_RT, "v20daemon.sock")
+        self.daemon = VoltronDaemon(self.socket_path, voltron20._build_parser(), voltron20._run)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        for i in range(500):
+            try:
+                v20client.connect(self.socket_path).close()
+                break
+            except socket.error:
+                time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join(10)
+        for d in ("v20install2", "v20install3"):
+            if os.path.exists(os.path.join(DIR_UNITTEST_RT, d)):
+                shutil.rmtree(os.path.join(DIR_UNITTEST_RT, d))
+        BaseTestCase.tearDown(self)
+
+    def run_command(self, argv, cwd=None):
+        return v20client.send_request(v20client.connect(self.socket_path), {"op": "run", "argv": argv, "cwd": cwd or os.getcwd()})
+
+    def test_daemon_install(self):
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        install = ["install", "-pkg", "snappy-deps", "-ver", SNAPPY_VERSION, "-p", SNAPPY_PLATFORM, "-depol", DIR_DEPOT, "-d"]
+        for install_dir in (DIR_INSTALL, "v20install2"):
+            response = self.run_command(install + [install_dir], DIR_UNITTEST_RT)
+            assert response["exit"] == 0 and "Installation completed." in response["stdout"]
+        assert CommonUtils.get_filecount_for_dir_tree(SNAPPY_INSTALLDIR) == 21
+        assert CommonUtils.get_filecount_for_dir_tree(os.path.join(DIR_UNITTEST_RT, "v20install2")) == 21
+        cache = self.daemon.get_status()["cache"]
+        assert cache["hits"]["graph"] == 1 and cache["misses"]["graph"] == 1
+        assert cache["hits"]["manifest"] >= 1
+
+        # a package published by another process is seen by the next command
+        staging = os.path.join(DIR_DEPOT, "staging")
+        shutil.copytree(DIR_SNAPPY_STAGING, staging)
+        with open(os.path.join(staging, "lib", "libsnappy.la"), "a") as f:
+            f.write("# changed")
+        ManifestGenerator(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP).generate_manifest()
+        SoftwareDepot(DIR_DEPOT).update(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM, staging, DIR_DEPOT_TEMP)
+        response = self.run_command(install + ["v20install3"], DIR_UNITTEST_RT)
+        assert response["exit"] == 0
+        assert self.daemon.get_status()["cache"]["misses"]["graph"] == 2
+        installed = os.path.join(DIR_UNITTEST_RT, "v20install3", "lib", "libsnappy.la")
+        with open(installed) as f:
+            assert f.read().endswith("# changed")
+
+    def test_daemon_depot_list(self):
+        list_json = ["depot", "-l", DIR_DEPOT, "list", "-f", "json"]
+        first = self.run_command(list_json)
+        assert self.run_command(list_json) == first
+        assert [r["package"] for r in json.loads(first["stdout"])] == [SNAPPY_PKG_NAME]
+        assert self.daemon.get_status()["cache"]["hits"]["listing"] == 1
+        self.add_meta_package_to_depot("snappy-deps", [(SNAPPY_PKG_NAME, SNAPPY_VERSION, SNAPPY_PLATFORM)])
+        records = json.loads(self.run_command(list_json)["stdout"])
+        assert sorted(r["package"] for r in records) == ["snappy", "snappy-deps"]
+
+    # Negative testing
+    def test_daemon_errors(self):
+        response = self.run_command(["depot", "-l", DIR_DEPOT, "serve"])
+        assert response["exit"] == 2 and "can not be run by the daemon" in response["stderr"]
+        response = self.run_command(["install", "-pkg", SNAPPY_PKG_NAME])
+        assert response["exit"] == 2 and "required" in response["stderr"]
+        response = self.run_command(["uninstall", "-pkg", "missing", "-ver", SNAPPY_VERSION, "-p", SNAPPY_PLATFORM, "-d", DIR_INSTALL])
+        assert response["exit"] == 1 and "ResourceNotFoundError" in response["stderr"]
+
+    def test_daemon_stop(self):
+        response = v20client.send_request(v20client.connect(self.socket_path), {"op": "stop"})
+        assert response["exit"] == 0
+        self.thread.join(10)
+        assert not os.path.exists(self.socket_path)
+        # without a daemon the client runs the command itself
+        assert not v20client.main(["--socket", self.socket_path, "depot", "-l", DIR_DEPOT, "reindex"])
+
+
+class BenchmarkTestCases(BaseTestCase):
+
+    def test_benchmark_fanout(self):
+        shape = benchmark.Shape("test", 3, 12, 16, 4096)
+        work_dir = os.path.join(DIR_UNITTEST_RT, "v20bench")
+        results = benchmark.Benchmark(shape, work_dir, repeat=2, jobs=2, pack=True).run()
+        shutil.rmtree(work_dir)
+        assert results["staged"]["files"] == 36
+        assert sorted(results["results"]) == sorted(benchmark.STEPS)
+        assert len(results["results"][benchmark.STEP_INSTALL]["runs"]) == 2
+        assert "fetch" in results["results"][benchmark.STEP_INSTALL_UPDATE]["phases"]
+        rows, regressions = benchmark.compare(results, results, 0.1)
+        assert len(rows) == len(benchmark.STEPS) and not regressions
+
+    def test_benchmark_content_is_reproducible(self):
+        shape = benchmark.Shape("test", 1, 20, 16, 4096)
+        hashes = []
+        for d in ("a", "b"):
+            stage_dir = os.path.join(DIR_UNITTEST_RT, "v20bench", d)
+            benchmark.SyntheticTree(shape, stage_dir, 7).stage()
+            manifest = json.loads(ManifestGenerator("bench000", "1.0", "bench", os.path.join(stage_dir, "bench000"), None,
+                                                    use_hash_cache=False).generate_manifest())
+            hashes.append(sorted((f["path"], f["sha1"], f["mode"]) for f in manifest[CommonConsts.MF_KEY_FILES]))
+        shutil.rmtree(os.path.join(DIR_UNITTEST_RT, "v20bench"))
+        assert hashes[0] == hashes[1]
+
+    def test_benchmark_startup(self):
+        work_dir = os.path.join(DIR_UNITTEST_RT, "v20bench")
+        results = benchmark.StartupBenchmark(work_dir, repeat=2, budget=60).run()
+        shutil.rmtree(work_dir)
+        assert sorted(results["results"]) == sorted(benchmark.STARTUP_COMMANDS)
+        assert len(results["results"][benchmark.STARTUP_GENSHA1]["runs"]) == 2
+        assert results["over_budget"] == []
+        rows, regressions = benchmark.compare(results, results, 0.1)
+        assert len(rows) == len(benchmark.STARTUP_COMMANDS) and not regressions
+
+    def test_cli_lazy_imports(self):
+        sample = os.path.join(DIR_SNAPPY_STAGING, "lib", "libsnappy.la")
+        for argv, modules in ((["manifest", "gensha1", sample], ["logging", "manifestutils", "swdepot", "depinstall", "transport"]),
+                              (["depot", "-l", DIR_DEPOT, "list"], ["logging", "depinstall", "transport", "httplib", "multiprocessing",
+                                                                "bz2", "packfile", "blobstore", "manifestutils", "chunking", "hashutils"])):
+            code = "import sys, voltron20; voltron20.main({0!r}); print sorted(set(sys.modules) & set({1!r}))".format(argv, modules)
+            output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+            assert output.splitlines()[-1] == "[]"
+            if argv[1] == "gensha1":
+                assert output.splitlines()[0] == CommonUtils.get_filehash(sample)
 
 
     if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import os
+import sys
+import json
+import socket
+import errno
+
+from commons import CommonConsts
+
+'''
+Thin client of the voltron20 daemon: takes the arguments of voltron20, runs the command in the daemon and exits
+with its exit code after printing its output. The daemon listens on the socket given with --socket before the
+command, in the VOLTRON20_SOCKET environment variable or on the default socket. If no daemon is listening, the
+command is run in this process.
+
+    python v20client.py [--socket <path>] <voltron20 arguments>
+'''
+
+
+def get_socket_path(socket_path=None):
+    return socket_path or os.environ.get(CommonConsts.DAEMON_SOCKET_ENV) or CommonConsts.DAEMON_SOCKET
+
+def connect(socket_path):
+    """Returns a socket connected to the daemon listening on socket_path; raises socket.error if none is."""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except socket.error:
+        s.close()
+        raise
+    return s
+
+def send_request(s, request):
+    """Sends a request over the connected socket s and returns the response of the daemon."""
+    try:
+        s.sendall(json.dumps(request) + "\n")
+        line = s.makefile("rb").readline()
+    finally:
+        s.close()
+    if not line:
+        raise socket.error(errno.ECONNRESET, "The voltron daemon closed the connection")
+    return json.loads(line)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    socket_path = None
+    if len(argv) > 1 and argv[0] == "--socket":
+        socket_path, argv = argv[1], argv[2:]
+    try:
+        s = connect(get_socket_path(socket_path))
+    except socket.error:
+        import voltron20
+        return voltron20.main(argv)
+    response = send_request(s, {"op": "run", "argv": argv, "cwd": os.getcwd()})
+    sys.stdout.write(response["stdout"].encode("utf-8"))
+    sys.stderr.write(response["stderr"].encode("utf-8"))
+    return response["exit"]
+
+if __name__ == "__main__":
+    sys.exit(main())
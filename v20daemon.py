@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import socket
+import errno
+import threading
+import traceback
+import urlparse
+import SocketServer
+import cStringIO
+
+import logger
+from commons import CommonUtils
+from depotcache import DepotCache
+
+'''
+Requests and responses are single lines of JSON. A request is {"op": "run", "argv": [...], "cwd": ...} to run a
+voltron20 command, {"op": "status"} or {"op": "stop"}; the response to a command is {"exit", "stdout", "stderr"}.
+'''
+DAEMON_OP_RUN = "run"
+DAEMON_OP_STATUS = "status"
+DAEMON_OP_STOP = "stop"
+
+"""Arguments holding paths, which are relative to the working directory of the client."""
+_PATH_ARGUMENTS = ("depot_location", "install_dir", "stage_dir", "staging_dir", "manifest_dir", "target_file_path",
+                   "hash_cache", "cache_dir", "checkpoint_file", "output", "trace_file", "profile_file", "file_path")
+
+
+class _ThreadLocalStream:
+    """Stands in for sys.stdout or sys.stderr, writing to the stream set for the current thread, if any."""
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def set_stream(self, stream):
+        self._local.stream = stream
+
+    def get_stream(self):
+        stream = getattr(self._local, "stream", None)
+        return self._default if stream is None else stream
+
+    def write(self, data):
+        self.get_stream().write(data)
+
+    def flush(self):
+        self.get_stream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.get_stream(), name)
+
+
+class _DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _DaemonRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {"exit": 2, "stdout": "", "stderr": "Invalid request: {0}\n".format(e)}
+        else:
+            response = self.server.voltron.handle_request(request)
+        self.wfile.write(json.dumps(response) + "\n")
+        if response.get("stopping"):
+            threading.Thread(target=self.server.voltron.shutdown).start()
+
+
+class VoltronDaemon:
+    """Runs voltron20 commands sent by clients over a Unix socket, in one long-running process whose DepotCache keeps
+    the manifests, dependency graphs and depot listings parsed by earlier commands. Commands run in a thread each,
+    with their output captured and returned to the client; log messages go to the log of the daemon.
+
+    parser is the voltron20 argument parser and run the function running the parsed command; commands parsed with
+    local_only set are refused. The socket is only accessible to the user running the daemon, as the commands run
+    with its permissions.
+    """
+
+    def __init__(self, socket_path, parser, run, cache=None):
+        self._log = logger.Logger.get_logger()
+        self._socket_path = socket_path
+        self._parser = parser
+        self._run = run
+        self._cache = cache or DepotCache()
+        self._started = time.time()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def serve_forever(self):
+        self._prepare_socket()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = _ThreadLocalStream(stdout), _ThreadLocalStream(stderr)
+        try:
+            umask = os.umask(0177)
+            try:
+                server = _DaemonServer(self._socket_path, _DaemonRequestHandler)
+            finally:
+                os.umask(umask)
+            server.voltron = self
+            self._server = server
+            self._log.info("Voltron daemon listening on {0} .".format(self._socket_path))
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                self._remove_socket()
+                self._log.info("Voltron daemon on {0} stopped.".format(self._socket_path))
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def shutdown(self):
+        if self._server:
+            self._server.shutdown()
+
+    def handle_request(self, request):
+        op = request.get("op", DAEMON_OP_RUN)
+        if op == DAEMON_OP_RUN:
+            return self.run_command(request.get("argv", []), request.get("cwd") or os.getcwd())
+        if op == DAEMON_OP_STATUS:
+            return {"exit": 0, "status": self.get_status()}
+        if op == DAEMON_OP_STOP:
+            return {"exit": 0, "stdout": "Voltron daemon stopping.\n", "stderr": "", "stopping": True}
+        return {"exit": 2, "stdout": "", "stderr": "Unknown request: {0}\n".format(op)}
+
+    def get_status(self):
+        with self._lock:
+            requests = self._requests
+        return {"pid": os.getpid(), "socket": self._socket_path, "uptime": time.time() - self._started,
+                "requests": requests, "cache": self._cache.stats()}
+
+    """Runs a command as voltron20 would in cwd and returns its exit code and output."""
+    def run_command(self, argv, cwd):
+        with self._lock:
+            self._requests += 1
+        stdout, stderr = cStringIO.StringIO(), cStringIO.StringIO()
+        sys.stdout.set_stream(stdout)
+        sys.stderr.set_stream(stderr)
+        try:
+            code = self._run_command(argv, cwd)
+        finally:
+            sys.stdout.set_stream(None)
+            sys.stderr.set_stream(None)
+        return {"exit": code, "stdout": stdout.getvalue().decode("utf-8", "replace"),
+                "stderr": stderr.getvalue().decode("utf-8", "replace")}
+
+    def _run_command(self, argv, cwd):
+        try:
+            args = self._parser.parse_args([a.encode("utf-8") if isinstance(a, unicode) else a for a in argv])
+            if getattr(args, "local_only", False):
+                sys.stderr.write("Command {0} can not be run by the daemon.\n".format(" ".join(argv)))
+                return 2
+            self._make_paths_absolute(args, cwd)
+            args.depot_cache = self._cache
+            return self._run(args) or 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            sys.stderr.write("{0}\n".format(e.code))
+            return 1
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+            return 1
+
+    def _make_paths_absolute(self, args, cwd):
+        for name in _PATH_ARGUMENTS:
+            value = getattr(args, name, None)
+            if value and not urlparse.urlparse(value).scheme:
+                setattr(args, name, os.path.join(cwd, value))
+
+    """Removes the socket left by a daemon that is no longer running; fails if one still listens on it."""
+    def _prepare_socket(self):
+        CommonUtils.make_dirs(os.path.dirname(os.path.abspath(self._socket_path)), 0700)
+        if not os.path.exists(self._socket_path):
+            return
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self._socket_path)
+        except socket.error as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+                raise
+            self._remove_socket()
+            return
+        finally:
+            s.close()
+        raise RuntimeError("A voltron daemon is already listening on {0}".format(self._socket_path))
+
+    def _remove_socket(self):
+        try:
+            os.remove(self._socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,100 @@
+import os
+import stat
+import json
+import logger
+
+from commons import CommonUtils, CommonConsts
+from parallel import WorkerPool
+from manifestutils import ManifestFile
+
+VERIFY_MODE_QUICK = "quick"
+VERIFY_MODE_DEEP = "deep"
+
+FILE_STATUS_OK = "ok"
+FILE_STATUS_MISSING = "missing"
+FILE_STATUS_MODIFIED = "modified"
+FILE_STATUS_MODE_CHANGED = "mode_changed"
+
+
+class InstallVerifier:
+    """Checks the files of every package recorded in <install_dir>/etc/packages against its manifest.
+
+    Each file is stat'ed once. In quick mode a file whose size and mtime still match the snapshot
+    recorded at install time is trusted without hashing; in deep mode every file is re-hashed.
+    Files are checked in parallel by jobs workers.
+    """
+
+    def __init__(self, install_dir, jobs=1, mode=VERIFY_MODE_QUICK):
+        self._log = logger.Logger.get_logger()
+        self._install_dir = install_dir
+        self._etc_dir = os.path.join(install_dir, CommonConsts.INSTALL_ETC_PACKAGES_DIR)
+        self._jobs = jobs
+        self._mode = mode
+
+    def verify(self, packages=None):
+        """Returns the report as a dictionary. packages optionally limits the check to the given package names."""
+        report = {"install_dir": self._install_dir, "mode": self._mode, "packages": {}}
+        for mfn in self._get_installed_manifests():
+            package = os.path.splitext(mfn)[0]
+            if packages and package not in packages:
+                continue
+            report["packages"][package] = self._verify_package(mfn)
+        report["ok"] = all(p["ok"] for p in report["packages"].values())
+        return report
+
+    def _get_installed_manifests(self):
+        if not os.path.isdir(self._etc_dir):
+            return []
+        exts = tuple("." + ext for ext in CommonConsts.MF_EXTS)
+        return sorted(mfn for mfn in os.listdir(self._etc_dir) if mfn.endswith(exts))
+
+    def _verify_package(self, mfn):
+        manifest = ManifestFile.load_file(os.path.join(self._etc_dir, mfn))
+        snapshot = {}
+        if self._mode == VERIFY_MODE_QUICK:
+            snapshot = self._load_snapshot(mfn)
+        files = list(manifest.get(CommonConsts.MF_KEY_FILES, []))
+        statuses = WorkerPool(self._jobs).map(lambda f: self._verify_file(f, snapshot), files)
+        result = {"files": len(files), FILE_STATUS_MISSING: [], FILE_STATUS_MODIFIED: [], FILE_STATUS_MODE_CHANGED: []}
+        for f, file_statuses in zip(files, statuses):
+            for status in file_statuses:
+                result[status].append(f[CommonConsts.MF_KEY_FILES_ATTR_PATH])
+        result["ok"] = not (result[FILE_STATUS_MISSING] or result[FILE_STATUS_MODIFIED] or result[FILE_STATUS_MODE_CHANGED])
+        return result
+
+    def _load_snapshot(self, mfn):
+        path = os.path.join(self._etc_dir, CommonUtils.generate_snapshot_filename(mfn))
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "rb") as f:
+                return json.load(f)
+        except ValueError as e:
+            self._log.warning("Ignoring unreadable install snapshot: {0}. Error is {1}".format(path, e))
+            return {}
+
+    def _verify_file(self, f, snapshot):
+        path = f[CommonConsts.MF_KEY_FILES_ATTR_PATH]
+        fullpath = os.path.join(self._install_dir, path)
+        try:
+            st = os.stat(fullpath)
+        except OSError:
+            return [FILE_STATUS_MISSING]
+        statuses = []
+        if oct(stat.S_IMODE(st.st_mode)) != f[CommonConsts.MF_KEY_FILES_ATTR_MODE]:
+            statuses.append(FILE_STATUS_MODE_CHANGED)
+        if snapshot.get(path) != CommonUtils.get_stat_snapshot(st):
+            if CommonUtils.get_filehash(fullpath) != f[CommonConsts.MF_KEY_FILES_ATTR_SHA1]:
+                statuses.append(FILE_STATUS_MODIFIED)
+        return statuses
+
+    @staticmethod
+    def format_report(report):
+        lines = []
+        for package in sorted(report["packages"]):
+            result = report["packages"][package]
+            lines.append("{0}: {1} files, {2}".format(package, result["files"], "OK" if result["ok"] else "FAILED"))
+            for status in (FILE_STATUS_MISSING, FILE_STATUS_MODIFIED, FILE_STATUS_MODE_CHANGED):
+                for path in result[status]:
+                    lines.append("    {0}: {1}".format(status, path))
+        return "\n".join(lines)
@@ -1,23 +1,47 @@
+import os
 import sys
+import json
 import argparse
-from manifestutils import ManifestGenerator
-import swdepot
-import depinstall
-from depinstall import PackageInstaller
+import logger
+from commons import CommonConsts, CommonUtils
 
-def _define_arguments():
+'''
+Commands import the modules they use when they run, and only the command given on the command line gets its
+arguments defined, so short commands such as depot list or manifest gensha1 do not pay for importing the
+installer, the HTTP transport or the logging setup.
+'''
+
+def _define_arguments(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    return _build_parser(argv).parse_args(argv)
+
+"""Defines the arguments of the command in argv, or of all commands if argv is None."""
+def _build_parser(argv=None):
     parser = argparse.ArgumentParser(prog="voltron20", description='Build Software.')
+    parser.add_argument("--verbose", "-v", dest="verbose", action="store_true", help="Log debug messages, such as every file installed.")
     sub_parsers = parser.add_subparsers(dest="subparser_name")
+    command = None if argv is None else _get_command(argv)
 
-    parser_manifest = sub_parsers.add_parser("manifest", help="Utility for manifest file.")
-    parser_depot = sub_parsers.add_parser("depot", help="Software depot management.")
-    parser_install = sub_parsers.add_parser("install", help="Package Installer.")
+    for name, help_text, define in (
+            ("manifest", "Utility for manifest file.", _define_parser_manifest),
+            ("depot", "Software depot management.", _define_parser_depot),
+            ("install", "Package Installer.", _define_parser_install),
+            ("verify", "Verify installed packages.", _define_parser_verify),
+            ("uninstall", "Package Uninstaller.", _define_parser_uninstall),
+            ("owns", "Shows the installed packages owning files.", _define_parser_owns),
+            ("conflicts", "Lists the files of a depot package owned by other installed packages.", _define_parser_conflicts),
+            ("daemon", "Runs commands sent by v20client in a long-running process that caches manifests.", _define_parser_daemon)):
+        command_parser = sub_parsers.add_parser(name, help=help_text)
+        if argv is None or name == command:
+            define(command_parser)
 
-    _define_parser_manifest(parser_manifest)
-    _define_parser_depot(parser_depot)
-    _define_parser_install(parser_install)
+    return parser
 
-    return parser.parse_args()
+def _get_command(argv):
+    for arg in argv:
+        if not arg.startswith("-"):
+            return arg
+    return None
 
 
 
@@ -30,25 +54,44 @@ def _define_parser_manifest(parser):
     parser_genfile.add_argument("--platform", "-p", dest="platform", required=True, help="Target platform.")
     parser_genfile.add_argument("--stage_dir", "-sd", dest="stage_dir", required=True, help="Staging directory.")
     parser_genfile.add_argument("--target_file_path", "-tfp", dest="target_file_path", help="Target file path.")
+    parser_genfile.add_argument("--hash_cache", "-hc", dest="hash_cache", help="Hash cache file path. Defaults to a file next to the staging directory.")
+    parser_genfile.add_argument("--no_hash_cache", dest="use_hash_cache", action="store_false", help="Hash every file without using the hash cache.")
+    parser_genfile.add_argument("--format", "-f", dest="manifest_format", choices=[CommonConsts.MF_EXT_JSON, CommonConsts.MF_EXT_BINARY],
+                                default=CommonConsts.MF_EXT_JSON, help="Manifest file format: JSON or the compact binary format.")
+    _define_hash_arguments(parser_genfile)
     parser_genfile.set_defaults(func=_handle_manifest_genfile)
 
 
     parser_gensha1 = sub_parsers.add_parser("gensha1", help="Generate sha1 string for given file.")
     parser_gensha1.add_argument("file_path", help="Provide the file path.")
+    parser_gensha1.set_defaults(func=_handle_manifest_gensha1)
 
 def _define_parser_depot(parser):
     parser.add_argument("-location", "-l", dest="depot_location", help="Location of software depot.")
+    parser.add_argument("--hardlink", dest="hardlink", action="store_true", help="Hardlink blobs from the staging directory. Staged files must not be modified afterwards.")
+    _define_hash_arguments(parser)
+    _define_stats_arguments(parser)
     sub_parsers = parser.add_subparsers(dest="subparser_name")
 
-    parser_list = sub_parsers.add_parser("list", help="Lists all the packages in the software depot.")
+    parser_list = sub_parsers.add_parser("list", help="Lists the packages in the software depot.")
+    parser_list.add_argument("--package_name", "-pkg", dest="package_name", help="Only packages with this name.")
+    parser_list.add_argument("--version", "-ver", dest="version", help="Only packages with this version.")
+    parser_list.add_argument("--platform", "-p", dest="platform", help="Only packages for this platform.")
+    parser_list.add_argument("--format", "-f", dest="list_format", choices=("text", "json"), default="text", help="Output format.")
     parser_list.set_defaults(func=_handle_depot_list)
 
+    parser_reindex = sub_parsers.add_parser("reindex", help="Rebuilds the package index of the software depot from its manifests.")
+    parser_reindex.set_defaults(func=_handle_depot_reindex)
+
     parser_add = sub_parsers.add_parser("add", help="Adds a package to software depot.")
     parser_add.add_argument("--package_name", "-pkg", dest="package_name", required=True, help="Name of the package.")
     parser_add.add_argument("--version", "-ver", dest="version", required=True, help="Package version.")
     parser_add.add_argument("--platform", "-p", dest="platform", required=True, help="Target platform.")
     parser_add.add_argument("--stage_dir", "-sd", dest="staging_dir", required=True, help="Staging directory with absolute path.")
     parser_add.add_argument("--manifest_dirpath", "-md", dest="manifest_dir", required=True, help="Absolute path of manifest directory.")
+    parser_add.add_argument("--pack", dest="pack", action="store_true", help="Also write a packfile of the package blobs for faster installs.")
+    parser_add.add_argument("--compress", dest="compress", action="store_true", help="Store new blobs compressed with the codec that suits each of them.")
+    parser_add.add_argument("--chunk", dest="chunk", action="store_true", help="Store large files as content-defined chunks shared between versions.")
     parser_add.set_defaults(func=_handle_depot_add)
 
     parser_update = sub_parsers.add_parser("update", help="Updates a package in software depot.")
@@ -57,6 +100,9 @@ def _define_parser_depot(parser):
     parser_update.add_argument("--platform", "-p", dest="platform", required=True, help="Target platform.")
     parser_update.add_argument("--stage_dir", "-sd", dest="staging_dir", required=True, help="Staging directory with absolute path.")
     parser_update.add_argument("--manifest_dir", "-md", dest="manifest_dir", required=True, help="Absolute path of manifest directory.")
+    parser_update.add_argument("--pack", dest="pack", action="store_true", help="Also write a packfile of the package blobs for faster installs.")
+    parser_update.add_argument("--compress", dest="compress", action="store_true", help="Store new blobs compressed with the codec that suits each of them.")
+    parser_update.add_argument("--chunk", dest="chunk", action="store_true", help="Store large files as content-defined chunks shared between versions.")
     parser_update.set_defaults(func=_handle_depot_update)
 
     parser_del = sub_parsers.add_parser("delete", help="Deletes a package in software depot.")
@@ -65,12 +111,54 @@ def _define_parser_depot(parser):
     parser_del.add_argument("--platform", "-p", dest="platform", required=True, help="Target platform.")
     parser_del.set_defaults(func=_handle_depot_delete)
 
+    parser_gc = sub_parsers.add_parser("gc", help="Removes the blobs, packfiles and temporary files no manifest references.")
+    parser_gc.add_argument("--dry_run", dest="dry_run", action="store_true", help="Only report what would be removed.")
+    parser_gc.add_argument("--min_age", dest="min_age", type=int, default=CommonConsts.DEPOT_GC_MIN_AGE,
+                           help="Keep unreferenced blobs modified less than this many seconds ago.")
+    parser_gc.add_argument("--format", "-f", dest="report_format", choices=["text", "json"], default="text", help="Report format.")
+    parser_gc.set_defaults(func=_handle_depot_gc)
+
+    parser_scrub = sub_parsers.add_parser("scrub", help="Re-hashes the stored blobs and reports the corrupt ones.")
+    parser_scrub.add_argument("--io_budget", dest="io_budget", type=int, help="Maximum MB read per second.")
+    parser_scrub.add_argument("--checkpoint", dest="checkpoint_file", help="Checkpoint file. Defaults to a file in the depot.")
+    parser_scrub.add_argument("--restart", dest="resume", action="store_false", help="Scrub from the start instead of resuming from the checkpoint.")
+    parser_scrub.add_argument("--limit", dest="limit", type=int, help="Stop after this many blobs; the next scrub resumes from there.")
+    parser_scrub.add_argument("--format", "-f", dest="report_format", choices=["text", "json"], default="text", help="Report format.")
+    parser_scrub.set_defaults(func=_handle_depot_scrub)
+
+    parser_serve = sub_parsers.add_parser("serve", help="Serves the software depot over HTTP.")
+    parser_serve.add_argument("--port", dest="port", type=int, default=CommonConsts.DEFAULT_DEPOT_HTTP_PORT, help="Port to listen on.")
+    parser_serve.add_argument("--host", dest="host", default="127.0.0.1", help="Address to listen on.")
+    parser_serve.set_defaults(func=_handle_depot_serve, local_only=True)
+
+def _define_hash_arguments(parser):
+    from parallel import POOL_TYPES, POOL_TYPE_THREAD
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int, help="Number of files hashed in parallel. Defaults to the number of CPUs.")
+    parser.add_argument("--pool", dest="pool_type", choices=POOL_TYPES, default=POOL_TYPE_THREAD, help="Hash files in a thread or a process pool.")
+
+def _define_stats_arguments(parser):
+    parser.add_argument("--stats", dest="stats", action="store_true", help="Print the time spent in each phase, per package, when done.")
+    parser.add_argument("--trace", dest="trace_file", help="Write the timed phases to this file in the Chrome trace event format.")
+    parser.add_argument("--profile", dest="profile_file", help="Run the command under cProfile and write the profile to this file.")
+
 def _define_parser_install(parser):
+    from depinstall import INSTALL_ENGINES, INSTALL_ENGINE_POOL
     parser.add_argument("--package_name", "-pkg", dest="package_name", required=True, help="Name of the package.")
     parser.add_argument("--version", "-ver", dest="version", required=True, help="Package version.")
     parser.add_argument("--platform", "-p", dest="platform", required=True, help="Target platform.")
     parser.add_argument("--install_dir", "-d", dest="install_dir", required=True, help="Root installation directory path")
-    parser.add_argument("--depot_location", "-depol", dest="depot_location", required=True, help="Location of software depot.")
+    parser.add_argument("--depot_location", "-depol", dest="depot_location", required=True, help="Location of software depot: a path or an http(s) URL.")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int, default=CommonConsts.DEFAULT_INSTALL_JOBS, help="Number of files installed in parallel.")
+    parser.add_argument("--dep_jobs", "-dj", dest="dep_jobs", type=int, default=CommonConsts.DEFAULT_DEPENDENCY_JOBS, help="Number of dependency packages installed in parallel.")
+    parser.add_argument("--verify", dest="verify", action="store_true", help="Re-hash files that are unchanged since the installed version of the package.")
+    parser.add_argument("--cache_dir", "-cd", dest="cache_dir", help="Local blob cache directory shared by install roots.")
+    parser.add_argument("--cache_size", dest="cache_size", type=int, default=CommonConsts.DEFAULT_BLOB_CACHE_SIZE_MB, help="Maximum blob cache size in MB.")
+    parser.add_argument("--no_packs", dest="use_packs", action="store_false", help="Fetch blobs one by one even if the depot has a packfile of the package.")
+    parser.add_argument("--engine", dest="engine", choices=INSTALL_ENGINES, default=INSTALL_ENGINE_POOL,
+                        help="Install files with a pool of workers, or through a pipeline of verify, fetch and commit stages.")
+    parser.add_argument("--plan", dest="plan", action="store_true", help="Print what the install would do without changing anything.")
+    parser.add_argument("--format", "-f", dest="plan_format", choices=("text", "json"), default="text", help="Format of the --plan output.")
+    _define_stats_arguments(parser)
     parser.set_defaults(func=_handle_install)
     '''
     sub_parsers = parser.add_subparsers(dest="subparser_name")
@@ -80,37 +168,252 @@ def _define_parser_install(parser):
     parser_verify.add_argument("staging_dir_path", help="Staging direcverify_before_installtory path.")
     '''
 
+def _define_parser_verify(parser):
+    from verifier import VERIFY_MODE_QUICK, VERIFY_MODE_DEEP
+    parser.add_argument("--install_dir", "-d", dest="install_dir", required=True, help="Root installation directory path")
+    parser.add_argument("--package", "-pkg", dest="packages", action="append", help="Installed package (<name>-<version>-<platform>) to verify. Defaults to all.")
+    parser.add_argument("--deep", dest="verify_mode", action="store_const", const=VERIFY_MODE_DEEP, default=VERIFY_MODE_QUICK,
+                        help="Re-hash every file instead of trusting unchanged size and mtime.")
+    parser.add_argument("--jobs", "-j", dest="jobs", type=int, default=CommonConsts.DEFAULT_INSTALL_JOBS, help="Number of files verified in parallel.")
+    parser.add_argument("--format", "-f", dest="report_format", choices=["text", "json"], default="text", help="Report format.")
+    parser.add_argument("--output", "-o", dest="output", help="Write the report to this file instead of stdout.")
+    parser.set_defaults(func=_handle_verify)
+
+def _define_parser_uninstall(parser):
+    parser.add_argument("--package_name", "-pkg", dest="package_name", required=True, help="Name of the package.")
+    parser.add_argument("--version", "-ver", dest="version", required=True, help="Package version.")
+    parser.add_argument("--platform", "-p", dest="platform", required=True, help="Target platform.")
+    parser.add_argument("--install_dir", "-d", dest="install_dir", required=True, help="Root installation directory path")
+    parser.add_argument("--force", dest="force", action="store_true", help="Uninstall even if other installed packages depend on the package.")
+    parser.set_defaults(func=_handle_uninstall)
+
+def _define_parser_owns(parser):
+    parser.add_argument("--install_dir", "-d", dest="install_dir", required=True, help="Root installation directory path")
+    parser.add_argument("paths", nargs="+", help="Paths of installed files, relative to the installation directory.")
+    parser.set_defaults(func=_handle_owns)
+
+def _define_parser_conflicts(parser):
+    parser.add_argument("--package_name", "-pkg", dest="package_name", required=True, help="Name of the package.")
+    parser.add_argument("--version", "-ver", dest="version", required=True, help="Package version.")
+    parser.add_argument("--platform", "-p", dest="platform", required=True, help="Target platform.")
+    parser.add_argument("--install_dir", "-d", dest="install_dir", required=True, help="Root installation directory path")
+    parser.add_argument("--depot_location", "-depol", dest="depot_location", required=True, help="Location of software depot: a path or an http(s) URL.")
+    parser.set_defaults(func=_handle_conflicts)
+
+def _define_parser_daemon(parser):
+    parser.add_argument("--socket", dest="socket_path", help="Unix socket of the daemon. Defaults to ${0} or {1}.".format(
+        CommonConsts.DAEMON_SOCKET_ENV, CommonConsts.DAEMON_SOCKET))
+    parser.set_defaults(local_only=True)
+    sub_parsers = parser.add_subparsers(dest="subparser_name")
+
+    parser_start = sub_parsers.add_parser("start", help="Starts the daemon in the foreground.")
+    parser_start.set_defaults(func=_handle_daemon_start)
+
+    parser_status = sub_parsers.add_parser("status", help="Shows whether the daemon is running and its cache statistics.")
+    parser_status.set_defaults(func=_handle_daemon_status)
+
+    parser_stop = sub_parsers.add_parser("stop", help="Stops the daemon.")
+    parser_stop.set_defaults(func=_handle_daemon_stop)
+
 def _handle_manifest_genfile(args):
-    mangen = ManifestGenerator(args.package_name, args.version, args.platform, args.stage_dir, args.target_file_path)
+    from manifestutils import ManifestGenerator
+    mangen = ManifestGenerator(args.package_name, args.version, args.platform, args.stage_dir, args.target_file_path,
+                               args.hash_cache, args.use_hash_cache, args.jobs, args.pool_type,
+                               args.manifest_format)
     mangen.generate_manifest()
     print "Manifest generated."
 
+def _handle_manifest_gensha1(args):
+    print CommonUtils.get_filehash(args.file_path)
+
+def _get_depot(args):
+    import swdepot
+    return swdepot.SoftwareDepot(args.depot_location, args.jobs, args.pool_type, args.hardlink, args.metrics, args.depot_cache)
+
 def _handle_depot_list(args):
-    depot = swdepot.SoftwareDepot(args.depot_location)
-    depot.list()
+    depot = _get_depot(args)
+    records = depot.query(args.package_name, args.version, args.platform)
+    if args.list_format == "json":
+        print json.dumps(records, indent=4, sort_keys=True)
+        return
+    for r in records:
+        print "{0}\t{1}\t{2}\t{3} files\t{4} bytes\t{5} dependencies".format(r["package"], r["version"], r["platform"],
+                                                                          r["file_count"], r["total_size"], len(r["depends"]))
+
+def _handle_depot_reindex(args):
+    depot = _get_depot(args)
+    depot.reindex()
+    print "Depot index rebuilt."
 
 def _handle_depot_add(args):
-    depot = swdepot.SoftwareDepot(args.depot_location)
-    depot.add(args.package_name, args.version, args.platform, args.staging_dir, args.manifest_dir)
+    depot = _get_depot(args)
+    depot.add(args.package_name, args.version, args.platform, args.staging_dir, args.manifest_dir, args.pack, args.compress, args.chunk)
     print "Package added."
 
 def _handle_depot_update(args):
-    depot = swdepot.SoftwareDepot(args.depot_location)
-    depot.update(args.package_name, args.version, args.platform, args.staging_dir, args.manifest_dir)
+    depot = _get_depot(args)
+    depot.update(args.package_name, args.version, args.platform, args.staging_dir, args.manifest_dir, args.pack, args.compress, args.chunk)
     print "Package updated."
 
 def _handle_depot_delete(args):
-    depot = swdepot.SoftwareDepot(args.depot_location)
+    depot = _get_depot(args)
     depot.delete(args.package_name, args.version, args.platform)
     print "Package deleted."
 
+def _handle_depot_gc(args):
+    from depotgc import DepotCollector
+    depot = _get_depot(args)
+    report = depot.gc(args.dry_run, args.min_age)
+    if args.report_format == "json":
+        print json.dumps(report, indent=4, sort_keys=True)
+    else:
+        print DepotCollector.format_report(report)
+
+def _handle_depot_scrub(args):
+    from depotgc import DepotScrubber
+    depot = _get_depot(args)
+    report = depot.scrub(args.io_budget * 1024 * 1024 if args.io_budget else None, args.checkpoint_file, args.resume, args.limit)
+    if args.report_format == "json":
+        print json.dumps(report, indent=4, sort_keys=True)
+    else:
+        print DepotScrubber.format_report(report)
+    if not report["ok"]:
+        return 1
+
+def _handle_depot_serve(args):
+    depot = _get_depot(args)
+    print "Serving software depot {0} on http://{1}:{2} ...".format(args.depot_location, args.host, args.port)
+    depot.serve(args.port, args.host)
+
 def _handle_install(args):
-    PackageInstaller(args.package_name, args.version, args.platform, args.install_dir, args.depot_location).install()
+    if args.plan:
+        return _handle_install_plan(args)
+    from depinstall import get_installer_class
+    blob_cache = None
+    if args.cache_dir:
+        from blobcache import BlobCache
+        blob_cache = BlobCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    installer_class = get_installer_class(args.engine)
+    installer_class(args.package_name, args.version, args.platform, args.install_dir, args.depot_location, jobs=args.jobs,
+                    dep_jobs=args.dep_jobs, verify=args.verify, blob_cache=blob_cache, use_packs=args.use_packs,
+                    metrics=args.metrics, depot_cache=args.depot_cache).install()
     print "Installation completed."
 
-def main():
-    argv = _define_arguments()
-    argv.func(argv)
+def _handle_install_plan(args):
+    from installplan import InstallPlanner
+    plan = InstallPlanner(args.package_name, args.version, args.platform, args.install_dir, args.depot_location, jobs=args.jobs,
+                          dep_jobs=args.dep_jobs, verify=args.verify, cache_dir=args.cache_dir, use_packs=args.use_packs).plan()
+    if args.plan_format == "json":
+        print json.dumps(plan, indent=4, sort_keys=True)
+    else:
+        print InstallPlanner.format_plan(plan)
+
+def _handle_verify(args):
+    from verifier import InstallVerifier
+    report = InstallVerifier(args.install_dir, args.jobs, args.verify_mode).verify(args.packages)
+    if args.report_format == "json":
+        output = json.dumps(report, indent=4, sort_keys=True)
+    else:
+        output = InstallVerifier.format_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print output
+    if not report["ok"]:
+        return 1
+
+def _handle_uninstall(args):
+    from depinstall import PackageUninstaller
+    PackageUninstaller(args.package_name, args.version, args.platform, args.install_dir, args.force).uninstall()
+    print "Uninstallation completed."
+
+def _handle_owns(args):
+    from installdb import open_install_database
+    owners = open_install_database(args.install_dir).owners(args.paths)
+    for path in args.paths:
+        print "{0}\t{1}".format(path, owners[path]["package"] if path in owners else "not owned by any package")
+    if len(owners) < len(set(args.paths)):
+        return 1
+
+def _handle_conflicts(args):
+    from depinstall import load_depot_manifest
+    from transport import get_transport
+    from installdb import open_install_database
+    manifest_filename = CommonUtils.generate_manifest_filename(args.package_name, args.version, args.platform, "json")
+    manifest = load_depot_manifest(get_transport(args.depot_location), manifest_filename)
+    paths = [f[CommonConsts.MF_KEY_FILES_ATTR_PATH] for f in manifest.get(CommonConsts.MF_KEY_FILES, [])]
+    conflicts = open_install_database(args.install_dir).conflicts(os.path.splitext(manifest_filename)[0], paths)
+    for r in conflicts:
+        print "{0}\t{1}".format(r["path"], r["package"])
+    if conflicts:
+        return 1
+    print "No conflicts."
+
+def _handle_daemon_start(args):
+    from v20daemon import VoltronDaemon
+    from v20client import get_socket_path
+    VoltronDaemon(get_socket_path(args.socket_path), _build_parser(), _run).serve_forever()
+
+def _handle_daemon_status(args):
+    response = _send_daemon_request(args, {"op": "status"})
+    if response is None:
+        return 1
+    status = response["status"]
+    print "Voltron daemon {0} on {1}: up {2:.0f}s, {3} commands run.".format(status["pid"], status["socket"], status["uptime"], status["requests"])
+    cache = status["cache"]
+    for kind in sorted(cache["hits"]):
+        print "{0}\t{1} hits\t{2} misses".format(kind, cache["hits"][kind], cache["misses"][kind])
+    print "{0} cached entries.".format(cache["entries"])
+
+def _handle_daemon_stop(args):
+    response = _send_daemon_request(args, {"op": "stop"})
+    if response is None:
+        return 1
+    print response["stdout"],
+
+def _send_daemon_request(args, request):
+    import socket
+    from v20client import get_socket_path, connect, send_request
+    socket_path = get_socket_path(args.socket_path)
+    try:
+        return send_request(connect(socket_path), request)
+    except socket.error as e:
+        print "No voltron daemon is running on {0}: {1}".format(socket_path, e)
+        return None
+
+def main(argv=None):
+    args = _define_arguments(argv)
+    logger.Logger.set_verbose(args.verbose)
+    return _run(args)
+
+"""Runs the command, collecting phase timings if --stats or --trace is given and profiling it if --profile is.
+A daemon passes its DepotCache in depot_cache."""
+def _run(args):
+    args.depot_cache = getattr(args, "depot_cache", None)
+    stats = getattr(args, "stats", False)
+    trace_file = getattr(args, "trace_file", None)
+    profile_file = getattr(args, "profile_file", None)
+    args.metrics = None
+    if stats or trace_file:
+        from metrics import Metrics
+        args.metrics = Metrics(trace=trace_file is not None)
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            return profiler.runcall(args.func, args)
+        return args.func(args)
+    finally:
+        if profiler:
+            profiler.dump_stats(profile_file)
+        if args.metrics:
+            if stats:
+                print args.metrics.format_summary()
+            if trace_file:
+                args.metrics.write_trace(trace_file)
 
 if __name__ == "__main__":
     sys.exit(main())